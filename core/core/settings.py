@@ -44,6 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the request timings cover the rest of the stack. They are kept per worker process,
+    # each worker's /metrics has to be scraped separately (see customer.metrics.Registry)
+    'customer.middleware.PerformanceMiddleware',
+    'customer.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,24 +98,97 @@ REST_FRAMEWORK = {
     ]
 }
 
+# Keyset pagination of the list endpoints, clients may ask for up to API_MAX_PAGE_SIZE rows with `page_size`
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
+# Most entries accepted by one /api/cart/add/bulk call
+CART_BULK_MAX_ITEMS = 100
+
+# Outbox events (cart repricing): runs an event gets before it is parked, seconds before
+# the first retry (doubled for each one after) and seconds a worker holds a claimed event
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_SECONDS = 5
+OUTBOX_LEASE_SECONDS = 300
+
+# Seconds stock stays held for a cart item after it was added or updated, released by `manage.py sweep_reservations`
+CART_HOLD_SECONDS = 15 * 60
+
+# Seconds a worker's coupon index is used before it is reloaded, even without a coupon version bump
+COUPON_INDEX_TTL = 60
+
+# Rows validated and upserted per transaction by the product import
+PRODUCT_IMPORT_CHUNK_SIZE = 1000
+
+# Rows fetched per query while streaming an export
+EXPORT_CHUNK_SIZE = 2000
+
+# Product search: indexed terms a query prefix may expand to, query words looked at and products ranked per query
+SEARCH_MAX_PREFIX_TERMS = 50
+SEARCH_MAX_QUERY_TERMS = 8
+SEARCH_MAX_CANDIDATES = 2000
+
 AUTH_USER_MODEL = 'customer.CustomUser'
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+# Shared by every worker process: token revocations, the catalog and coupon versions and
+# replica stickiness only reach the other workers through it, so it can't be per process (locmem)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'KEY_PREFIX': 'ecommerce',
+    }
+}
+
+# Tests swap in a locmem cache, clearing the shared one would flush it for every worker
+TEST_RUNNER = 'customer.runner.TestRunner'
+
+# Serialized product payloads, invalidated by bumping the catalog version
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 300
+CATALOG_CACHE_LOCK_TIMEOUT = 10
+
+# Verified knox tokens kept per process by customer.authentication.CachedTokenAuthentication
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_CACHE_TTL = 300
+
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# The MySQL backend with a connection pool, see customer/backends/pool.py. With
+# CONN_MAX_AGE = 0 every request hands its connection back to the pool when done.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'customer.backends.mysql',
         'NAME': 'ecommerce',
         'USER': 'root',
         'PASSWORD': '(Hareesh-76)',
         'HOST': 'localhost',  
         'PORT': '3306',      
+        'POOL': {
+            'MIN_SIZE': 2,
+            'MAX_SIZE': 20,
+            'MAX_LIFETIME': 1800,
+            'MAX_IDLE': 300,
+            'TIMEOUT': 10,
+        },
     }
 }
 
 
+# Aliases in DATABASES replicating default; reads of GET requests are spread over them
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['customer.routers.ReplicaRouter']
+
+# Seconds a user's reads stay on the primary after they wrote, longer than the replication lag
+REPLICA_STICKY_SECONDS = 5
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -148,6 +225,25 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files
+MEDIA_ROOT = BASE_DIR / 'media'
+MEDIA_URL = 'media/'
+
+# Product image renditions, rendered by customer.renditions into content addressed files
+RENDITION_ROOT = MEDIA_ROOT / 'renditions'
+RENDITION_URL = '/media/renditions/'
+RENDITION_WIDTHS = (160, 480, 1024)
+RENDITION_FORMATS = ('webp', 'jpeg')
+RENDITION_QUALITY = 80
+# Worker processes (0 renders inline) and images queued for them at most, the rest wait for `manage.py generate_renditions`
+RENDITION_WORKERS = 2
+RENDITION_QUEUE_SIZE = 64
+
+# Chunked image uploads: part files are kept here until complete, sizes in bytes
+IMAGE_UPLOAD_ROOT = MEDIA_ROOT / 'uploads'
+IMAGE_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+IMAGE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
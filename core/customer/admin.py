@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Product, CartItem, Discounts
+from .models import CustomUser, Product, CartItem, Discounts, DiscountShard
 
 class CustomUserCreationForm(UserCreationForm):
     class Meta:
@@ -41,3 +41,4 @@ admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(Product)
 admin.site.register(CartItem)
 admin.site.register(Discounts)
+admin.site.register(DiscountShard)
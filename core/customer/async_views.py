@@ -0,0 +1,102 @@
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework import exceptions
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from .models import Product, CartItem, Discounts
+from .serializers import ProductSerializer, CartItemSerializer
+from .authentication import CachedTokenAuthentication
+from .pagination import KeysetPagination
+from .fastpath import product_rows, cart_item_rows, discount_rows
+from .views import ProductListView
+
+# Async variants of the read endpoints for ASGI deployments. They are plain
+# Django async views (DRF views are sync only) answering the same payloads as
+# their generic view counterparts, so a slow query parks a coroutine instead
+# of a worker thread.
+
+
+def _json(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type="application/json")
+
+
+def token_required(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        authenticator = CachedTokenAuthentication()
+        try:
+            result = await authenticator.aauthenticate(request)
+            if result is None:
+                raise exceptions.NotAuthenticated()
+            request.user, request.auth = result
+            return await view(request, *args, **kwargs)
+        except exceptions.APIException as e:
+            response = _json({"detail": e.detail}, status=e.status_code)
+            if e.status_code == 401:
+                response.headers["WWW-Authenticate"] = authenticator.authenticate_header(request)
+            return response
+    return wrapper
+
+
+async def _page(queryset, request, encoder, view=None):
+    request = Request(request)
+    # Filtered and sorted by the backends of the generic `view` it stands in for
+    for backend in getattr(view, 'filter_backends', ()):
+        queryset = backend().filter_queryset(request, queryset, view)
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(encoder.values(queryset), request, view)
+    # Encoders may query (product images), keep them off the event loop
+    data = await sync_to_async(encoder.encode)(page)
+    return paginator.get_paginated_response(data).data
+
+
+def _not_found():
+    return _json({"detail": "No such item."}, status=404)
+
+
+@require_GET
+@token_required
+async def product_list(request):
+    return _json(await _page(Product.objects.all(), request, product_rows, ProductListView))
+
+
+@require_GET
+@token_required
+async def product_retrieve(request, pk):
+    product = await Product.objects.filter(pk=pk).afirst()
+    if product is None:
+        return _not_found()
+    return _json(await sync_to_async(lambda: ProductSerializer(product).data)())
+
+
+@require_GET
+@token_required
+async def cart_list(request):
+    return _json(await _page(CartItem.objects.filter(user=request.user), request, cart_item_rows))
+
+
+@require_GET
+@token_required
+async def cart_retrieve(request, pk):
+    item = await CartItem.objects.filter(user=request.user, pk=pk).select_related("product").afirst()
+    if item is None:
+        return _not_found()
+    return _json(CartItemSerializer(item).data)
+
+
+@require_GET
+@token_required
+async def discount_list(request):
+    paginator = KeysetPagination()
+    page = await paginator.apaginate_queryset(discount_rows.values(Discounts.objects.all()), Request(request))
+    # The used count of sharded coupons is summed with a query, keep it off the event loop
+    data = await sync_to_async(discount_rows.encode)(page)
+    return _json(paginator.get_paginated_response(data).data)
+
+
+@require_GET
+@token_required
+async def discount_product(request, pk):
+    return _json([row async for row in Discounts.objects.filter(product=pk).values()])
@@ -0,0 +1,173 @@
+import binascii
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from asgiref.sync import sync_to_async
+from rest_framework import exceptions
+from rest_framework.authentication import get_authorization_header
+from knox.auth import TokenAuthentication
+from knox.crypto import hash_token
+from knox.settings import knox_settings
+from .metrics import timed
+from .routers import identify
+
+
+class TokenCache:
+    """
+    Bounded LRU map of verified token digests with a per-entry TTL.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[-1] < time.monotonic():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return entry[:-1]
+
+    def set(self, digest, auth_token, generation):
+        with self._lock:
+            self._entries[digest] = (auth_token, generation, time.monotonic() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, digest):
+        with self._lock:
+            self._entries.pop(digest, None)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for digest in [d for d, entry in self._entries.items() if entry[0].user_id == user_id]:
+                del self._entries[digest]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 300),
+)
+
+
+def _generation_key(user_id):
+    return f"auth:user:{user_id}:generation"
+
+
+def _revoked_key(token_key):
+    return f"auth:token:{token_key}:revoked"
+
+
+def revoke_token(auth_token):
+    """
+    Forget a deleted token. The marker lives in the default cache, which
+    every worker process shares (see CACHES), so the copies they hold are
+    rejected on their next use.
+    """
+    token_cache.discard(auth_token.digest)
+    cache.set(_revoked_key(auth_token.token_key), True, token_cache.ttl)
+
+
+def invalidate_user_tokens(user_id):
+    # Bumping the user's generation makes every process drop that user's entries
+    token_cache.discard_user(user_id)
+    key = _generation_key(user_id)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in for knox's TokenAuthentication that remembers verified tokens.
+
+    A cache hit costs a SHA-512 of the presented token and one shared cache
+    read instead of the token query and digest comparison. Logout, logoutall
+    and any change to the user invalidate the entries of every worker right
+    away, through the markers they leave in the shared cache.
+    """
+
+    def authenticate(self, request):
+        with timed("auth"):
+            result = super().authenticate(request)
+        if result is not None:
+            identify(result[0].pk)
+        return result
+
+    def authenticate_credentials(self, token):
+        digest = self._digest(token)
+        cached = token_cache.get(digest)
+        if cached is not None:
+            if self._still_valid(cached, cache.get_many(self._shared_keys(cached[0]))):
+                auth_token = cached[0]
+                if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                    self.renew_token(auth_token)
+                return self.validate_user(auth_token)
+            token_cache.discard(digest)
+        return self._verify(digest, token)
+
+    async def aauthenticate(self, request):
+        """
+        authenticate() for plain async views. Cache hits stay on the event
+        loop, only misses run knox's token lookup in a worker thread.
+        """
+        with timed("auth"):
+            result = await self._aauthenticate(request)
+        if result is not None:
+            identify(result[0].pk)
+        return result
+
+    async def _aauthenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.authenticate_header(request).encode().lower():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+
+        digest = self._digest(auth[1])
+        cached = token_cache.get(digest)
+        if cached is not None:
+            if self._still_valid(cached, await cache.aget_many(self._shared_keys(cached[0]))):
+                auth_token = cached[0]
+                if knox_settings.AUTO_REFRESH and auth_token.expiry:
+                    await sync_to_async(self.renew_token)(auth_token)
+                return self.validate_user(auth_token)
+            token_cache.discard(digest)
+        return await sync_to_async(self._verify)(digest, auth[1])
+
+    def _digest(self, token):
+        try:
+            return hash_token(token.decode("utf-8"))
+        except (TypeError, binascii.Error, UnicodeDecodeError):
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+    def _shared_keys(self, auth_token):
+        return [_revoked_key(auth_token.token_key), _generation_key(auth_token.user_id)]
+
+    def _still_valid(self, cached, shared):
+        auth_token, generation = cached
+        revoked_key, generation_key = self._shared_keys(auth_token)
+        fresh = auth_token.expiry is None or auth_token.expiry > timezone.now()
+        return fresh and not shared.get(revoked_key) and shared.get(generation_key, 0) == generation
+
+    def _verify(self, digest, token):
+        user, auth_token = super().authenticate_credentials(token)
+        token_cache.set(digest, auth_token, cache.get(_generation_key(user.pk), 0))
+        return user, auth_token
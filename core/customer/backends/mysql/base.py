@@ -0,0 +1,10 @@
+from django.db.backends.mysql.base import DatabaseWrapper as MySQLDatabaseWrapper
+from ..pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, MySQLDatabaseWrapper):
+
+    @staticmethod
+    def check_connection(connection):
+        # Without reconnecting, a dead connection is dropped rather than revived with a blank session
+        connection.ping(False)
@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import deque
+from django.db.utils import OperationalError
+from ..metrics import registry
+
+# Keys of a database's POOL setting and their defaults
+DEFAULTS = {
+    "MIN_SIZE": 0,
+    "MAX_SIZE": 10,
+    # Seconds a connection is used for at most, None for no limit
+    "MAX_LIFETIME": 1800,
+    # Seconds a connection above MIN_SIZE may sit idle before it is closed
+    "MAX_IDLE": 300,
+    # Seconds a checkout waits for a free connection
+    "TIMEOUT": 10,
+}
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB-API connections, shared by the connection
+    wrappers of every thread of the process.
+
+    Connections are opened through the `connect` callable given to
+    acquire(), at most `max_size` at once; past that acquire() waits up to
+    `timeout` seconds for one to be released. Idle connections are checked
+    with `check` before they are handed out and are closed once older than
+    `max_lifetime`, or idle for `max_idle` while more than `min_size` are open.
+    """
+
+    def __init__(self, min_size=0, max_size=10, max_lifetime=None, max_idle=None, timeout=10, check=None):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("The pool needs 0 <= MIN_SIZE <= MAX_SIZE and MAX_SIZE >= 1")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.check = check
+        self._condition = threading.Condition()
+        # (connection, opened at, idle since), the most recently released last
+        self._idle = deque()
+        self._opened_at = {}
+        self.stats = dict.fromkeys(
+            ("checkouts", "waits", "timeouts", "opened", "closed", "failed_checks"), 0
+        )
+        self.stats.update(wait_seconds=0.0, max_wait_seconds=0.0)
+
+    @property
+    def size(self):
+        return len(self._opened_at)
+
+    def acquire(self, connect):
+        deadline = time.monotonic() + self.timeout
+        started = time.monotonic()
+        waited = False
+        while True:
+            expired = []
+            connection = None
+            with self._condition:
+                while connection is None:
+                    while self._idle:
+                        candidate, opened_at, _ = self._idle.pop()
+                        if self._expired(opened_at):
+                            expired.append(self._forget(candidate))
+                        else:
+                            connection = candidate
+                            break
+                    if connection is not None:
+                        break
+                    if self.size < self.max_size:
+                        # Reserve the slot, the connection is opened outside the lock
+                        connection = _Opening()
+                        self._opened_at[id(connection)] = time.monotonic()
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        break
+                    waited = True
+                    self._condition.wait(remaining)
+                if waited:
+                    waited_for = time.monotonic() - started
+                    self.stats["waits"] += 1
+                    self.stats["wait_seconds"] += waited_for
+                    self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited_for)
+                    waited = False
+            self._close_all(expired)
+            if connection is None:
+                raise PoolTimeout(f"No database connection was released within {self.timeout}s")
+
+            if isinstance(connection, _Opening):
+                connection = self._open(connection, connect)
+                with self._condition:
+                    self.stats["checkouts"] += 1
+                return connection
+            if self._healthy(connection):
+                with self._condition:
+                    self.stats["checkouts"] += 1
+                return connection
+            with self._condition:
+                self.stats["failed_checks"] += 1
+                self._forget(connection)
+                self._condition.notify()
+            self._close_all([connection])
+
+    def release(self, connection, reusable=True):
+        """
+        Give a connection back. Ones that are not `reusable` (say, closed in
+        the middle of a transaction) or past their lifetime are closed.
+        """
+        closing = []
+        with self._condition:
+            opened_at = self._opened_at.get(id(connection))
+            if opened_at is None:
+                closing.append(connection)
+            elif not reusable or self._expired(opened_at):
+                closing.append(self._forget(connection))
+            else:
+                now = time.monotonic()
+                self._idle.append((connection, opened_at, now))
+                # Trim from the least recently used end
+                while self.max_idle is not None and self.size > self.min_size and self._idle and now - self._idle[0][2] > self.max_idle:
+                    closing.append(self._forget(self._idle.popleft()[0]))
+            self._condition.notify()
+        self._close_all(closing)
+
+    def fill(self, connect):
+        # Open connections up to min_size
+        while True:
+            with self._condition:
+                if self.size >= self.min_size:
+                    return
+                slot = _Opening()
+                self._opened_at[id(slot)] = time.monotonic()
+            self.release(self._open(slot, connect))
+
+    def close(self):
+        with self._condition:
+            closing = [self._forget(connection) for connection, _, _ in self._idle]
+            self._idle.clear()
+        self._close_all(closing)
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.stats, size=self.size, idle=len(self._idle), in_use=self.size - len(self._idle),
+                        min_size=self.min_size, max_size=self.max_size)
+
+    def _open(self, slot, connect):
+        try:
+            connection = connect()
+        except BaseException:
+            with self._condition:
+                del self._opened_at[id(slot)]
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._opened_at[id(connection)] = self._opened_at.pop(id(slot))
+            self.stats["opened"] += 1
+        return connection
+
+    def _expired(self, opened_at):
+        return self.max_lifetime is not None and time.monotonic() - opened_at > self.max_lifetime
+
+    def _healthy(self, connection):
+        if self.check is None:
+            return True
+        try:
+            self.check(connection)
+        except Exception:
+            return False
+        return True
+
+    def _forget(self, connection):
+        # Called with the lock held, the connection is closed after it is released
+        del self._opened_at[id(connection)]
+        self.stats["closed"] += 1
+        return connection
+
+    def _close_all(self, connections):
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class _Opening:
+    # Placeholder holding a pool slot while its connection is being opened
+    pass
+
+
+_lock = threading.Lock()
+pools = {}
+
+
+def get_pool(alias, database, options, check):
+    # Per database as well, the test runner points an alias at another one
+    with _lock:
+        pool = pools.get((alias, database))
+        if pool is None:
+            settings = dict(DEFAULTS, **options)
+            pool = pools[alias, database] = ConnectionPool(
+                min_size=settings["MIN_SIZE"], max_size=settings["MAX_SIZE"], max_lifetime=settings["MAX_LIFETIME"],
+                max_idle=settings["MAX_IDLE"], timeout=settings["TIMEOUT"], check=check,
+            )
+        return pool
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Makes a database backend hand out pooled connections. Closing one, as
+    Django does at the end of every request with CONN_MAX_AGE = 0, returns
+    it to the pool it came from. Subclasses implement `check_connection`.
+    """
+    pool = None
+
+    @staticmethod
+    def check_connection(connection):
+        # Raises when the driver connection is no longer usable
+        raise NotImplementedError
+
+    def get_new_connection(self, conn_params):
+        def connect():
+            return super(PooledDatabaseWrapperMixin, self).get_new_connection(conn_params)
+        self.pool = get_pool(self.alias, str(self.settings_dict["NAME"]), self.settings_dict.get("POOL", {}), self.check_connection)
+        self.pool.fill(connect)
+        return self.pool.acquire(connect)
+
+    def _close(self):
+        if self.connection is not None:
+            # A connection left inside a transaction goes back to the driver, not to the next request
+            self.pool.release(self.connection, reusable=self.autocommit and not self.in_atomic_block)
+
+
+def pool_metrics():
+    with _lock:
+        current = sorted(pools.items())
+    if not current:
+        return []
+    snapshots = {key: pool.snapshot() for key, pool in current}
+    lines = []
+    for name, kind, help_text, value in (
+        ("db_pool_connections", "gauge", "Open pooled connections", lambda s: s["size"]),
+        ("db_pool_idle_connections", "gauge", "Pooled connections waiting for a checkout", lambda s: s["idle"]),
+        ("db_pool_max_connections", "gauge", "Most connections the pool opens", lambda s: s["max_size"]),
+        ("db_pool_checkouts_total", "counter", "Connections handed out", lambda s: s["checkouts"]),
+        ("db_pool_waits_total", "counter", "Checkouts that waited for a connection", lambda s: s["waits"]),
+        ("db_pool_wait_seconds_total", "counter", "Time checkouts spent waiting", lambda s: s["wait_seconds"]),
+        ("db_pool_max_wait_seconds", "gauge", "Longest wait for a connection", lambda s: s["max_wait_seconds"]),
+        ("db_pool_timeouts_total", "counter", "Checkouts that gave up waiting", lambda s: s["timeouts"]),
+        ("db_pool_opened_total", "counter", "Connections opened", lambda s: s["opened"]),
+        ("db_pool_closed_total", "counter", "Connections closed for age, idleness or failure", lambda s: s["closed"]),
+        ("db_pool_failed_checks_total", "counter", "Idle connections that failed the checkout health check", lambda s: s["failed_checks"]),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{alias="{alias}",database="{database}"}} {value(snapshot)}' for (alias, database), snapshot in snapshots.items()]
+    return lines
+
+
+registry.register_collector(pool_metrics)
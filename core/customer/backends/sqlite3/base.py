@@ -0,0 +1,20 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from ..pool import PooledDatabaseWrapperMixin
+
+
+# The pooled backend on SQLite, for running the pool without a MySQL server
+class DatabaseWrapper(PooledDatabaseWrapperMixin, SQLiteDatabaseWrapper):
+
+    @staticmethod
+    def check_connection(connection):
+        connection.execute("SELECT 1")
+
+    def get_new_connection(self, conn_params):
+        # Django never closes in-memory connections, so they would hold their pool slot for good
+        if self.is_in_memory_db():
+            raise ImproperlyConfigured(
+                f"The pooled SQLite backend needs a database file, set DATABASES['{self.alias}']['NAME'] "
+                f"(and ['TEST']['NAME'] for the test database) to a path instead of an in-memory database."
+            )
+        return super().get_new_connection(conn_params)
@@ -0,0 +1,111 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from .routers import primary_reads
+
+VERSION_KEY = "catalog:version"
+STOCK_VERSION_KEY = "catalog:stock-version"
+HITS_KEY = "catalog:hits"
+MISSES_KEY = "catalog:misses"
+
+_missing = object()
+
+
+def _cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def _incr(key, delta=1):
+    cache = _cache()
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Counter evicted or never set
+        if cache.add(key, delta, None):
+            return delta
+        return cache.incr(key, delta)
+
+
+def _version(key):
+    version = _cache().get(key)
+    if version is None:
+        # Start from the clock so an evicted version never reuses old entries
+        _cache().add(key, int(time.time() * 1000), None)
+        version = _cache().get(key)
+    return version
+
+
+def catalog_version():
+    return _version(VERSION_KEY)
+
+
+def bump_catalog_version():
+    # Every cached payload is keyed on the version, bumping it orphans them all at once
+    catalog_version()
+    return _incr(VERSION_KEY)
+
+
+def stock_version():
+    return _version(STOCK_VERSION_KEY)
+
+
+def bump_stock_version():
+    # Orphans only the payloads that picked their rows by stock or updated_at
+    stock_version()
+    return _incr(STOCK_VERSION_KEY)
+
+
+def cached_catalog_payload(parts, compute, stock=False):
+    """
+    Read-through lookup of a serialized catalog payload.
+
+    `parts` identify the payload within the current catalog version and
+    `compute` builds it on a miss. Stock and updated_at are not kept fresh,
+    checkout moves them without a catalog bump: callers overlay them with
+    fastpath.live_stock, and payloads whose rows were picked by them pass
+    `stock` to be keyed on the stock version too. Only one caller recomputes a missing
+    payload at a time, the others wait for it to show up in the cache.
+    Payloads are cached as read from the primary: a lagging replica would
+    file rows from before a change under the version that change bumped.
+    """
+    cache = _cache()
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    version = f"{catalog_version()}.{stock_version()}" if stock else catalog_version()
+    key = f"catalog:{version}:{digest}"
+    lock_key = key + ":lock"
+    timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+    lock_timeout = getattr(settings, 'CATALOG_CACHE_LOCK_TIMEOUT', 10)
+    deadline = time.monotonic() + lock_timeout
+
+    while True:
+        data = cache.get(key, _missing)
+        if data is not _missing:
+            _incr(HITS_KEY)
+            return data
+
+        if cache.add(lock_key, 1, lock_timeout):
+            _incr(MISSES_KEY)
+            try:
+                with primary_reads():
+                    data = compute()
+                cache.set(key, data, timeout)
+                return data
+            finally:
+                cache.delete(lock_key)
+
+        # Someone else is recomputing it, fall back to computing ourselves if they take too long
+        if time.monotonic() > deadline:
+            _incr(MISSES_KEY)
+            return compute()
+        time.sleep(0.01)
+
+
+def catalog_cache_stats():
+    cache = _cache()
+    return {
+        "version": catalog_version(),
+        "stock_version": stock_version(),
+        "hits": cache.get(HITS_KEY, 0),
+        "misses": cache.get(MISSES_KEY, 0),
+    }
@@ -0,0 +1,89 @@
+from collections import defaultdict
+from django.db import transaction
+from .models import CartItem, Product, StockReservation
+from .coupons import coupon_index, EXPIRED
+from .pricing import discounted_rate
+from .redemption import redeem_coupon
+from .summary import line, record
+from .reservations import available, take, give_back, hold_until
+
+
+def bulk_add_to_cart(user, entries):
+    """
+    Add several `{product, quantity, coupon}` entries to the cart of `user`.
+
+    Applies the same rules as CartItemSerializer for every entry, but reads
+    the products and the user's cart rows with one query each, checks
+    coupons against the coupon index and writes the new rows and their stock
+    holds with a single bulk_create each, moving the cart summary once for
+    all of them.
+    Returns one `(entry index, errors)` pair per entry, errors empty when it
+    was added.
+    """
+    products = Product.objects.in_bulk({entry['product'] for entry in entries})
+    in_cart = set(CartItem.objects.filter(user=user, product_id__in=products.keys()).values_list('product_id', flat=True))
+
+    errors = {}
+    # (entry index, coupon) of the entries passing the checks, at most one per product and so per coupon
+    accepted = []
+    for index, entry in enumerate(entries):
+        product = products.get(entry['product'])
+        if(product is None):
+            errors[index] = ["There's no such product in the store"]
+            continue
+        if(entry['quantity'] < 0):
+            errors[index] = ["Bad value"]
+            continue
+        if(product.id in in_cart):
+            errors[index] = ["Item already exists in the cart"]
+            continue
+        if(entry['quantity'] > available(product)):
+            errors[index] = [f"Currently there's only {available(product)} remaining in the stock"]
+            continue
+        coupon = coupon_index.lookup(product.id, entry['coupon'])
+        if(coupon is None):
+            errors[index] = ["Invalid Coupon Code!"]
+            continue
+        if(coupon is EXPIRED):
+            errors[index] = ["Coupon code expired or reached its limit!"]
+            continue
+        # The same product twice in one batch is a duplicate as well
+        in_cart.add(product.id)
+        accepted.append((index, coupon))
+
+    items = []
+    with transaction.atomic():
+        # Stock is held first, in product order, so an entry short of it never uses up a coupon
+        for index, _ in sorted(accepted, key=lambda entry: entries[entry[0]]['product']):
+            if(not take(entries[index]['product'], entries[index]['quantity'])):
+                errors[index] = [f"Currently there's only {available(products[entries[index]['product']])} remaining in the stock"]
+
+        unheld = defaultdict(int)
+        for index, coupon in accepted:
+            if(index in errors):
+                continue
+            product = products[entries[index]['product']]
+            if(not redeem_coupon(coupon)):
+                errors[index] = ["Coupon code expired or reached its limit!"]
+                unheld[product.id] += entries[index]['quantity']
+                continue
+            rate = discounted_rate(product.price, coupon.discount)
+            items.append(CartItem(
+                user=user, product=product, quantity=entries[index]['quantity'], coupon=coupon.code,
+                price=product.price, rate=rate, total=rate * entries[index]['quantity'],
+            ))
+        give_back(unheld)
+        CartItem.objects.bulk_create(items)
+        if(items):
+            if(items[0].pk is None):
+                # MySQL doesn't return the new ids, the user has one row per product
+                ids = dict(CartItem.objects.filter(user=user, product_id__in=[item.product_id for item in items]).values_list('product_id', 'id'))
+                for item in items:
+                    item.pk = ids[item.product_id]
+            expires_at = hold_until()
+            StockReservation.objects.bulk_create(
+                StockReservation(cart_item=item, product_id=item.product_id, quantity=item.quantity, expires_at=expires_at) for item in items
+            )
+            record(user.pk, added=[line(item) for item in items])
+
+    return [(index, errors.get(index, [])) for index in range(len(entries))]
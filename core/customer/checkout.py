@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import CartItem, Discounts, Product, StockReservation
+from .pricing import discounted_rate
+from .cache import bump_stock_version
+from .summary import line, record
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCart(CheckoutError):
+    pass
+
+
+class OutOfStock(CheckoutError):
+    def __init__(self, product_id, requested):
+        self.product_id = product_id
+        self.requested = requested
+        super().__init__(f"Not enough stock left for product {product_id} (requested {requested})")
+
+
+def checkout(user, items=None):
+    """
+    Buy the given cart items of `user` (the whole cart by default) in one
+    transaction.
+
+    Stock is taken with a conditional `UPDATE ... SET stock = stock - n WHERE
+    stock >= reserved + n`, so concurrent buyers can never oversell, and the products are
+    touched in id order so two carts never lock the same rows in opposite
+    order. Units held for other carts are left alone, while the ones held
+    for these items are used up; an item whose hold was swept buys from the
+    stock nobody holds. When any product falls short nothing is bought.
+
+    The total is charged at the current prices and discounts rather than the
+    rows' stored totals, which a queued outbox reprice may not have caught
+    up with yet.
+    """
+    if items is None:
+        items = CartItem.objects.filter(user=user)
+    now = timezone.now()
+
+    with transaction.atomic():
+        bought = list(items.filter(user=user).select_for_update().order_by('product_id'))
+        if not bought:
+            raise EmptyCart("Your cart is empty")
+
+        # Locked so a sweep can't hand the same units back, the rows go with their cart items
+        held = dict(StockReservation.objects.select_for_update().filter(cart_item__in=bought).values_list('cart_item_id', 'quantity'))
+
+        for item in bought:
+            own = held.get(item.pk, 0)
+            taken = Product.objects.filter(pk=item.product_id, stock__gte=F('reserved') - own + item.quantity).update(
+                stock=F('stock') - item.quantity, reserved=F('reserved') - own, updated_at=now
+            )
+            if not taken:
+                raise OutOfStock(item.product_id, item.quantity)
+
+        # Read after the stock UPDATEs locked the products, so a concurrent price edit is either seen or waits
+        prices = dict(Product.objects.filter(pk__in={item.product_id for item in bought}).values_list('pk', 'price'))
+        discounts = {
+            (product_id, code): discount for product_id, code, discount in Discounts.objects.filter(
+                product_id__in=prices.keys(), coupon_code__in={item.coupon for item in bought if item.coupon}
+            ).values_list('product_id', 'coupon_code', 'discount')
+        }
+        # Coupons were redeemed when the rows were added to the cart
+        total = sum(discounted_rate(prices[item.product_id], discounts.get((item.product_id, item.coupon))) * item.quantity for item in bought)
+
+        CartItem.objects.filter(pk__in=[item.pk for item in bought]).delete()
+        record(user.pk, removed=[line(item) for item in bought])
+
+        # Cached product payloads read stock live, only pages filtered by it go stale
+        transaction.on_commit(bump_stock_version)
+
+    return {"items": len(bought), "total": total}
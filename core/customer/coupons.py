@@ -0,0 +1,89 @@
+import heapq
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .models import Discounts
+
+VERSION_KEY = "coupons:version"
+
+Coupon = namedtuple("Coupon", ["id", "product_id", "code", "discount", "allowed_users", "used", "expiry", "shards"])
+
+# Returned by CouponIndex.lookup for a coupon that exists but ran past its expiry
+EXPIRED = object()
+
+
+def coupon_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_coupon_version():
+    coupon_version()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        return coupon_version()
+
+
+class CouponIndex:
+    """
+    Process-local index of the discounts keyed by (product_id, coupon_code).
+
+    Coupons drop out of the index when they expire, driven by a heap ordered
+    on expiry so each lookup only looks at the coupons that just lapsed. The
+    whole index is reloaded when the shared coupon version moves, which the
+    discount create/update/delete paths bump, and at least every
+    COUPON_INDEX_TTL seconds for changes that never bumped it (admin, shell,
+    a cache outage).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._fresh_until = 0
+        self._entries = {}
+        self._expired = set()
+        self._heap = []
+
+    def lookup(self, product_id, code):
+        version = coupon_version()
+        with self._lock:
+            if version != self._version or time.monotonic() >= self._fresh_until:
+                self._load(version)
+            self._expire(timezone.now())
+            key = (product_id, code)
+            if key in self._expired:
+                return EXPIRED
+            return self._entries.get(key)
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def _load(self, version):
+        self._entries = {}
+        self._expired = set()
+        self._heap = []
+        for row in Discounts.objects.values_list("id", "product_id", "coupon_code", "discount", "allowed_users", "used", "expiry", "shards"):
+            coupon = Coupon(*row)
+            key = (coupon.product_id, coupon.code)
+            self._entries[key] = coupon
+            self._heap.append((coupon.expiry, coupon.id, key))
+        heapq.heapify(self._heap)
+        self._version = version
+        self._fresh_until = time.monotonic() + settings.COUPON_INDEX_TTL
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            if self._entries.pop(key, None) is not None:
+                self._expired.add(key)
+
+
+coupon_index = CouponIndex()
@@ -0,0 +1,72 @@
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from .models import Product, CartItem, Discounts
+from .fastpath import with_shard_redemptions
+
+EXPORTS = {
+    "products": (Product, ("id", "name", "description", "actual_price", "price", "stock", "created_at", "updated_at")),
+    "carts": (CartItem, ("id", "user_id", "product_id", "quantity", "coupon", "price", "rate", "total", "created_at", "updated_at")),
+    "discounts": (Discounts, ("id", "product_id", "discount", "provider", "coupon_code", "allowed_users", "used", "shards", "created_at", "updated_at", "expiry")),
+}
+
+# Rows of a batch completed before they are written out
+BATCH_HOOKS = {
+    "discounts": with_shard_redemptions,
+}
+
+FORMATS = ("ndjson", "csv")
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_rows(name, since=None, chunk_size=2000):
+    """
+    Yield the rows of an export as dicts, walking the table in id order.
+
+    Every batch is a fresh `id > last id` query of `chunk_size` rows, so only
+    one batch is held at a time even on drivers that buffer whole result sets.
+    `since` keeps the rows created or updated at or after that watermark,
+    and sharded coupons, whose redemptions leave their row alone.
+    """
+    model, fields = EXPORTS[name]
+    queryset = model.objects.all()
+    if since is not None:
+        changed = Q(updated_at__gte=since) | Q(updated_at__isnull=True, created_at__gte=since)
+        if model is Discounts:
+            changed |= Q(shards__gt=0)
+        queryset = queryset.filter(changed)
+    complete = BATCH_HOOKS.get(name, list)
+
+    last = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last).order_by("id").values(*fields)[:chunk_size])
+        yield from complete(batch)
+        if len(batch) < chunk_size:
+            return
+        last = batch[-1]["id"]
+
+
+class _Echo:
+    # File-like sink for csv.writer that hands the formatted line back
+    def write(self, value):
+        return value
+
+
+def encode_rows(name, rows, file_format):
+    """
+    Turn rows into NDJSON lines or CSV lines (header first).
+    """
+    if file_format == "ndjson":
+        for row in rows:
+            yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+        return
+    _, fields = EXPORTS[name]
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
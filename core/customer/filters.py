@@ -0,0 +1,80 @@
+from decimal import Decimal, InvalidOperation
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+# `sort` values and the keyset each one pages on, all backed by an index on Product
+SORTS = {
+    "created": ("created_at", "id"),
+    "-created": ("-created_at", "-id"),
+    "price": ("price", "id"),
+    "-price": ("-price", "-id"),
+}
+
+WINDOWS = {
+    "created_after": "created_at__gte",
+    "created_before": "created_at__lt",
+    "updated_after": "updated_at__gte",
+    "updated_before": "updated_at__lt",
+}
+
+# Parameters picking products by what a checkout changes, such pages are cached per stock version
+STOCK_FILTERS = ("in_stock", "updated_after", "updated_before")
+
+BOOLEANS = {"true": True, "1": True, "yes": True, "false": False, "0": False, "no": False}
+
+
+class ProductFilter(BaseFilterBackend):
+    """
+    Query parameters of the product list: `min_price`, `max_price`,
+    `in_stock`, `created_after`/`created_before`, `updated_after`/`updated_before`
+    (ISO 8601, lower bound inclusive) and `sort` (one of SORTS).
+
+    The sort column leads the keyset, so KeysetPagination walks its index in
+    order and the other filters are checked along the way. `in_stock` pages
+    search the (in_stock, sort column, id) indexes instead.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        filters = {}
+        for param, lookup in (("min_price", "price__gte"), ("max_price", "price__lte")):
+            if(params.get(param)):
+                filters[lookup] = self._decimal(param, params[param])
+        for param, lookup in WINDOWS.items():
+            if(params.get(param)):
+                filters[lookup] = self._datetime(param, params[param])
+        if(params.get("in_stock")):
+            if(params["in_stock"].lower() not in BOOLEANS):
+                raise ValidationError({"in_stock": "Use true or false"})
+            if(BOOLEANS[params["in_stock"].lower()]):
+                # `in_stock = true` is written as a bare column, which no index is searched for, IN is an equality
+                filters["in_stock__in"] = [True]
+        return queryset.filter(**filters)
+
+    def get_ordering(self, request, queryset, view):
+        sort = request.query_params.get("sort") or "created"
+        if(sort not in SORTS):
+            raise ValidationError({"sort": f"Use one of {', '.join(SORTS)}"})
+        return SORTS[sort]
+
+    def _decimal(self, param, value):
+        try:
+            number = Decimal(value)
+        except(InvalidOperation):
+            number = None
+        if(number is None or not number.is_finite()):
+            raise ValidationError({param: "Must be a number"})
+        return number
+
+    def _datetime(self, param, value):
+        try:
+            parsed = parse_datetime(value)
+        except(ValueError):
+            parsed = None
+        if(parsed is None):
+            raise ValidationError({param: "Must be an ISO 8601 datetime"})
+        if(timezone.is_naive(parsed)):
+            parsed = timezone.make_aware(parsed)
+        return parsed
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import tempfile
+from PIL import Image, ImageOps
+
+# Pillow only, no Django: render() runs in the rendition worker processes
+
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+# Pixel modes each encoder takes as they are, others are converted
+MODES = {"webp": ("RGB", "RGBA"), "jpeg": ("RGB", "L")}
+
+
+def file_sha256(file, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def rendition_name(sha256, width, file_format):
+    # Content addressed, the same picture always maps to the same files
+    return f"{sha256[:2]}/{sha256}/{width}.{EXTENSIONS[file_format]}"
+
+
+def render(source, sha256, root, widths, formats, quality):
+    """
+    Write every `width` x `format` rendition of the image at `source` under
+    `root` and return `{width: {format: name}}`.
+
+    A width bounds both sides, the aspect ratio is kept and images are
+    never enlarged. Renditions already on disk are not rendered again, and
+    new ones are written to a temporary file and renamed into place, so a
+    half-written file is never visible.
+    """
+    names = {str(width): {file_format: rendition_name(sha256, width, file_format) for file_format in formats} for width in widths}
+    missing = [(width, file_format) for width in widths for file_format in formats
+               if not os.path.exists(os.path.join(root, names[str(width)][file_format]))]
+    if not missing:
+        return names
+
+    with Image.open(source) as original:
+        original = ImageOps.exif_transpose(original)
+        for width in sorted({width for width, _ in missing}):
+            variant = original.copy()
+            variant.thumbnail((width, width), Image.LANCZOS)
+            for file_format in formats:
+                if (width, file_format) not in missing:
+                    continue
+                path = os.path.join(root, names[str(width)][file_format])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                frame = variant
+                if variant.mode not in MODES[file_format]:
+                    alpha = "A" in variant.getbands() or "transparency" in variant.info
+                    frame = variant.convert("RGBA" if alpha and "RGBA" in MODES[file_format] else "RGB")
+                fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as out:
+                        frame.save(out, format=file_format.upper(), quality=quality)
+                    os.replace(temporary, path)
+                except BaseException:
+                    os.unlink(temporary)
+                    raise
+    return names
@@ -0,0 +1,103 @@
+import csv
+import json
+import time
+from itertools import islice
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from .models import Product
+from .serializers import ProductSerializer
+from .outbox import enqueue_many
+from .cache import bump_catalog_version
+from .search import index_products
+
+FORMATS = ("csv", "ndjson")
+
+# Only this many row errors are kept in the report, the rest are just counted
+MAX_REPORTED_ERRORS = 100
+
+
+def guess_format(filename):
+    if filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+
+def read_rows(stream, file_format):
+    """
+    Lazily yield `(line number, row dict)` from a text stream, one row at a time.
+    """
+    if file_format == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield number, row
+
+
+def import_products(rows, chunk_size=1000, progress=None):
+    """
+    Upsert products from `(line number, row)` pairs, keyed on the product name.
+
+    Rows are validated with ProductSerializer and written chunk by chunk with
+    bulk_create(update_conflicts=True), so memory stays bounded by the chunk
+    size whatever the input length. Cart items of products whose price moved
+    are queued for repricing in the outbox and the chunk is written to the
+    search index. `progress` is
+    called with the running report after every chunk.
+    """
+    report = {"rows": 0, "imported": 0, "failed": 0, "errors": [], "elapsed": 0.0, "rows_per_sec": 0.0}
+    started = time.perf_counter()
+    conflict_target = {"unique_fields": ["name"]} if connection.features.supports_update_conflicts_with_target else {}
+
+    # One serializer validates every row, as ListSerializer does with its child
+    validator = ProductSerializer()
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        now = timezone.now()
+        products = {}
+        for number, row in chunk:
+            try:
+                if not isinstance(row, dict):
+                    raise ValidationError(["Not a JSON object"])
+                data = validator.run_validation(row)
+            except ValidationError as e:
+                report["failed"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append({"line": number, "errors": e.detail})
+                continue
+            # A name repeated within the chunk keeps its last row
+            products[data["name"]] = Product(**data, updated_at=now)
+
+        with transaction.atomic():
+            previous = dict(Product.objects.filter(name__in=products.keys()).values_list("name", "price"))
+            Product.objects.bulk_create(
+                products.values(), update_conflicts=True, update_fields=["description", "price", "stock", "updated_at"], **conflict_target
+            )
+            repriced = [name for name, price in previous.items() if price != products[name].price]
+            enqueue_many("reprice_product", [{"product_id": pk} for pk in Product.objects.filter(name__in=repriced).values_list("id", flat=True)])
+            # bulk_create sends no post_save, index the chunk here
+            index_products(Product.objects.filter(name__in=products.keys()).only("id", "name", "description"))
+
+        report["rows"] += len(chunk)
+        report["imported"] += len(products)
+        report["elapsed"] = time.perf_counter() - started
+        report["rows_per_sec"] = report["rows"] / report["elapsed"] if report["elapsed"] else 0.0
+        if progress is not None:
+            progress(report)
+
+    if report["imported"]:
+        bump_catalog_version()
+    return report
@@ -0,0 +1,209 @@
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from knox.models import AuthToken
+from customer.models import CustomUser, Product, Discounts
+from customer.search import index_products
+
+# Figures compared with the baseline, and whether higher is worse. The p99 of
+# a short run is a handful of samples, it is reported but not compared.
+COMPARED = (("p50", True), ("p95", True), ("throughput", False))
+
+
+class Client:
+    """
+    Calls the WSGI application in-process, the way a server thread would.
+    """
+
+    def __init__(self, application, record):
+        self.application = application
+        self.record = record
+
+    def call(self, route, method, path, body=None, token=None):
+        path, _, query = path.partition('?')
+        data = json.dumps(body).encode() if body is not None else b''
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80', 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(data), 'wsgi.errors': BytesIO(),
+            'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(data)),
+        }
+        if token is not None:
+            environ['HTTP_AUTHORIZATION'] = f"Token {token}"
+        statuses = []
+        started = time.perf_counter()
+        response = self.application(environ, lambda status, headers: statuses.append(int(status.split()[0])))
+        content = b''.join(response)
+        response.close()
+        self.record(route, time.perf_counter() - started, statuses[0])
+        return json.loads(content) if content and statuses[0] < 400 else None
+
+
+def percentile(ordered, fraction):
+    # Nearest rank
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive every API workflow through the WSGI application from concurrent threads and report "
+        "throughput and p50/p95/p99 latency per route. Run with --settings=core.benchmark_settings; "
+        "the benchmark database is flushed first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help="Virtual users, each going through the whole workflow once")
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--products', type=int, default=1000, help="Catalog size, each product with a coupon")
+        parser.add_argument('--warmup', type=int, default=2, help="Users run before measuring")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save-baseline', metavar='PATH', help="Write the results as the baseline to compare later runs with")
+        parser.add_argument('--baseline', metavar='PATH', help="Fail when a route regressed against this baseline")
+        parser.add_argument('--threshold', type=float, default=0.25, help="Tolerated relative regression")
+        parser.add_argument('--min-delta-ms', type=float, default=1.0, help="Latency changes below this are never regressions")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BENCHMARK_DATABASE', False):
+            raise CommandError("Run with --settings=core.benchmark_settings, the benchmark flushes its database")
+
+        call_command('migrate', verbosity=0, interactive=False)
+        call_command('flush', verbosity=0, interactive=False)
+        self.products, self.coupons = self._seed(options['products'])
+        admin = CustomUser.objects.create_superuser(email="bench-admin@example.com", password=None, username="bench-admin")
+        _, self.admin_token = AuthToken.objects.create(admin)
+        connections.close_all()
+
+        self.application = WSGIHandler()
+        self.seed = options['seed']
+        for user in range(options['warmup']):
+            self._workflow(Client(self.application, lambda *args: None), f"warmup{user}")
+
+        lock = threading.Lock()
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+
+        def record(route, seconds, status_code):
+            with lock:
+                latencies[route].append(seconds * 1000)
+                if status_code >= 400:
+                    errors[route] += 1
+
+        def run(user):
+            try:
+                self._workflow(Client(self.application, record), f"user{user}")
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(options['threads']) as pool:
+            started = time.perf_counter()
+            list(pool.map(run, range(options['users'])))
+            elapsed = time.perf_counter() - started
+
+        results = {}
+        for route, values in sorted(latencies.items()):
+            values.sort()
+            results[route] = {
+                "requests": len(values), "errors": errors[route], "throughput": round(len(values) / elapsed, 2),
+                "p50": round(percentile(values, 0.5), 3), "p95": round(percentile(values, 0.95), 3), "p99": round(percentile(values, 0.99), 3),
+            }
+        self._report(results, elapsed)
+
+        run_settings = {name: options[name] for name in ('users', 'threads', 'products', 'warmup', 'seed')}
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as out:
+                json.dump({"settings": run_settings, "routes": results}, out, indent=2, sort_keys=True)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+        if options['baseline']:
+            self._compare(results, run_settings, options)
+
+    def _seed(self, count):
+        products = Product.objects.bulk_create(
+            Product(name=f"Bench product {n}", description=f"Benchmark item number {n}", price=10 + n % 90, stock=1_000_000)
+            for n in range(count)
+        )
+        index_products(products)
+        expiry = timezone.now() + timedelta(days=365)
+        Discounts.objects.bulk_create(
+            Discounts(product=product, discount=n % 50, provider="bench", coupon_code=f"BENCH{n}", allowed_users=1_000_000, expiry=expiry)
+            for n, product in enumerate(products)
+        )
+        return [product.pk for product in products], {product.pk: f"BENCH{n}" for n, product in enumerate(products)}
+
+    def _workflow(self, client, name):
+        """
+        One shopper signing up and buying, and the admin adding a product and
+        a discount for it, then removing both.
+        """
+        rng = random.Random(f"{self.seed}-{name}")
+        email = f"{name}@bench.example.com"
+        client.call("register", "POST", "/api/register/", {"username": name, "email": email, "password": "bench-pass-1"})
+        token = client.call("knox_login", "POST", "/api/login/", {"username": email, "password": "bench-pass-1"})["token"]
+
+        client.call("product_list", "GET", "/api/products/", token=token)
+        product = rng.choice(self.products)
+        client.call("product_retrieve", "GET", f"/api/products/{product}", token=token)
+        client.call("product_search", "GET", f"/api/products/search?q=bench+{rng.randrange(len(self.products))}", token=token)
+
+        client.call("cart_add", "POST", "/api/cart/add", {"product": product, "quantity": 1, "coupon": self.coupons[product]}, token=token)
+        items = client.call("cart_list", "GET", "/api/cart/", token=token)
+        item = items["results"][0]["id"]
+        client.call("cart_summary", "GET", "/api/cart/summary", token=token)
+        client.call("cart_update", "PUT", f"/api/cart/update/{item}", {"product": product, "quantity": 2, "coupon": self.coupons[product]}, token=token)
+        client.call("cart_buy", "DELETE", f"/api/cart/buy/{item}", token=token)
+
+        admin = self.admin_token
+        created = client.call("product_create", "POST", "/api/products/create", {"name": f"Bench new {name}", "description": "New", "price": "12.00", "stock": 10}, token=admin)
+        client.call("product_update", "PUT", f"/api/products/update/{created['id']}", {"name": f"Bench new {name}", "description": "Changed", "price": "13.00", "stock": 9}, token=admin)
+        expiry = (timezone.now() + timedelta(days=30)).isoformat()
+        discount = {"product": created['id'], "discount": 10, "provider": "bench", "coupon_code": f"NEW{name}", "allowed_users": 100, "expiry": expiry}
+        created_discount = client.call("discount_create", "POST", "/api/discount/create", discount, token=admin)
+        client.call("discount_view", "GET", "/api/discount/", token=token)
+        client.call("discount_update", "PUT", f"/api/discount/update/{created_discount['id']}", dict(discount, discount=15), token=admin)
+        client.call("discount_retrieve", "GET", f"/api/discount/retrieve/{created_discount['id']}", token=admin)
+        client.call("discount_delete", "DELETE", f"/api/discount/delete/{created_discount['id']}", token=admin)
+        client.call("product_delete", "DELETE", f"/api/products/delete/{created['id']}", token=admin)
+
+    def _report(self, results, elapsed):
+        self.stdout.write(f"{'route':<20} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for route, result in results.items():
+            self.stdout.write(
+                f"{route:<20} {result['requests']:>8} {result['errors']:>6} {result['throughput']:>8.1f} "
+                f"{result['p50']:>8.1f} {result['p95']:>8.1f} {result['p99']:>8.1f}"
+            )
+        total = sum(result['requests'] for result in results.values())
+        self.stdout.write(f"{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s")
+
+    def _compare(self, results, run_settings, options):
+        with open(options['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["settings"] != run_settings:
+            self.stdout.write(self.style.WARNING(f"The baseline was taken with {baseline['settings']}, this run used {run_settings}"))
+
+        regressions = []
+        for route, result in results.items():
+            before = baseline["routes"].get(route)
+            if before is None:
+                continue
+            if result["errors"] > before["errors"]:
+                regressions.append(f"{route}: {result['errors']} errors, {before['errors']} in the baseline")
+            for figure, higher_is_worse in COMPARED:
+                change = (result[figure] - before[figure]) if higher_is_worse else (before[figure] - result[figure])
+                if before[figure] and change > before[figure] * options['threshold'] and (figure == "throughput" or change > options['min_delta_ms']):
+                    regressions.append(f"{route}: {figure} {result[figure]:.1f}, {before[figure]:.1f} in the baseline")
+
+        if regressions:
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            raise CommandError(f"{len(regressions)} regressions beyond {options['threshold']:.0%} of the baseline")
+        self.stdout.write(self.style.SUCCESS(f"No route regressed beyond {options['threshold']:.0%} of the baseline"))
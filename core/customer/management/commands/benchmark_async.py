@@ -0,0 +1,129 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from knox.models import AuthToken
+from customer.models import CustomUser, Product
+
+
+class Command(BaseCommand):
+    help = "Compare the sync WSGI and async ASGI product list under concurrency with simulated DB latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=100, help="Requests in flight on the ASGI side")
+        parser.add_argument('--workers', type=int, default=8, help="WSGI worker threads")
+        parser.add_argument('--db-latency', type=float, default=0.02, help="Seconds added to every query")
+
+    def handle(self, *args, **options):
+        user = CustomUser.objects.create_user(email="bench-async@example.com", password=None, username="bench-async")
+        products = Product.objects.bulk_create(Product(name=f"bench-async-{n}", price=10, stock=1) for n in range(50))
+        _, token = AuthToken.objects.create(user)
+
+        latency = options['db_latency']
+
+        def slow_query(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def install(sender, connection, **kwargs):
+            # Fires again on every reconnect of the same thread's connection
+            if slow_query not in connection.execute_wrappers:
+                connection.execute_wrappers.append(slow_query)
+
+        connection_created.connect(install)
+        connections.close_all()
+        # Both handlers are driven with the test client's host name
+        hosts = override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'])
+        hosts.enable()
+        try:
+            headers = [(b'authorization', f"Token {token}".encode())]
+            sync = self._run_wsgi('/api/products/', headers, options['requests'], options['workers'])
+            asgi = asyncio.run(self._run_asgi('/api/async/products/', headers, options['requests'], options['concurrency']))
+        finally:
+            hosts.disable()
+            connection_created.disconnect(install)
+            connections.close_all()
+            Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+            user.delete()
+
+        for label, (elapsed, latencies) in (("sync WSGI", sync), ("async ASGI", asgi)):
+            latencies.sort()
+            self.stdout.write(
+                f"{label:>10}: {len(latencies) / elapsed:8.1f} req/s, p50 {statistics.median(latencies) * 1000:7.1f} ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms"
+            )
+
+    def _check(self, label, statuses):
+        failed = sorted({status for status in statuses if not 200 <= status < 300})
+        if failed:
+            raise CommandError(f"{label} answered {', '.join(map(str, failed))}, nothing was measured")
+
+    def _run_wsgi(self, path, headers, requests, workers):
+        application = WSGIHandler()
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80', 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': BytesIO(),
+        }
+        environ.update({'HTTP_' + name.decode().upper(): value.decode() for name, value in headers})
+
+        statuses = []
+
+        def one(_):
+            started = time.perf_counter()
+            body = application(
+                dict(environ, **{'wsgi.input': BytesIO()}),
+                lambda status, response_headers: statuses.append(int(status.split()[0])),
+            )
+            b"".join(body)
+            body.close()
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(workers) as pool:
+            started = time.perf_counter()
+            latencies = list(pool.map(one, range(requests)))
+            elapsed = time.perf_counter() - started
+        self._check("sync WSGI", statuses)
+        return elapsed, latencies
+
+    async def _run_asgi(self, path, headers, requests, concurrency):
+        application = ASGIHandler()
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'headers': headers + [(b'host', b'testserver')],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+        }
+        semaphore = asyncio.Semaphore(concurrency)
+        statuses = []
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        async def one():
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                # The client never disconnects, Django cancels this once the response is sent
+                await asyncio.Future()
+
+            async with semaphore:
+                started = time.perf_counter()
+                await application(dict(scope), receive, send)
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - started
+        self._check("async ASGI", statuses)
+        return elapsed, list(latencies)
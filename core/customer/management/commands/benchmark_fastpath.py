@@ -0,0 +1,75 @@
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from customer.models import CustomUser, Product, CartItem, Discounts
+from customer.serializers import ProductSerializer, CartItemSerializer, DiscountSerializer
+from customer.fastpath import product_rows, cart_item_rows, discount_rows
+from customer.redemption import shard_coupon
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare serializer and fast path list rendering per 10k rows (rolled back afterwards). Both sides get "
+        "their rows already fetched, the serializer's with products and shards pre-fetched, so only "
+        "serialization and rendering are timed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000, help="Rows of each model to render")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per path, the best one is reported")
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        if rows <= 0:
+            raise CommandError("--rows must be positive")
+
+        with transaction.atomic():
+            user = CustomUser.objects.create_user(email="bench-fastpath@example.com", password=None, username="bench-fastpath")
+            products = Product.objects.bulk_create(
+                Product(name=f"bench-fastpath-{n}", description="Benchmark product   ünïcode", price=Decimal(n % 1000) + Decimal("0.99"), stock=n)
+                for n in range(rows)
+            )
+            CartItem.objects.bulk_create(
+                CartItem(user=user, product=product, quantity=1 + n % 3, coupon="", price=product.price, rate=product.price, total=product.price * (1 + n % 3))
+                for n, product in enumerate(products)
+            )
+            discounts = Discounts.objects.bulk_create(
+                Discounts(product=product, discount=n % 90, provider="bench", coupon_code=f"FAST{n}", allowed_users=100, used=n % 7)
+                for n, product in enumerate(products)
+            )
+            for discount in discounts[::100]:
+                shard_coupon(discount, 4)
+
+            cases = (
+                ("products", Product.objects.order_by('id'), ProductSerializer, product_rows),
+                ("cart items", CartItem.objects.filter(user=user).select_related('product').order_by('id'), CartItemSerializer, cart_item_rows),
+                ("discounts", Discounts.objects.select_related('product').prefetch_related('redemption_shards').order_by('id'), DiscountSerializer, discount_rows),
+            )
+            for name, queryset, serializer_class, encoder in cases:
+                # Each side reads its rows once, untimed. Products still read their images and discounts the
+                # fast path's shard sums with one query per run, as the views do
+                instances = list(queryset)
+                values = list(encoder.values(queryset.all()))
+                slow, slow_body = self._best(options['repeat'], lambda: serializer_class(instances, many=True).data)
+                fast, fast_body = self._best(options['repeat'], lambda: encoder.encode(values))
+                if slow_body != fast_body:
+                    raise CommandError(f"Fast path output of {name} differs from {serializer_class.__name__}")
+                scale = 10_000 / rows
+                self.stdout.write(
+                    f"{name}: serializer {slow * scale * 1000:.1f}ms, fast path {fast * scale * 1000:.1f}ms per 10k rows "
+                    f"({slow / fast:.1f}x), {len(fast_body)} identical bytes"
+                )
+
+            transaction.set_rollback(True)
+
+    def _best(self, repeat, compute):
+        renderer = JSONRenderer()
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            body = renderer.render(compute())
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
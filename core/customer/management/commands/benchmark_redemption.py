@@ -0,0 +1,86 @@
+import threading
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
+from django.utils import timezone
+from customer.models import Product, Discounts
+from customer.coupons import coupon_index
+from customer.redemption import redeem_coupon, shard_coupon, total_redeemed
+
+
+class Command(BaseCommand):
+    help = "Benchmark concurrent coupon redemptions and check the limit is never exceeded"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--attempts', type=int, default=2000, help="Redemptions tried in total")
+        parser.add_argument('--allowed', type=int, default=1500, help="allowed_users of the coupon")
+        parser.add_argument('--shards', type=int, default=0, help="Redemption shards, 0 for the single counter")
+
+    def handle(self, *args, **options):
+        product = Product.objects.create(name=f"bench-redeem-{time.time_ns()}", price=100, stock=0)
+        try:
+            discount = Discounts.objects.create(
+                product=product, discount=10, provider="bench", coupon_code=f"BENCH-{product.pk}",
+                allowed_users=options['allowed'], expiry=timezone.now() + timedelta(hours=1),
+            )
+            if options['shards']:
+                shard_coupon(discount, options['shards'])
+            coupon_index.invalidate()
+            coupon = coupon_index.lookup(product.pk, discount.coupon_code)
+
+            redeemed, retries = self._run(coupon, options['threads'], options['attempts'])
+            discount.refresh_from_db()
+            counted = total_redeemed(discount)
+        finally:
+            product.delete()
+
+        expected = min(options['attempts'], options['allowed'])
+        self.stdout.write(
+            f"{options['threads']} threads, {options['shards'] or 'no'} shards: {redeemed['count']} redemptions in "
+            f"{redeemed['elapsed']:.3f}s ({redeemed['count'] / redeemed['elapsed']:,.0f}/s), {retries['count']} lock retries"
+        )
+        if redeemed['count'] != expected or counted != expected:
+            raise CommandError(f"Expected {expected} redemptions, got {redeemed['count']} (counter says {counted})")
+
+    def _run(self, coupon, threads, attempts):
+        remaining = {'count': attempts}
+        redeemed = {'count': 0, 'elapsed': 0}
+        retries = {'count': 0}
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads + 1)
+
+        def worker():
+            barrier.wait()
+            try:
+                while True:
+                    with lock:
+                        if remaining['count'] == 0:
+                            return
+                        remaining['count'] -= 1
+                    while True:
+                        try:
+                            with transaction.atomic():
+                                taken = redeem_coupon(coupon)
+                            break
+                        except OperationalError:
+                            # SQLite answers write contention with "database is locked"
+                            with lock:
+                                retries['count'] += 1
+                            time.sleep(0.001)
+                    if taken:
+                        with lock:
+                            redeemed['count'] += 1
+            finally:
+                connection.close()
+
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in pool:
+            thread.join()
+        redeemed['elapsed'] = time.perf_counter() - started
+        return redeemed, retries
@@ -0,0 +1,56 @@
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from customer.models import CustomUser, Product, CartItem, Discounts
+from customer.pricing import reprice_product
+
+
+class Command(BaseCommand):
+    help = "Benchmark a product price edit against a large number of cart rows (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help="Cart rows holding the edited product")
+        parser.add_argument('--other-rows', type=int, default=0, help="Cart rows of unrelated products")
+        parser.add_argument('--coupons', type=int, default=5, help="Discounts defined on the edited product")
+        parser.add_argument('--batch-size', type=int, default=10_000)
+        parser.add_argument('--max-seconds', type=float, default=None, help="Fail when repricing takes longer")
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        batch_size = options['batch_size']
+
+        with transaction.atomic():
+            user = CustomUser.objects.create_user(email="bench-reprice@example.com", password=None, username="bench-reprice")
+            product = Product.objects.create(name="bench-reprice-product", price=Decimal("100.00"), stock=rows)
+            other = Product.objects.create(name="bench-reprice-other", price=Decimal("10.00"), stock=0)
+            codes = [f"BENCH{n}" for n in range(options['coupons'])]
+            Discounts.objects.bulk_create(
+                Discounts(product=product, discount=5 * (n + 1), provider="bench", coupon_code=code, allowed_users=rows)
+                for n, code in enumerate(codes)
+            )
+            coupons = codes + [""]
+
+            self.stdout.write(f"Seeding {rows} cart rows...")
+            self._seed(user, product, rows, coupons, batch_size)
+            self._seed(user, other, options['other_rows'], [""], batch_size)
+
+            product.price = Decimal("80.00")
+            product.save(update_fields=['price'])
+            started = time.perf_counter()
+            updated = reprice_product(product)
+            elapsed = time.perf_counter() - started
+
+            transaction.set_rollback(True)
+
+        rate = updated / elapsed if elapsed else float('inf')
+        self.stdout.write(f"Repriced {updated} cart rows in {elapsed:.3f}s ({rate:,.0f} rows/s)")
+        if options['max_seconds'] is not None and elapsed > options['max_seconds']:
+            raise CommandError(f"Repricing took {elapsed:.3f}s, budget was {options['max_seconds']}s")
+
+    def _seed(self, user, product, rows, coupons, batch_size):
+        for start in range(0, rows, batch_size):
+            CartItem.objects.bulk_create(
+                CartItem(user=user, product=product, quantity=1 + n % 3, coupon=coupons[n % len(coupons)], price=product.price, rate=product.price, total=product.price)
+                for n in range(start, min(start + batch_size, rows))
+            )
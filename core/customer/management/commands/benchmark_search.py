@@ -0,0 +1,73 @@
+import itertools
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from customer.models import Product
+from customer.search import index_products, search_products
+
+
+class Command(BaseCommand):
+    help = "Measure product search latency on a synthetic catalog (rolled back afterwards)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--vocabulary', type=int, default=20_000, help="Distinct words the catalog is written with")
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--limit', type=int, default=50)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-p95-ms', type=float, default=None, help="Fail when the p95 latency is above this")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = [self._word(rng) for _ in range(options['vocabulary'])]
+        # Zipf-like word frequencies, as in real product text
+        weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            total = options['products']
+            for start in range(0, total, options['chunk_size']):
+                products = Product.objects.bulk_create(
+                    Product(
+                        name=f"{' '.join(rng.choices(words, cum_weights=weights, k=3))} {n}",
+                        description=' '.join(rng.choices(words, cum_weights=weights, k=12)),
+                        price=1, stock=1,
+                    )
+                    for n in range(start, min(start + options['chunk_size'], total))
+                )
+                if products[0].pk is None:
+                    products = Product.objects.filter(name__in=[product.name for product in products])
+                index_products(products)
+                self.stdout.write(f"{min(start + options['chunk_size'], total)} products indexed")
+            self.stdout.write(f"Catalog of {total} products built in {time.perf_counter() - started:.1f}s")
+
+            queries = []
+            for _ in range(options['queries']):
+                kind = rng.random()
+                if kind < 0.4:
+                    queries.append(rng.choices(words, cum_weights=weights)[0])
+                elif kind < 0.7:
+                    queries.append(rng.choice(words)[:3])
+                else:
+                    queries.append(' '.join(rng.choices(words, cum_weights=weights, k=2)))
+
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                search_products(query, options['limit'])
+                latencies.append((time.perf_counter() - started) * 1000)
+
+            transaction.set_rollback(True)
+
+        latencies.sort()
+        p50 = statistics.median(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        self.stdout.write(f"{len(latencies)} queries: p50 {p50:.1f}ms, p95 {p95:.1f}ms, max {latencies[-1]:.1f}ms")
+        if options['max_p95_ms'] is not None and p95 > options['max_p95_ms']:
+            raise CommandError(f"p95 latency {p95:.1f}ms is above the {options['max_p95_ms']}ms budget")
+
+    def _word(self, rng):
+        return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
@@ -0,0 +1,36 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from customer.exporter import EXPORTS, FORMATS, export_rows, encode_rows
+
+
+class Command(BaseCommand):
+    help = "Stream products, carts or discounts as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--since', default=None, help="Only rows created or updated at or after this ISO 8601 datetime")
+        parser.add_argument('--output', default='-', help="File to write, - for stdout")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None:
+                raise CommandError("--since must be an ISO 8601 datetime")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        watermark = timezone.now()
+        rows = export_rows(options['name'], since=since, chunk_size=options['chunk_size'])
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', newline='', encoding='utf-8')
+        try:
+            for line in encode_rows(options['name'], rows, options['format']):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f"Next watermark: {watermark.isoformat()}")
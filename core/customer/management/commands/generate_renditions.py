@@ -0,0 +1,52 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from customer.models import Image
+from customer.imaging import file_sha256, render
+from customer.renditions import render_arguments, store_renditions
+
+
+class Command(BaseCommand):
+    help = "Render the missing product image renditions (all of them with --all) on a process pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Render images that already have renditions as well")
+        parser.add_argument('--workers', type=int, default=max(settings.RENDITION_WORKERS, 1))
+
+    def handle(self, *args, **options):
+        images = Image.objects.order_by('id')
+        if not options['all']:
+            images = images.filter(renditions={})
+
+        # Images submitted but not stored yet, enough to keep every worker busy without queueing the whole table
+        window = 2 * options['workers']
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context("spawn")) as executor:
+            jobs = {}
+            for image in images.iterator():
+                if len(jobs) >= window:
+                    finished, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                    stored, lost = self._store(jobs, finished)
+                    done, failed = done + stored, failed + lost
+                if not image.sha256:
+                    with image.image.open('rb') as source:
+                        image.sha256 = file_sha256(source)
+                    Image.objects.filter(pk=image.pk).update(sha256=image.sha256)
+                jobs[executor.submit(render, *render_arguments(image))] = image.pk
+            stored, lost = self._store(jobs, wait(jobs).done)
+            done, failed = done + stored, failed + lost
+        self.stdout.write(self.style.SUCCESS(f"Rendered {done} images, {failed} failed"))
+
+    def _store(self, jobs, finished):
+        # Saves the renditions of the finished jobs and drops them from `jobs`, returns (stored, failed)
+        stored = failed = 0
+        for future in finished:
+            pk = jobs.pop(future)
+            try:
+                store_renditions(pk, future.result())
+                stored += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"image {pk}: {e}")
+        return stored, failed
@@ -0,0 +1,31 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from customer.importer import FORMATS, guess_format, read_rows, import_products
+
+
+class Command(BaseCommand):
+    help = "Stream products from a CSV or NDJSON file and upsert them by name"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, - for stdin")
+        parser.add_argument('--format', choices=FORMATS, default=None, help="Defaults to the file extension")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or guess_format(options['path'])
+
+        def progress(report):
+            self.stdout.write(f"{report['rows']} rows, {report['failed']} failed, {report['rows_per_sec']:,.0f} rows/s")
+
+        try:
+            stream = sys.stdin if options['path'] == '-' else open(options['path'], newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(e)
+        with stream:
+            report = import_products(read_rows(stream, file_format), chunk_size=options['chunk_size'], progress=progress)
+
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report['imported']} products from {report['rows']} rows in {report['elapsed']:.2f}s ({report['failed']} failed)"
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from customer.models import Product, SearchTerm
+from customer.search import index_products
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product search index from the catalog, chunk by chunk"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        indexed = 0
+        last = 0
+        while True:
+            products = list(Product.objects.filter(id__gt=last).order_by('id').only('id', 'name', 'description')[:chunk_size])
+            if not products:
+                break
+            with transaction.atomic():
+                index_products(products)
+            indexed += len(products)
+            last = products[-1].id
+            self.stdout.write(f"{indexed} products indexed")
+
+        # Terms left over from renamed or deleted products
+        removed, _ = SearchTerm.objects.filter(searchposting__isnull=True).delete()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} products, dropped {removed} unused terms"))
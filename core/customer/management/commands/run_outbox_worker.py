@@ -0,0 +1,37 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from customer.outbox import drain
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the side effects queued in the outbox (cart repricing) on a thread or process pool, "
+        "claiming --batch-size events at a time, every --interval seconds until stopped (once with --once)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--pool', choices=('thread', 'process'), default='thread')
+        parser.add_argument('--batch-size', type=int, default=100, help="Events claimed per round")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds between polls once the outbox is empty")
+        parser.add_argument('--once', action='store_true', help="Drain the due events and exit")
+
+    def handle(self, *args, **options):
+        if options['pool'] == 'process':
+            executor = ProcessPoolExecutor(options['workers'], mp_context=multiprocessing.get_context("spawn"), initializer=django.setup)
+        else:
+            executor = ThreadPoolExecutor(options['workers'])
+        with executor:
+            while True:
+                started = time.monotonic()
+                succeeded, failed = drain(options['batch_size'], executor)
+                if succeeded or failed or options['once']:
+                    self.stdout.write(f"Ran {succeeded} events, {failed} failed and were rescheduled, in {time.monotonic() - started:.2f}s")
+                if options['once']:
+                    return
+                connections.close_all()
+                time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections
+from customer.reservations import sweep, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Release the cart stock holds past their expiry in batches, every --interval seconds until stopped "
+        "(once with --once). Run it alongside the API, expired holds keep counting against the stock until swept."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Holds released per transaction")
+        parser.add_argument('--interval', type=float, default=30, help="Seconds between sweeps")
+        parser.add_argument('--once', action='store_true', help="Sweep once and exit")
+        parser.add_argument('--reconcile', action='store_true', help="Recount every product's held stock from the holds first")
+
+    def handle(self, *args, **options):
+        if options['reconcile']:
+            self.stdout.write(f"Recounted the held stock of {reconcile()} products")
+        while True:
+            started = time.monotonic()
+            released = sweep(options['batch_size'])
+            if released or options['once']:
+                self.stdout.write(f"Released {released} expired holds in {time.monotonic() - started:.2f}s")
+            if options['once']:
+                return
+            # Hand the connection back to the pool between sweeps
+            connections.close_all()
+            time.sleep(options['interval'])
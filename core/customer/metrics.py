@@ -0,0 +1,178 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Sections timed within a request besides the SQL, reported in this order
+SECTIONS = ("auth", "serializer")
+
+_current = ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    """
+    What one request spent where, in seconds. Filled by `record_query()`
+    and `timed()` while the request is the current one.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.total = 0.0
+        self.sections = dict.fromkeys(SECTIONS, 0.0)
+        self._depth = dict.fromkeys(SECTIONS, 0)
+
+    def server_timing(self):
+        parts = [f'db;dur={self.db * 1000:.2f};desc="{self.queries} queries"']
+        parts += [f"{name};dur={self.sections[name] * 1000:.2f}" for name in SECTIONS]
+        parts.append(f"total;dur={self.total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+def start_request():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every database connection. Connections are
+    per thread, the current request is followed through sync_to_async by its
+    context variable.
+    """
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db += time.perf_counter() - started
+        timings.queries += 1
+
+
+@contextmanager
+def timed(section):
+    """
+    Add the time spent in the block to `section` of the current request.
+    Nested blocks of the same section are counted once.
+    """
+    timings = _current.get()
+    if timings is None or timings._depth[section]:
+        yield
+        return
+    timings._depth[section] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.sections[section] += time.perf_counter() - started
+        timings._depth[section] -= 1
+
+
+class TimedSerializerMixin:
+    # Serializer validation and representation count as the request's serializer time
+
+    def run_validation(self, *args, **kwargs):
+        with timed("serializer"):
+            return super().run_validation(*args, **kwargs)
+
+    def to_representation(self, instance):
+        with timed("serializer"):
+            return super().to_representation(instance)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+HISTOGRAMS = (
+    ("api_request_duration_seconds", "Time to answer a request", SECONDS_BUCKETS, lambda timings: timings.total),
+    ("api_request_db_seconds", "Time spent in SQL per request", SECONDS_BUCKETS, lambda timings: timings.db),
+    ("api_request_queries", "SQL queries per request", QUERY_BUCKETS, lambda timings: timings.queries),
+    ("api_request_auth_seconds", "Time spent authenticating per request", SECONDS_BUCKETS, lambda timings: timings.sections["auth"]),
+    ("api_request_serializer_seconds", "Time spent in serializers per request", SECONDS_BUCKETS, lambda timings: timings.sections["serializer"]),
+)
+
+
+class Registry:
+    """
+    Per-route histograms of this process, keyed by URL name.
+
+    Nothing is shared between worker processes: /metrics answers with the
+    requests of whichever worker served the scrape. Every worker has to be
+    scraped on its own (one target per worker, e.g. a port each) and the
+    series summed in Prometheus, a scrape through a load balancer sees a
+    different worker's counters each time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._responses = {}
+        self._collectors = []
+
+    def register_collector(self, collector):
+        # `collector()` returns more exposition lines, rendered after the request metrics
+        self._collectors.append(collector)
+
+    def observe(self, route, status_code, timings):
+        with self._lock:
+            histograms = self._routes.get(route)
+            if histograms is None:
+                histograms = self._routes[route] = [Histogram(buckets) for _, _, buckets, _ in HISTOGRAMS]
+            for histogram, (_, _, _, value) in zip(histograms, HISTOGRAMS):
+                histogram.observe(value(timings))
+            key = (route, status_code)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        with self._lock:
+            lines = [
+                "# HELP api_responses_total Responses sent",
+                "# TYPE api_responses_total counter",
+            ]
+            for (route, status_code), count in sorted(self._responses.items()):
+                lines.append(f'api_responses_total{{route="{route}",status="{status_code}"}} {count}')
+            for index, (name, help_text, buckets, _) in enumerate(HISTOGRAMS):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for route, histograms in sorted(self._routes.items()):
+                    histogram = histograms[index]
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{route="{route}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{route="{route}"}} {histogram.count}')
+            collectors = list(self._collectors)
+        for collector in collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+            self._responses.clear()
+
+
+registry = Registry()
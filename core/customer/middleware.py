@@ -0,0 +1,85 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .metrics import start_request, end_request, registry
+from . import routers
+
+
+class PerformanceMiddleware:
+    """
+    Times every request and answers with a Server-Timing header naming the
+    SQL time and query count, the authentication and serializer time and
+    the total. The same figures feed the per-route histograms served by
+    /api/metrics.
+
+    Goes first in MIDDLEWARE so the total covers the other middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings, token = start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_request(token)
+        return self._finish(request, response, timings, started)
+
+    async def __acall__(self, request):
+        timings, token = start_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_request(token)
+        return self._finish(request, response, timings, started)
+
+    def _finish(self, request, response, timings, started):
+        timings.total = time.perf_counter() - started
+        response["Server-Timing"] = timings.server_timing()
+        match = getattr(request, "resolver_match", None)
+        route = match.url_name if match is not None and match.url_name else "unmatched"
+        registry.observe(route, response.status_code, timings)
+        return response
+
+
+class ReplicaMiddleware:
+    """
+    Routes the reads of each request through customer.routers.ReplicaRouter
+    and, once a request wrote, keeps its user's reads on the primary for
+    REPLICA_STICKY_SECONDS.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = routers.start_request(request.method)
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.end_request(token)
+        state.finish()
+        return response
+
+    async def __acall__(self, request):
+        state, token = routers.start_request(request.method)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routers.end_request(token)
+        state.finish()
+        return response
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0015_alter_discounts_expiry_alter_discounts_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='cartitem_user_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='discounts',
+            index=models.Index(fields=['created_at', 'id'], name='discounts_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['created_at', 'id'], name='product_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:45
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0017_updated_at_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discounts',
+            name='shards',
+            field=models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0, message='Shards cannot be negative.')]),
+        ),
+        migrations.CreateModel(
+            name='DiscountShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('allowed', models.IntegerField(default=0)),
+                ('used', models.IntegerField(default=0)),
+                ('discount', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemption_shards', to='customer.discounts')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('discount', 'index'), name='discountshard_discount_index_uniq')],
+            },
+        ),
+    ]
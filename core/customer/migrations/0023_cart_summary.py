@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:55
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0022_chunked_image_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CartSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cart_summary', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('items', models.IntegerField(default=0)),
+                ('quantity', models.IntegerField(default=0)),
+                ('subtotal', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('total', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0023_cart_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='reserved',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('cart_item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reservation', to='customer.cartitem')),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='customer.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at', 'id'], name='reservation_expires_id_idx'), models.Index(fields=['product', 'expires_at'], name='reservation_product_exp_idx')],
+            },
+        ),
+    ]
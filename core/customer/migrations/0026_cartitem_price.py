@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:46
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_price(apps, schema_editor):
+    # Existing rows were priced at their product's current price
+    CartItem = apps.get_model('customer', 'CartItem')
+    Product = apps.get_model('customer', 'Product')
+    CartItem.objects.update(price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0025_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='price',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=20),
+        ),
+        migrations.RunPython(backfill_price, migrations.RunPython.noop),
+    ]
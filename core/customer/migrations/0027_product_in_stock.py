@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0026_cartitem_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='in_stock',
+            field=models.GeneratedField(db_persist=True, expression=models.Q(('stock__gt', 0)), output_field=models.BooleanField()),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['in_stock', 'created_at', 'id'], name='product_stock_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['in_stock', 'price', 'id'], name='product_stock_price_idx'),
+        ),
+    ]
@@ -44,19 +44,65 @@ class Product(models.Model):
     actual_price = models.DecimalField(max_digits=5, decimal_places=2, default=0)
     price = models.DecimalField(max_digits=5, decimal_places=2)
     stock = models.IntegerField()
+    # Units held for carts by StockReservation rows, available stock is stock - reserved
+    reserved = models.IntegerField(default=0)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(null=True, default=None)
+    # Kept by the database, leads the indexes the in_stock filter of the product list searches in sort order
+    in_stock = models.GeneratedField(expression=models.Q(stock__gt=0), output_field=models.BooleanField(), db_persist=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="product_created_id_idx"),
+            models.Index(fields=["updated_at"], name="product_updated_idx"),
+            models.Index(fields=["price", "id"], name="product_price_id_idx"),
+            models.Index(fields=["in_stock", "created_at", "id"], name="product_stock_created_idx"),
+            models.Index(fields=["in_stock", "price", "id"], name="product_stock_price_idx"),
+        ]
 
 class CartItem(models.Model):
     user = models.ForeignKey("CustomUser", on_delete=models.CASCADE)
     product = models.ForeignKey("Product", on_delete=models.CASCADE)
     quantity = models.IntegerField(blank=True, default=1)
     coupon = models.CharField(max_length=50, blank=True, default="")
+    # Listed price of the product when the row was last priced, the summary's subtotal is counted from it
+    price = models.DecimalField(max_digits=20, decimal_places=2, default=00.00)
     rate = models.DecimalField(max_digits=20, decimal_places=2, default=00.00)
     total = models.DecimalField(max_digits=20, decimal_places=2, default=00.00)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(null=True, default=None)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at", "id"], name="cartitem_user_created_id_idx"),
+        ]
+
+class StockReservation(models.Model):
+    # Stock held for a cart row until expires_at, see customer.reservations
+    cart_item = models.OneToOneField("CartItem", on_delete=models.CASCADE, related_name="reservation")
+    product = models.ForeignKey("Product", on_delete=models.CASCADE, db_index=False)
+    quantity = models.IntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["expires_at", "id"], name="reservation_expires_id_idx"),
+            models.Index(fields=["product", "expires_at"], name="reservation_product_exp_idx"),
+        ]
+
+class CartSummary(models.Model):
+    # Running totals of a user's cart, kept in step with its rows by customer.summary
+    user = models.OneToOneField("CustomUser", on_delete=models.CASCADE, primary_key=True, related_name="cart_summary")
+    items = models.IntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=20, decimal_places=2, default=00.00)
+    total = models.DecimalField(max_digits=20, decimal_places=2, default=00.00)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    @property
+    def savings(self):
+        return self.subtotal - self.total
+
 class Discounts(models.Model):
     product = models.ForeignKey("Product", on_delete=models.CASCADE)
     discount = models.IntegerField(validators=[
@@ -71,16 +117,77 @@ class Discounts(models.Model):
     used = models.IntegerField(validators=[
             MinValueValidator(0, message="Users cannot be negative."),
         ], default=0)
+    shards = models.IntegerField(validators=[
+            MinValueValidator(0, message="Shards cannot be negative."),
+        ], default=0)
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(null=True, default=None)
     expiry = models.DateTimeField(default=datetime.now() + timedelta(days=10))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="discounts_created_id_idx"),
+            models.Index(fields=["updated_at"], name="discounts_updated_idx"),
+        ]
         
-class Image(models.Model):
-    product = models.ForeignKey("Product", on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='photos/')
-    
+class DiscountShard(models.Model):
+    # Slice of a hot coupon's remaining redemptions, see customer.redemption
+    discount = models.ForeignKey("Discounts", on_delete=models.CASCADE, related_name="redemption_shards")
+    index = models.IntegerField()
+    allowed = models.IntegerField(default=0)
+    used = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["discount", "index"], name="discountshard_discount_index_uniq"),
+        ]
+        
+class OutboxEvent(models.Model):
+    # Side effect committed with the change that caused it, run by `manage.py run_outbox_worker`, see customer.outbox
+    topic = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    attempts = models.IntegerField(default=0)
+    # Not run before then; None once it ran out of attempts
+    available_at = models.DateTimeField(null=True, default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["available_at", "id"], name="outbox_available_id_idx"),
+        ]
+        
+class SearchTerm(models.Model):
+    # Vocabulary of the product search index, see customer.search
+    term = models.CharField(max_length=64, unique=True)
 
+class SearchPosting(models.Model):
+    # Both lookups are served by the composite indexes below
+    term = models.ForeignKey("SearchTerm", on_delete=models.CASCADE, db_index=False)
+    product = models.ForeignKey("Product", on_delete=models.CASCADE, related_name="search_postings", db_index=False)
+    weight = models.PositiveSmallIntegerField(default=1)
 
-    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "term"], name="searchposting_product_term_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["term", "weight"], name="searchposting_term_weight_idx"),
+        ]
         
+class Image(models.Model):
+    product = models.ForeignKey("Product", on_delete=models.CASCADE)
+    image = models.ImageField(upload_to='photos/')
+    sha256 = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    # {width: {format: name under RENDITION_ROOT}}, empty until rendered
+    renditions = models.JSONField(default=dict, blank=True)
+
+class ImageUpload(models.Model):
+    # Chunked image upload in progress, see customer.uploads
+    product = models.ForeignKey("Product", on_delete=models.CASCADE)
+    user = models.ForeignKey("CustomUser", on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255, blank=True, default="")
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
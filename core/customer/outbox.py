@@ -0,0 +1,137 @@
+import json
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import OutboxEvent, Product, Discounts
+from .pricing import reprice_product, reprice_discount
+
+handlers = {}
+
+
+def handler(topic):
+    """
+    Register the function running the events of `topic`, called with their
+    payload as keyword arguments. Handlers must be idempotent: an event is
+    run again when its worker died before recording the outcome, and events
+    with the same payload claimed together run once.
+    """
+    def register(function):
+        handlers[topic] = function
+        return function
+    return register
+
+
+def enqueue(topic, **payload):
+    # Written in the caller's transaction, the event only exists if the change committed
+    return OutboxEvent.objects.create(topic=topic, payload=payload)
+
+
+def enqueue_many(topic, payloads):
+    return OutboxEvent.objects.bulk_create(OutboxEvent(topic=topic, payload=payload) for payload in payloads)
+
+
+def claim(batch_size, now=None):
+    """
+    Lease up to `batch_size` due events to the caller for OUTBOX_LEASE_SECONDS
+    and count the attempt. Rows other workers are claiming are skipped; an
+    event whose worker died comes back once its lease runs out.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True).filter(available_at__lte=now)
+            .order_by('available_at', 'id')[:batch_size]
+        )
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+            available_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS), attempts=F('attempts') + 1
+        )
+    return events
+
+
+def batches(events):
+    """
+    Group claimed events into `(topic, payload, ids, attempts)` runs, one per
+    distinct topic and payload: ten price edits of a product reprice it once.
+    """
+    groups = defaultdict(list)
+    for event in events:
+        # `attempts` as loaded, before claim() counted this one
+        groups[event.topic, json.dumps(event.payload, sort_keys=True)].append(event)
+    return [
+        (topic, group[0].payload, [event.pk for event in group], max(event.attempts for event in group) + 1)
+        for (topic, _), group in groups.items()
+    ]
+
+
+def run(topic, payload, ids, attempts):
+    """
+    Run one handler in its own transaction and delete its events with it.
+    A failure schedules a retry after an exponential backoff, or parks the
+    events once they had OUTBOX_MAX_ATTEMPTS. Returns whether it succeeded.
+    """
+    try:
+        with transaction.atomic():
+            handlers[topic](**payload)
+            OutboxEvent.objects.filter(pk__in=ids).delete()
+        return True
+    except Exception as e:
+        if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            available_at = None
+        else:
+            available_at = timezone.now() + timedelta(seconds=settings.OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1))
+        OutboxEvent.objects.filter(pk__in=ids).update(available_at=available_at, last_error=f"{type(e).__name__}: {e}")
+        return False
+
+
+def run_pooled(topic, payload, ids, attempts):
+    # Pool workers hand their connection back after every run
+    try:
+        return run(topic, payload, ids, attempts)
+    finally:
+        connections.close_all()
+
+
+def drain(batch_size=100, executor=None):
+    """
+    Run every due event, `batch_size` claimed at a time, on `executor` (a
+    thread or process pool) or inline. Returns (succeeded, failed) runs.
+    """
+    succeeded = failed = 0
+    while True:
+        events = claim(batch_size)
+        if not events:
+            return succeeded, failed
+        runs = batches(events)
+        if executor is None:
+            results = [run(*arguments) for arguments in runs]
+        else:
+            results = list(executor.map(run_pooled, *zip(*runs)))
+        succeeded += results.count(True)
+        failed += results.count(False)
+
+
+# Both handlers lock the products they reprice before reading a price or a discount, so two
+# runs for one product, on other threads or workers, reprice one after the other and the
+# later always works from what the earlier committed
+
+@handler("reprice_product")
+def reprice_product_event(product_id):
+    product = Product.objects.select_for_update().filter(pk=product_id).first()
+    # A deleted product took its cart rows with it
+    if product is not None:
+        reprice_product(product)
+
+
+@handler("reprice_discount")
+def reprice_discount_event(discount_id, previous_product_id, previous_code):
+    product_id = Discounts.objects.filter(pk=discount_id).values_list('product_id', flat=True).first()
+    # Deleting a discount leaves the cart rows priced as they were
+    if product_id is None:
+        return
+    products = {product.pk: product for product in Product.objects.select_for_update().filter(pk__in={previous_product_id, product_id}).order_by('pk')}
+    discount = Discounts.objects.filter(pk=discount_id).select_related('product').first()
+    if discount is not None:
+        reprice_discount(discount, previous_product=products.get(previous_product_id), previous_code=previous_code)
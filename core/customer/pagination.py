@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, Cursor
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset pagination on an indexed `(column, id)` pair, `(created_at, id)`
+    unless a filter backend of the view picks another one with get_ordering.
+
+    The cursor carries the key of the last (or first, when paging backwards)
+    row of the page, so every page is a range scan starting at that key no
+    matter how deep it is, and rows inserted meanwhile never shift a page.
+    """
+    ordering = ('created_at', 'id')
+    page_size = getattr(settings, 'API_PAGE_SIZE', 50)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 200)
+    template = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.set_page([row async for row in self.page_queryset(queryset, request, view)])
+
+    def page_queryset(self, queryset, request, view=None):
+        # The rows of the requested page, plus one telling whether another page follows
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.key_field = queryset.model._meta.get_field(self.ordering[0].lstrip('-'))
+
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        key, pk = (field.lstrip('-') for field in self.ordering)
+        descending = self.ordering[0].startswith('-')
+
+        if reverse != descending:
+            queryset = queryset.order_by('-' + key, '-' + pk)
+        else:
+            queryset = queryset.order_by(key, pk)
+
+        # Row-value comparison (key, id) > (cursor key, cursor id), < when walking the index backwards.
+        # The redundant key >= cursor key bound lets the database start the index scan at the cursor.
+        if self.cursor is not None:
+            key_value, key_pk = self._parse_position(self.cursor.position)
+            lookup = '__lt' if reverse != descending else '__gt'
+            queryset = queryset.filter(**{key + lookup + 'e': key_value}).filter(
+                Q(**{key + lookup: key_value}) | Q(**{key: key_value, pk + lookup: key_pk})
+            )
+
+        return queryset[:self.page_size + 1]
+
+    def get_ordering(self, request, queryset, view):
+        for backend in getattr(view, 'filter_backends', ()):
+            if hasattr(backend, 'get_ordering'):
+                return tuple(backend().get_ordering(request, queryset, view))
+        return type(self).ordering
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if self.cursor is not None and self.cursor.reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # Paging backwards ran past the first row, resume from the cursor
+            return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.cursor.position))
+        position = self._get_position_from_instance(self.page[-1], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.cursor.position))
+        position = self._get_position_from_instance(self.page[0], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        key, pk = (field.lstrip('-') for field in ordering)
+        if isinstance(instance, dict):
+            value, pk = instance[key], instance[pk]
+        else:
+            value, pk = getattr(instance, key), getattr(instance, pk)
+        return f"{value.isoformat() if hasattr(value, 'isoformat') else value}|{pk}"
+
+    def _parse_position(self, position):
+        try:
+            value, pk = position.rsplit('|', 1)
+            key_value = self.key_field.to_python(value)
+            if key_value is None:
+                raise ValueError()
+            return key_value, int(pk)
+        except (AttributeError, TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
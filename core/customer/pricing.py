@@ -0,0 +1,68 @@
+from decimal import Decimal, ROUND_HALF_UP
+from django.db.models import F, Value, DecimalField, ExpressionWrapper
+from django.utils import timezone
+from .models import CartItem, Discounts
+from .summary import refresh
+
+CENT = Decimal("0.01")
+
+
+def discounted_rate(price, discount=0):
+    # Rate of a product once a percentage discount is applied, rounded to cents
+    rate = Decimal(price) * (100 - Decimal(discount or 0)) / 100
+    return rate.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _apply_rate(items, price, rate):
+    # Single UPDATE for the whole group, total is derived in SQL from quantity; stamped for incremental exports
+    total = ExpressionWrapper(Value(rate) * F('quantity'), output_field=DecimalField(max_digits=20, decimal_places=2))
+    return items.update(price=price, rate=rate, total=total, updated_at=timezone.now())
+
+
+def reprice_product(product, coupons=None):
+    """
+    Recompute rate and total of the cart items holding `product`.
+
+    Items are grouped by the rate they end up with so every group is written
+    with one set-based UPDATE, cart items of other products are never touched.
+    Passing `coupons` restricts the repricing to items using those codes.
+    The cart summaries of their owners are recomputed with one more UPDATE.
+    Returns the number of cart items updated.
+    """
+    items = CartItem.objects.filter(product=product)
+    if coupons is not None:
+        items = items.filter(coupon__in=coupons)
+
+    discounts = Discounts.objects.filter(product=product)
+    if coupons is not None:
+        discounts = discounts.filter(coupon_code__in=coupons)
+
+    groups = {}
+    for code, discount in discounts.values_list('coupon_code', 'discount'):
+        groups.setdefault(discounted_rate(product.price, discount), []).append(code)
+
+    updated = 0
+    codes = []
+    for rate, group in groups.items():
+        updated += _apply_rate(items.filter(coupon__in=group), product.price, rate)
+        codes.extend(group)
+
+    # Items without a (still) valid coupon pay the listed price
+    updated += _apply_rate(items.exclude(coupon__in=codes), product.price, discounted_rate(product.price))
+    if updated:
+        refresh(items.values('user'))
+    return updated
+
+
+def reprice_discount(discount, previous_product=None, previous_code=None):
+    """
+    Reprice the cart items affected by a change of `discount`.
+
+    When the coupon moved to another product or was renamed, the items still
+    holding the old (product, code) pair are repriced as well.
+    """
+    updated = 0
+    if previous_product is not None and (previous_product.pk != discount.product_id or previous_code != discount.coupon_code):
+        updated += reprice_product(previous_product, coupons=[previous_code])
+    updated += reprice_product(discount.product, coupons=[discount.coupon_code])
+    return updated
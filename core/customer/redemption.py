@@ -0,0 +1,64 @@
+import random
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import Discounts, DiscountShard
+from .coupons import bump_coupon_version
+
+
+def redeem_coupon(coupon, count=1):
+    """
+    Count `count` uses of `coupon` (an entry of the coupon index) if that many
+    are left, otherwise take none.
+
+    In the default mode this is a single `UPDATE ... SET used = used + 1
+    WHERE used < allowed_users`, so concurrent redeemers can never push the
+    count past the limit. Sharded coupons spread the remaining uses over
+    DiscountShard rows and redeem against a random shard first, so redeemers
+    stop queueing on one hot row; each shard enforces its own slice of the
+    limit, which keeps the total bounded. Returns whether the uses were taken.
+    """
+    now = timezone.now()
+    if not coupon.shards:
+        return Discounts.objects.filter(pk=coupon.id, used__lte=F('allowed_users') - count, expiry__gt=now).update(
+            used=F('used') + count, updated_at=now
+        ) == 1
+
+    if coupon.expiry <= now:
+        return False
+    start = random.randrange(coupon.shards)
+    for offset in range(coupon.shards):
+        index = (start + offset) % coupon.shards
+        if DiscountShard.objects.filter(discount_id=coupon.id, index=index, used__lte=F('allowed') - count).update(used=F('used') + count):
+            return True
+    return False
+
+
+def total_redeemed(discount):
+    if not discount.shards:
+        return discount.used
+    if 'redemption_shards' in getattr(discount, '_prefetched_objects_cache', {}):
+        # Shards prefetched for a whole list are summed without a query per discount
+        return discount.used + sum(shard.used for shard in discount.redemption_shards.all())
+    return discount.used + (discount.redemption_shards.aggregate(used=Sum('used'))['used'] or 0)
+
+
+def shard_coupon(discount, shards):
+    """
+    Switch `discount` to `shards` redemption shards (0 goes back to the single
+    counter). Uses already taken are folded into Discounts.used and the
+    remaining ones are split evenly across the new shards.
+    """
+    with transaction.atomic():
+        discount = Discounts.objects.select_for_update().get(pk=discount.pk)
+        current = list(DiscountShard.objects.select_for_update().filter(discount=discount))
+        used = discount.used + sum(shard.used for shard in current)
+        DiscountShard.objects.filter(discount=discount).delete()
+
+        remaining = max(discount.allowed_users - used, 0)
+        DiscountShard.objects.bulk_create(
+            DiscountShard(discount=discount, index=index, allowed=remaining // shards + (1 if index < remaining % shards else 0))
+            for index in range(shards)
+        )
+        Discounts.objects.filter(pk=discount.pk).update(used=used, shards=shards, updated_at=timezone.now())
+        transaction.on_commit(bump_coupon_version)
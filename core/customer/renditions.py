@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils import timezone
+from .models import Image, Product
+from .imaging import render
+from .cache import bump_catalog_version
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+def _pool():
+    # Spawned rather than forked workers, forking a threaded server is unsafe
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.RENDITION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            _slots = threading.BoundedSemaphore(settings.RENDITION_QUEUE_SIZE)
+        return _executor, _slots
+
+
+def render_arguments(image):
+    return (
+        image.image.path, image.sha256, str(settings.RENDITION_ROOT),
+        tuple(settings.RENDITION_WIDTHS), tuple(settings.RENDITION_FORMATS), settings.RENDITION_QUALITY,
+    )
+
+
+def store_renditions(pk, renditions):
+    Image.objects.filter(pk=pk).update(renditions=renditions)
+    Product.objects.filter(image__pk=pk).update(updated_at=timezone.now())
+    bump_catalog_version()
+
+
+def schedule_renditions(image):
+    """
+    Queue the renditions of `image` on the worker pool, or render them right
+    away when RENDITION_WORKERS is 0. Returns False when the queue is full;
+    the image is then left for `manage.py generate_renditions`.
+    """
+    if settings.RENDITION_WORKERS == 0:
+        store_renditions(image.pk, render(*render_arguments(image)))
+        return True
+
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        return False
+    future = executor.submit(render, *render_arguments(image))
+    future.add_done_callback(partial(_finished, image.pk, slots, threading.get_ident()))
+    return True
+
+
+def _finished(pk, slots, scheduler, future):
+    slots.release()
+    try:
+        store_renditions(pk, future.result())
+    except Exception:
+        logger.exception("Rendering image %s failed", pk)
+    finally:
+        # Runs on the pool's thread unless the job was already done, that one has its own connection
+        if threading.get_ident() != scheduler:
+            connection.close()
+
+
+def image_payloads(product_ids):
+    """
+    `{product id: [image payload]}` for the products, with one query.
+    """
+    images = defaultdict(list)
+    rows = Image.objects.filter(product_id__in=product_ids).order_by('id').values('id', 'product_id', 'image', 'renditions')
+    for row in rows:
+        images[row['product_id']].append({
+            "id": row['id'],
+            "url": default_storage.url(row['image']),
+            "renditions": {
+                width: {file_format: settings.RENDITION_URL + name for file_format, name in formats.items()}
+                for width, formats in row['renditions'].items()
+            },
+        })
+    return images
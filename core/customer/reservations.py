@@ -0,0 +1,112 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Product, StockReservation
+
+
+def available(product):
+    # Stock not held for any cart, read off the product row
+    return max(product.stock - product.reserved, 0)
+
+
+def hold_until():
+    return timezone.now() + timedelta(seconds=settings.CART_HOLD_SECONDS)
+
+
+def take(product_id, quantity):
+    # Single conditional UPDATE, concurrent holds can never exceed the stock
+    return Product.objects.filter(pk=product_id, stock__gte=F('reserved') + quantity).update(reserved=F('reserved') + quantity) == 1
+
+
+def give_back(held):
+    """
+    Return `held` units, a mapping of product id to quantity, to the
+    available stock with one UPDATE for all the products.
+    """
+    held = {product_id: quantity for product_id, quantity in held.items() if quantity}
+    if not held:
+        return
+    Product.objects.filter(pk__in=held.keys()).update(reserved=F('reserved') - Case(
+        *(When(pk=product_id, then=Value(quantity)) for product_id, quantity in held.items()),
+        default=Value(0), output_field=IntegerField(),
+    ))
+
+
+def hold(item, created=False):
+    """
+    Hold `item.quantity` units of its product for the cart row `item` for the
+    next CART_HOLD_SECONDS, topping up or trimming what it already holds.
+
+    Returns False, holding nothing new, when there isn't that much stock
+    left. Pass `created` for a row that was just inserted and holds nothing.
+    """
+    expires_at = hold_until()
+    current = None if created else StockReservation.objects.select_for_update().filter(cart_item=item).first()
+    if current is not None and current.product_id != item.product_id:
+        give_back({current.product_id: current.quantity})
+        current.delete()
+        current = None
+
+    change = item.quantity - (current.quantity if current is not None else 0)
+    if change > 0 and not take(item.product_id, change):
+        return False
+    if change < 0:
+        give_back({item.product_id: -change})
+
+    if current is None:
+        StockReservation.objects.create(cart_item=item, product_id=item.product_id, quantity=item.quantity, expires_at=expires_at)
+    else:
+        current.quantity = item.quantity
+        current.expires_at = expires_at
+        current.save(update_fields=['quantity', 'expires_at'])
+    return True
+
+
+def _drop(reservations):
+    # (id, product id, quantity) of holds locked by the caller
+    held = defaultdict(int)
+    for _, product_id, quantity in reservations:
+        held[product_id] += quantity
+    give_back(held)
+    StockReservation.objects.filter(pk__in=[pk for pk, _, _ in reservations]).delete()
+
+
+def release(items):
+    """
+    Drop the holds of the cart rows `items`, locking them first so a sweep
+    can't hand the same units back twice.
+    """
+    _drop(list(StockReservation.objects.select_for_update().filter(cart_item__in=items).values_list('pk', 'product_id', 'quantity')))
+
+
+def sweep(batch_size=500, now=None):
+    """
+    Release the holds past their expiry, `batch_size` per transaction.
+
+    Each batch is read through the expiry index, skipping rows a checkout has
+    locked, and hands its units back with one UPDATE however many holds it
+    has on a product, so a popular product's row is written once per batch
+    rather than once per cart. Returns the number of holds released.
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                StockReservation.objects.select_for_update(skip_locked=True).filter(expires_at__lte=now)
+                .order_by('expires_at', 'id').values_list('pk', 'product_id', 'quantity')[:batch_size]
+            )
+            _drop(batch)
+        released += len(batch)
+        if len(batch) < batch_size:
+            return released
+
+
+def reconcile():
+    # Recount Product.reserved from the holds, for rows removed behind our back (say, a deleted user's cart)
+    held = StockReservation.objects.filter(product=OuterRef('pk')).order_by().values('product').annotate(total=Sum('quantity')).values('total')
+    return Product.objects.update(reserved=Coalesce(Subquery(held), Value(0)))
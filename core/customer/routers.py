@@ -0,0 +1,105 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from knox.models import get_token_model
+
+_current = ContextVar("replica_routing", default=None)
+
+
+def _sticky_key(user_id):
+    return f"db:sticky:{user_id}"
+
+
+class RoutingState:
+    """
+    How the reads of one request are routed. Requests that may write read
+    from the primary throughout; safe ones read from the replica picked for
+    them, unless their user wrote within the last REPLICA_STICKY_SECONDS.
+    """
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.replica = random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None
+        self.user_id = None
+        self.wrote = False
+        self._sticky = None
+
+    def read_alias(self):
+        if self.primary or self.replica is None:
+            return DEFAULT_DB_ALIAS
+        if self._sticky is None:
+            self._sticky = self.user_id is not None and cache.get(_sticky_key(self.user_id)) is not None
+        return DEFAULT_DB_ALIAS if self._sticky else self.replica
+
+    def finish(self):
+        # The user's next requests read their own writes until the replicas caught up
+        if self.wrote and self.user_id is not None:
+            cache.set(_sticky_key(self.user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+def start_request(method):
+    state = RoutingState(primary=method not in ("GET", "HEAD", "OPTIONS"))
+    return state, _current.set(state)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads of the current request to the primary inside the block,
+    for results that outlive the request such as shared cache entries.
+    """
+    state = _current.get()
+    if state is None or state.primary:
+        yield
+        return
+    state.primary = True
+    try:
+        yield
+    finally:
+        state.primary = False
+
+
+def identify(user_id):
+    # Called once a request is authenticated, stickiness is per user
+    state = _current.get()
+    if state is not None:
+        state.user_id = user_id
+
+
+class ReplicaRouter:
+    """
+    Sends the reads of safe API requests to the DATABASE_REPLICAS aliases
+    and everything else to the primary. Code running outside a request
+    (commands, workers) and reads inside a transaction stay on the primary,
+    and so do token lookups, a token is used right after it is created.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            # Related rows come from where their instance was read
+            return instance._state.db
+        state = _current.get()
+        if state is None or model is get_token_model() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return state.read_alias()
+
+    def db_for_write(self, model, **hints):
+        state = _current.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
@@ -0,0 +1,138 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from django.conf import settings
+from .models import Product, SearchTerm, SearchPosting
+from .fastpath import product_rows
+
+# Longest indexed term, longer words are cut (SearchTerm.term max_length)
+MAX_TERM_LENGTH = 64
+
+# A word of the name counts as much as this many in the description
+NAME_WEIGHT = 4
+
+# Terms per `IN (...)` list, below the bound variable limits of the backends
+_BATCH = 500
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    # Case and accent folded words, so "Café" and "CAFE" are the same term
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return [word[:MAX_TERM_LENGTH] for word in _WORD.findall(text)]
+
+
+def product_terms(name, description):
+    weights = Counter()
+    for word in tokenize(name):
+        weights[word] += NAME_WEIGHT
+    for word in tokenize(description):
+        weights[word] += 1
+    return {term: min(weight, 32767) for term, weight in weights.items()}
+
+
+def _batches(values):
+    values = list(values)
+    for start in range(0, len(values), _BATCH):
+        yield values[start:start + _BATCH]
+
+
+def index_products(products):
+    """
+    (Re)build the search postings of `products` from their name and description.
+
+    Run it in the transaction that wrote the products so the index never
+    disagrees with the catalog. Deleted products lose their postings through
+    the foreign key cascade.
+    """
+    terms = {product.pk: product_terms(product.name, product.description) for product in products}
+    SearchPosting.objects.filter(product_id__in=terms.keys()).delete()
+
+    vocabulary = set().union(*terms.values())
+    ids = {}
+    for batch in _batches(vocabulary):
+        SearchTerm.objects.bulk_create([SearchTerm(term=term) for term in batch], ignore_conflicts=True)
+        ids.update(SearchTerm.objects.filter(term__in=batch).values_list('term', 'id'))
+
+    # A term the database collation folded into another one is skipped
+    SearchPosting.objects.bulk_create(
+        [
+            SearchPosting(term_id=ids[term], product_id=pk, weight=weight)
+            for pk, weights in terms.items() for term, weight in weights.items() if term in ids
+        ],
+        batch_size=_BATCH,
+    )
+
+
+def _matching_terms(word):
+    # The term itself plus the ones it is a prefix of, as an indexed range scan
+    if len(word) < 2:
+        return list(SearchTerm.objects.filter(term=word).values_list('id', 'term'))
+    upper = word[:-1] + chr(ord(word[-1]) + 1)
+    return list(
+        SearchTerm.objects.filter(term__gte=word, term__lt=upper).order_by('term').values_list('id', 'term')[:settings.SEARCH_MAX_PREFIX_TERMS]
+    )
+
+
+def search_products(query, limit=50):
+    """
+    Products matching every word of `query`, best first, as product payloads.
+
+    A word matches terms it equals or is a prefix of (the shortest
+    SEARCH_MAX_PREFIX_TERMS of them). A product scores the weights of its
+    matching terms, doubled for whole-word matches, so name hits outrank
+    description hits and exact words outrank prefixes.
+
+    Candidates come from the rarest word of the query. When even that word
+    is in more than SEARCH_MAX_CANDIDATES products, only the ones where it
+    weighs most are ranked, which keeps broad queries as cheap as narrow ones.
+    """
+    words = list(dict.fromkeys(tokenize(query)))[:settings.SEARCH_MAX_QUERY_TERMS]
+    if not words:
+        return []
+
+    words_of_term = defaultdict(set)
+    exact = set()
+    matched = []
+    for index, word in enumerate(words):
+        terms = _matching_terms(word)
+        if not terms:
+            return []
+        matched.append([pk for pk, _ in terms])
+        for pk, term in terms:
+            words_of_term[pk].add(index)
+            if term == word:
+                exact.add(pk)
+
+    limit_candidates = settings.SEARCH_MAX_CANDIDATES
+    # Counting stops at the cap, so a very common word costs no more than a rare one
+    sizes = [SearchPosting.objects.filter(term_id__in=ids)[:limit_candidates + 1].count() for ids in matched]
+    driver = sizes.index(min(sizes))
+    if sizes[driver] <= limit_candidates:
+        postings = list(SearchPosting.objects.filter(term_id__in=matched[driver]).values_list('product_id', 'term_id', 'weight'))
+    else:
+        # Heaviest postings term by term (whole word first), each a backwards walk of the (term, weight) index
+        postings = []
+        for term_id in matched[driver]:
+            rows = SearchPosting.objects.filter(term_id=term_id).order_by('-weight').values_list('product_id', 'term_id', 'weight')
+            postings.extend(rows[:limit_candidates - len(postings)])
+            if len(postings) >= limit_candidates:
+                break
+
+    # The other words are only looked up for the candidates
+    others = [pk for index, ids in enumerate(matched) if index != driver for pk in ids]
+    if others:
+        for batch in _batches({product_id for product_id, _, _ in postings}):
+            postings.extend(SearchPosting.objects.filter(product_id__in=batch, term_id__in=others).values_list('product_id', 'term_id', 'weight'))
+
+    scores = Counter()
+    found = defaultdict(set)
+    for product_id, term_id, weight in postings:
+        scores[product_id] += weight * 2 if term_id in exact else weight
+        found[product_id] |= words_of_term[term_id]
+    ranked = sorted((pk for pk in scores if len(found[pk]) == len(words)), key=lambda pk: (-scores[pk], pk))[:limit]
+
+    rows = {row['id']: row for row in product_rows.values(Product.objects.filter(id__in=ranked))}
+    return product_rows.encode([rows[pk] for pk in ranked if pk in rows])
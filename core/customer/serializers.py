@@ -1,10 +1,19 @@
 from rest_framework import serializers
+from django.conf import settings
 from .models import CustomUser, Product, CartItem, Discounts
 from django.utils import timezone
-from django.db.utils import IntegrityError
-from decimal import Decimal
+from django.db import models, transaction
+from .pricing import discounted_rate
+from .cache import bump_catalog_version
+from .coupons import coupon_index, bump_coupon_version, EXPIRED
+from .redemption import redeem_coupon, total_redeemed, shard_coupon
+from .renditions import image_payloads
+from .metrics import TimedSerializerMixin
+from .summary import line, record
+from .reservations import available, hold
+from .outbox import enqueue
 
-class UserRegisterSerializer(serializers.ModelSerializer):
+class UserRegisterSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ["first_name", "last_name", "username", "email", "password"]
@@ -17,7 +26,19 @@ class UserRegisterSerializer(serializers.ModelSerializer):
         user.save()
         return user
     
-class ProductSerializer(serializers.Serializer):
+class ProductListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # The images of the whole list are read with one query, not one per product
+        products = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.image_map = image_payloads([product.id for product in products])
+        return super().to_representation(products)
+
+
+class ProductSerializer(TimedSerializerMixin, serializers.Serializer):
+    # {product id: [image payload]} of the list being serialized, filled by ProductListSerializer
+    image_map = None
+
     id = serializers.ReadOnlyField()
     name = serializers.CharField()
     description = serializers.CharField()
@@ -25,6 +46,14 @@ class ProductSerializer(serializers.Serializer):
     stock = serializers.IntegerField()
     created_at = serializers.ReadOnlyField()
     updated_at = serializers.ReadOnlyField()
+    images = serializers.SerializerMethodField()
+
+    class Meta:
+        list_serializer_class = ProductListSerializer
+
+    def get_images(self, obj):
+        images = self.image_map if self.image_map is not None else image_payloads([obj.id])
+        return images.get(obj.id, [])
 
     def validate(self, attrs):
         if(attrs['stock'] < 0):
@@ -33,29 +62,42 @@ class ProductSerializer(serializers.Serializer):
     
     def create(self, validated_data):
         product = Product.objects.create(**validated_data)
+        transaction.on_commit(bump_catalog_version)
         return product
     
     def update(self, instance, validated_data):
+        price_changed = 'price' in validated_data and validated_data['price'] != instance.price
         instance.name = validated_data.get('name', instance.name)
         instance.price = validated_data.get('price', instance.price)
         instance.stock= validated_data.get('stock', instance.stock)
         instance.description = validated_data.get('description', instance.description)
-        for item in CartItem.objects.all():
-            item.rate = instance.price
-            item.total = item.rate*item.quantity
-            item.save()
         instance.updated_at = timezone.now()
-        instance.save()
+        with transaction.atomic():
+            instance.save()
+
+            # Only the carts holding this product are repriced, and only when the price moved,
+            # by the outbox worker once this commits
+            if price_changed:
+                enqueue("reprice_product", product_id=instance.pk)
+            transaction.on_commit(bump_catalog_version)
         return instance
 
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(TimedSerializerMixin, serializers.Serializer):
+    image = serializers.ImageField()
+
+class ImageUploadSerializer(TimedSerializerMixin, serializers.Serializer):
+    size = serializers.IntegerField(min_value=1, max_value=settings.IMAGE_UPLOAD_MAX_SIZE)
+    filename = serializers.CharField(max_length=255, required=False, default="")
+    sha256 = serializers.RegexField(r'^[0-9a-f]{64}$', required=False, default="")
+
+class CustomUserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     model = CustomUser
     fields = "__all__"
     
 
-class CartItemSerializer(serializers.Serializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.Serializer):
     id = serializers.ReadOnlyField()
     user = serializers.ReadOnlyField
     product = serializers.SlugRelatedField(queryset=Product.objects.all(), slug_field='id')
@@ -73,34 +115,23 @@ class CartItemSerializer(serializers.Serializer):
         if(attrs['quantity'] < 0):
             raise serializers.ValidationError("Bad value")
         
-        # Product id validation
-
-        try:
-            Product.objects.get(id=attrs['product'].id)
-        except(Product.DoesNotExist):
-            raise serializers.ValidationError("There's no such product in the store")
-        
-        # Stock and Requested Quantity check
+        # Stock and Requested Quantity check (the product itself was resolved by the field)
 
         try:
             item = CartItem.objects.get(product=attrs['product'], user=self.context['request'].user)
         except(CartItem.DoesNotExist):
-            if(attrs['quantity'] > attrs['product'].stock):
-                raise serializers.ValidationError(f"Currently there's only {attrs['product'].stock} remaining in the stock")
+            if(attrs['quantity'] > available(attrs['product'])):
+                raise serializers.ValidationError(f"Currently there's only {available(attrs['product'])} remaining in the stock")
             return attrs 
         
-        # Discount Validation
+        # Discount Validation, served from the in-memory coupon index
 
-        try:
-            discounts = Discounts.objects.filter(product=attrs['product'])
-        except(Discounts.DoesNotExist):
-            return attrs
-        for dis in discounts.values():
-            if(dis["coupon_code"] == attrs["coupon"]):
-                if(dis["expiry"] <= timezone.now() or dis["used"] >= dis["allowed_users"]):
-                    raise serializers.ValidationError("Coupon code expired or reached its limit!")
-                return attrs
-        raise serializers.ValidationError("Invalid Coupon Code!")
+        coupon = coupon_index.lookup(attrs['product'].id, attrs['coupon'])
+        if(coupon is EXPIRED or (coupon is not None and coupon.used >= coupon.allowed_users)):
+            raise serializers.ValidationError("Coupon code expired or reached its limit!")
+        if(coupon is None):
+            raise serializers.ValidationError("Invalid Coupon Code!")
+        return attrs
 
 
     def create(self, validated_data):
@@ -108,77 +139,118 @@ class CartItemSerializer(serializers.Serializer):
         try:
             item = CartItem.objects.get(user=validated_data['user'], product=validated_data['product'])
         except(CartItem.DoesNotExist):
+            coupon = coupon_index.lookup(validated_data['product'].id, validated_data['coupon'])
+            if(coupon is None):
+                raise serializers.ValidationError("Invalid Coupon Code!")
+
+            with transaction.atomic():
 
-            # Incrementing used count for discount
+                # Incrementing used count for discount, refused once the limit is reached
+
+                if(coupon is EXPIRED or not redeem_coupon(coupon)):
+                    raise serializers.ValidationError("Coupon code expired or reached its limit!")
 
-            dis = Discounts.objects.get(product=validated_data['product'], coupon_code=validated_data["coupon"])
-            dis.used += 1
-            dis.save()
+                # Adding discounted value to the requested product
 
-            # Adding discounted value to the requested product
+                validated_data['price'] = validated_data['product'].price
+                validated_data['rate'] = discounted_rate(validated_data['product'].price, coupon.discount)
+                validated_data['total'] = validated_data['rate'] * validated_data['quantity']
+                item = CartItem.objects.create(**validated_data)
 
-            prod = Product.objects.get(name=validated_data.get('product').name)
-            validated_data['rate'] = prod.price - prod.price*Decimal(dis.discount/100)
-            validated_data['total'] = validated_data['rate'] * validated_data['quantity']
-            item = CartItem.objects.create(**validated_data)
+                # The stock is held for the cart until CART_HOLD_SECONDS pass
+                if(not hold(item, created=True)):
+                    raise serializers.ValidationError(f"Currently there's only {available(item.product)} remaining in the stock")
+                record(item.user_id, added=[line(item)])
             return item
         
         raise serializers.ValidationError("Item already exists in the cart")
         
     
     def update(self, instance, validated_data):
+        previous = line(instance)
         instance.product = validated_data.get('product', instance.product)
         instance.quantity = validated_data.get('quantity', instance.quantity)
 
-        # Updating discount
-        item = Product.objects.get(name=instance.product.name)
+        # Updating discount, the product was already resolved by the field
         dis = Discounts.objects.get(product=validated_data['product'], coupon_code=validated_data["coupon"])
-        instance.rate = item.price - item.price*Decimal(dis.discount/100)
+        instance.price = instance.product.price
+        instance.rate = discounted_rate(instance.product.price, dis.discount)
         instance.total = instance.rate * validated_data['quantity']
         instance.updated_at = timezone.now()
-        instance.save()
+        with transaction.atomic():
+            instance.save()
+            if(not hold(instance)):
+                raise serializers.ValidationError(f"Currently there's only {available(instance.product)} remaining in the stock")
+            record(instance.user_id, added=[line(instance)], removed=[previous])
         return instance
     
-class DiscountSerializer(serializers.Serializer):
+class CartBulkEntrySerializer(TimedSerializerMixin, serializers.Serializer):
+    # Shape of one entry of a bulk add, the cart rules are checked in customer.cart
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField()
+    coupon = serializers.CharField()
+
+class CartSummarySerializer(TimedSerializerMixin, serializers.Serializer):
+    items = serializers.ReadOnlyField()
+    quantity = serializers.ReadOnlyField()
+    subtotal = serializers.ReadOnlyField()
+    savings = serializers.ReadOnlyField()
+    total = serializers.ReadOnlyField()
+    updated_at = serializers.ReadOnlyField()
+
+class DiscountSerializer(TimedSerializerMixin, serializers.Serializer):
     id = serializers.ReadOnlyField()
     product = serializers.SlugRelatedField(queryset=Product.objects.all(), slug_field="id")
     discount = serializers.IntegerField()
     provider = serializers.CharField()
     coupon_code = serializers.CharField()
     allowed_users = serializers.IntegerField()
-    used = serializers.ReadOnlyField()
+    used = serializers.SerializerMethodField()
+    shards = serializers.IntegerField(required=False, min_value=0, max_value=256)
     created_at = serializers.ReadOnlyField()
     updated_at = serializers.ReadOnlyField()
     expiry = serializers.DateTimeField()
 
+    def get_used(self, obj):
+        return total_redeemed(obj)
+
     def create(self, validated_data):
         validated_data['used'] = 0
-        dis = Discounts.objects.create(**validated_data)
+        shards = validated_data.pop('shards', 0)
+        with transaction.atomic():
+            dis = Discounts.objects.create(**validated_data)
+            if(shards):
+                shard_coupon(dis, shards)
+                dis.refresh_from_db()
+            transaction.on_commit(bump_coupon_version)
         return dis
     
     def update(self, instance, validated_data):
+        previous_product = instance.product
+        previous_code = instance.coupon_code
+        previous_discount = instance.discount
+        previous_allowed = instance.allowed_users
+
         instance.product = validated_data.get('product', instance.product)
         instance.provider = validated_data.get('provider', instance.provider)
         instance.coupon_code = validated_data.get('coupon_code', instance.coupon_code)
-
-        # Changing the rate for already saved items in cart with respect to the change in discount value
-        if instance.discount != validated_data['discount']: # Efficient! Not happens everytime
-            instance.discount = validated_data.get('discount', instance.discount)
-            for item in CartItem.objects.filter(product=instance.product, coupon=instance.coupon_code).values():
-                item['rate'] = instance.product.price - item.price*Decimal(instance.discount/100)
-                item['total'] = item['rate'] * item['quantity']
-
+        instance.discount = validated_data.get('discount', instance.discount)
         instance.allowed_users = validated_data.get('allowed_users', instance.allowed_users)
         instance.expiry = validated_data.get('expiry', instance.expiry)
         instance.updated_at = timezone.now()
-        instance.save()
-        return instance
-    
-
-
-
-
-
+        with transaction.atomic():
 
+            # used and shards are left out, redemptions keep moving them concurrently
+            instance.save(update_fields=['product', 'provider', 'coupon_code', 'discount', 'allowed_users', 'expiry', 'updated_at'])
 
+            # Changing the rate for already saved items in cart with respect to the change in discount value, left to the outbox worker
+            if(instance.discount != previous_discount or instance.product != previous_product or instance.coupon_code != previous_code):
+                enqueue("reprice_discount", discount_id=instance.pk, previous_product_id=previous_product.pk, previous_code=previous_code)
 
+            # Shard quotas are slices of allowed_users, recut them when either changes
+            shards = validated_data.get('shards', instance.shards)
+            if(shards != instance.shards or (shards and instance.allowed_users != previous_allowed)):
+                shard_coupon(instance, shards)
+                instance.refresh_from_db()
+            transaction.on_commit(bump_coupon_version)
+        return instance
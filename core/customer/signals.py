@@ -0,0 +1,44 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from knox.models import get_token_model
+from .authentication import revoke_token, invalidate_user_tokens
+from .models import CustomUser, Product, CartItem
+from .search import index_products
+from .metrics import record_query
+from .reservations import release
+
+
+# knox's LogoutView deletes the token and LogoutAllView deletes the whole set
+@receiver(post_delete, sender=get_token_model())
+def token_deleted(sender, instance, **kwargs):
+    revoke_token(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # login() only stamps last_login, nothing a cached token depends on
+    if update_fields is not None and set(update_fields) == {"last_login"}:
+        return
+    invalidate_user_tokens(instance.pk)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def user_deleted(sender, instance, **kwargs):
+    # Their cart rows go with them, the stock they held doesn't come back by itself
+    release(CartItem.objects.filter(user=instance))
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, update_fields=None, **kwargs):
+    # Saves of stock or price alone leave the indexed text as it was
+    if update_fields is not None and not {"name", "description"} & set(update_fields):
+        return
+    index_products([instance])
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    # A reconnect reuses the wrapper object, install it once
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
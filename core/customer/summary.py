@@ -0,0 +1,76 @@
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import CartItem, CartSummary
+
+MONEY = DecimalField(max_digits=20, decimal_places=2)
+
+
+def line(item):
+    # What one cart row counts for in its owner's summary, priced as the row was, not as its product is now
+    return item.quantity, item.price * item.quantity, item.total
+
+
+def record(user_id, added=(), removed=()):
+    """
+    Move the cart summary of `user_id` by the `line()`s of the rows just
+    added and removed, with a single UPDATE in the caller's transaction.
+
+    Call it after the rows were written: a user without a summary yet gets
+    one built from their cart as it is now.
+    """
+    items = len(added) - len(removed)
+    quantity = sum(q for q, _, _ in added) - sum(q for q, _, _ in removed)
+    subtotal = sum(s for _, s, _ in added) - sum(s for _, s, _ in removed)
+    total = sum(t for _, _, t in added) - sum(t for _, _, t in removed)
+    updated = CartSummary.objects.filter(user_id=user_id).update(
+        items=F('items') + items, quantity=F('quantity') + quantity,
+        subtotal=F('subtotal') + subtotal, total=F('total') + total, updated_at=timezone.now(),
+    )
+    if not updated:
+        rebuild(user_id)
+
+
+def _totals(items):
+    # Aliased, the aggregates would otherwise shadow the fields they sum
+    totals = items.aggregate(
+        lines=Coalesce(Count('id'), 0),
+        units=Coalesce(Sum('quantity'), 0),
+        listed=Coalesce(Sum(ExpressionWrapper(F('price') * F('quantity'), output_field=MONEY)), Value(0), output_field=MONEY),
+        paid=Coalesce(Sum('total'), Value(0), output_field=MONEY),
+    )
+    return {"items": totals["lines"], "quantity": totals["units"], "subtotal": totals["listed"], "total": totals["paid"]}
+
+
+def rebuild(user_id):
+    # Summary of one user recomputed from their cart rows
+    summary, _ = CartSummary.objects.update_or_create(
+        user_id=user_id, defaults=dict(_totals(CartItem.objects.filter(user_id=user_id)), updated_at=timezone.now())
+    )
+    return summary
+
+
+def refresh(users):
+    """
+    Recompute the existing summaries of `users` (ids or a subquery of them)
+    with one set-based UPDATE, for writes that touch the carts of many users
+    at once such as repricing a product or deleting it.
+    """
+    rows = CartItem.objects.filter(user=OuterRef('user')).order_by().values('user')
+
+    def column(aggregate, output_field):
+        return Coalesce(Subquery(rows.annotate(value=aggregate).values('value')), Value(0), output_field=output_field)
+
+    return CartSummary.objects.filter(user__in=users).update(
+        items=column(Count('id'), IntegerField()),
+        quantity=column(Sum('quantity'), IntegerField()),
+        subtotal=column(Sum(ExpressionWrapper(F('price') * F('quantity'), output_field=MONEY)), MONEY),
+        total=column(Sum('total'), MONEY),
+        updated_at=timezone.now(),
+    )
+
+
+def cart_summary(user):
+    # Single row read, built on first use for carts that predate it
+    summary = CartSummary.objects.filter(user=user).first()
+    return summary if summary is not None else rebuild(user.pk)
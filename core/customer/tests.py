@@ -1,3 +1,1429 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from decimal import Decimal
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.renderers import JSONRenderer
+from PIL import Image as PILImage
+from rest_framework.test import APIClient
+from knox.models import AuthToken
+from .models import CustomUser, Product, CartItem, Discounts, DiscountShard, Image, ImageUpload, StockReservation, OutboxEvent
+from .checkout import checkout, OutOfStock
+from .pricing import reprice_product
+from .serializers import ProductSerializer, CartItemSerializer, DiscountSerializer
+from .redemption import redeem_coupon, shard_coupon, total_redeemed
+from .coupons import coupon_index
+from .renditions import store_renditions
+from .metrics import registry
+from .authentication import token_cache
+from .search import index_products
+from .cache import bump_catalog_version, catalog_cache_stats
+from .summary import cart_summary, rebuild
+from .reservations import sweep
+from .outbox import batches, claim, drain, enqueue, handlers, run
+from .urls import urlpatterns
+from .backends.pool import ConnectionPool, PoolTimeout, pools
+from .backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
 
-# Create your tests here.
+
+class CheckoutTests(TransactionTestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(name="Widget", price=Decimal("10.00"), stock=50)
+
+    def _buyer(self, n, quantity=1):
+        user = CustomUser.objects.create_user(email=f"buyer{n}@example.com", password=None, username=f"buyer{n}")
+        CartItem.objects.create(user=user, product=self.product, quantity=quantity, rate=self.product.price, total=self.product.price*quantity)
+        return user
+
+    def test_checkout_buys_whole_cart(self):
+        other = Product.objects.create(name="Gadget", price=Decimal("5.00"), stock=3)
+        # Redeemed when the row below was added
+        Discounts.objects.create(product=other, discount=10, coupon_code="GADGET10", allowed_users=5, used=1)
+        user = self._buyer(0, quantity=2)
+        CartItem.objects.create(user=user, product=other, quantity=3, coupon="GADGET10", rate=Decimal("4.50"), total=Decimal("13.50"))
+        _, token = AuthToken.objects.create(user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+        response = client.post("/api/cart/checkout")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["items"], 2)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 48)
+        self.assertEqual(Product.objects.get(pk=other.pk).stock, 0)
+        self.assertEqual(Discounts.objects.get(coupon_code="GADGET10").used, 1)
+        self.assertFalse(CartItem.objects.filter(user=user).exists())
+
+    def test_coupons_at_their_limit_are_bought_with(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        Discounts.objects.create(product=self.product, discount=10, coupon_code="ONCE", allowed_users=1)
+        other = Product.objects.create(name="Gadget", price=Decimal("5.00"), stock=3)
+        Discounts.objects.create(product=other, discount=20, coupon_code="ALSO", allowed_users=1)
+        user = CustomUser.objects.create_user(email="limit@example.com", password=None, username="limit")
+        _, token = AuthToken.objects.create(user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+        for product, code in ((self.product, "ONCE"), (other, "ALSO")):
+            self.assertEqual(client.post("/api/cart/add", {"product": product.pk, "quantity": 1, "coupon": code}, format="json").status_code, 200)
+        self.assertEqual(client.delete(f"/api/cart/buy/{CartItem.objects.get(user=user, product=other).pk}").status_code, 200)
+        response = client.post("/api/cart/checkout")
+
+        self.assertEqual((response.status_code, response.data["total"]), (200, Decimal("9.00")))
+        self.assertEqual(list(Discounts.objects.order_by("id").values_list("used", flat=True)), [1, 1])
+
+    def test_checkout_charges_prices_a_queued_reprice_has_not_applied(self):
+        Discounts.objects.create(product=self.product, discount=10, coupon_code="WIDGET10", allowed_users=5, used=1)
+        user = CustomUser.objects.create_user(email="early@example.com", password=None, username="early")
+        CartItem.objects.create(user=user, product=self.product, quantity=2, coupon="WIDGET10", price=Decimal("10.00"), rate=Decimal("9.00"), total=Decimal("18.00"))
+        serializer = ProductSerializer(self.product, data={"name": "Widget", "description": "Dearer", "price": "30.00", "stock": 50})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        self.assertTrue(OutboxEvent.objects.exists())
+
+        self.assertEqual(checkout(user)["total"], Decimal("54.00"))
+
+    def test_checkout_is_all_or_nothing(self):
+        other = Product.objects.create(name="Gadget", price=Decimal("5.00"), stock=1)
+        user = self._buyer(0, quantity=2)
+        CartItem.objects.create(user=user, product=other, quantity=2, rate=other.price, total=other.price*2)
+
+        with self.assertRaises(OutOfStock):
+            checkout(user)
+
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 50)
+        self.assertEqual(Product.objects.get(pk=other.pk).stock, 1)
+        self.assertEqual(CartItem.objects.filter(user=user).count(), 2)
+
+    def test_concurrent_checkouts_never_oversell(self):
+        options = {}
+        if connection.vendor == "sqlite":
+            if connection.is_in_memory_db():
+                self.skipTest("Threads need a file-backed test database to share")
+            # Writers take the file lock up front and queue on it instead of failing with "database is locked"
+            options = {"transaction_mode": "IMMEDIATE", "timeout": 60}
+        buyers = [self._buyer(n) for n in range(200)]
+        barrier = threading.Barrier(len(buyers))
+        outcomes = []
+
+        def buy(user):
+            barrier.wait()
+            try:
+                checkout(user)
+                outcomes.append("bought")
+            except OutOfStock:
+                outcomes.append("out of stock")
+            finally:
+                connection.close()
+
+        with mock.patch.dict(connection.settings_dict["OPTIONS"], options):
+            threads = [threading.Thread(target=buy, args=(user,)) for user in buyers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(outcomes.count("bought"), 50)
+        self.assertEqual(outcomes.count("out of stock"), 150)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 0)
+        self.assertEqual(CartItem.objects.count(), 150)
+
+
+class FastPathTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="lister@example.com", password=None, username="lister")
+        for n in range(3):
+            product = Product.objects.create(name=f"Item \u2028{n}", description="ünïcode", price=Decimal("9.99") * (n + 1), stock=n)
+            CartItem.objects.create(user=self.user, product=product, quantity=n + 1, coupon="", rate=product.price, total=product.price * (n + 1))
+            Discounts.objects.create(product=product, discount=5 * n, provider="shop", coupon_code=f"CODE{n}", allowed_users=10, used=n)
+        Product.objects.filter(name__endswith="1").update(updated_at=None)
+        shard_coupon(Discounts.objects.get(coupon_code="CODE2"), 3)
+        _, token = AuthToken.objects.create(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+    def assertSameBytes(self, url, serializer_class, queryset):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        rows = queryset.order_by("created_at", "id")
+        expected = JSONRenderer().render(serializer_class(rows, many=True).data)
+        self.assertEqual(JSONRenderer().render(response.data["results"]), expected)
+
+    def test_lists_match_serializers_byte_for_byte(self):
+        self.assertSameBytes("/api/products/", ProductSerializer, Product.objects.all())
+        self.assertSameBytes("/api/cart/", CartItemSerializer, CartItem.objects.filter(user=self.user))
+        self.assertSameBytes("/api/discount/", DiscountSerializer, Discounts.objects.all())
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="searcher@example.com", password=None, username="searcher")
+        _, token = AuthToken.objects.create(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.kettle = Product.objects.create(name="Steel Kettle", description="Boils water fast", price=Decimal("20.00"), stock=5)
+        self.mug = Product.objects.create(name="Café Mug", description="Goes well with a kettle", price=Decimal("5.00"), stock=5)
+
+    def search(self, query):
+        response = self.client.get("/api/products/search", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return [product["name"] for product in response.data["results"]]
+
+    def test_ranked_prefix_search(self):
+        self.assertEqual(self.search("kettle"), ["Steel Kettle", "Café Mug"])
+        self.assertEqual(self.search("ket"), ["Steel Kettle", "Café Mug"])
+        self.assertEqual(self.search("CAFE mu"), ["Café Mug"])
+        self.assertEqual(self.search("kettle water"), ["Steel Kettle"])
+        self.assertEqual(self.search("teapot"), [])
+
+    def test_index_follows_product_changes(self):
+        self.kettle.name = "Copper Pot"
+        self.kettle.save()
+        self.assertEqual(self.search("steel"), [])
+        self.assertEqual(self.search("copper"), ["Copper Pot"])
+
+        self.mug.delete()
+        self.assertEqual(self.search("mug"), [])
+        self.assertEqual(self.client.get("/api/products/search").status_code, 400)
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        user = CustomUser.objects.create_user(email="pager@example.com", password=None, username="pager")
+        _, token = AuthToken.objects.create(user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        # Ties on price and on created_at, only the id tells the rows apart
+        created_at = timezone.now()
+        Product.objects.bulk_create(
+            Product(name=f"P{n}", price=Decimal("5.00") if n % 2 else Decimal("7.00"), stock=1, created_at=created_at) for n in range(7)
+        )
+        self.ids = list(Product.objects.order_by("id").values_list("id", flat=True))
+
+    def page(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [product["id"] for product in response.data["results"]], response.data["next"], response.data["previous"]
+
+    def walk(self, params):
+        ids, url, _ = self.page("/api/products/", params)
+        pages = [ids]
+        while url is not None:
+            ids, url, _ = self.page(url)
+            pages.append(ids)
+        return pages
+
+    def test_pages_cover_equal_keys_once_in_order(self):
+        pages = self.walk({"page_size": 2})
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(sum(pages, []), self.ids)
+
+        by_price = sum(self.walk({"sort": "price", "page_size": 3}), [])
+        self.assertEqual(by_price, self.ids[1::2] + self.ids[0::2])
+        self.assertEqual(sum(self.walk({"sort": "-price", "page_size": 3}), []), list(reversed(by_price)))
+
+    def test_previous_links_lead_back_to_the_same_pages(self):
+        first, url, previous = self.page("/api/products/", {"sort": "price", "page_size": 3})
+        self.assertIsNone(previous)
+        second, url, previous = self.page(url)
+        third, _, _ = self.page(url)
+
+        self.assertEqual(self.page(previous)[0], first)
+        # A row added meanwhile shifts no page
+        Product.objects.create(name="P7", price=Decimal("1.00"), stock=1)
+        back, _, previous = self.page(self.page(url)[2])
+        self.assertEqual(back, second)
+        self.assertEqual(self.page(previous)[0], first)
+
+    def test_tampered_cursors_are_refused(self):
+        for cursor in ("not-base64!", "cD1ub3QtYS1kYXRlfDE=", "cD0xMi41MA=="):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get("/api/products/", {"cursor": cursor}).status_code, 404)
+
+
+class ProductFilterTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = CustomUser.objects.create_user(email="filterer@example.com", password=None, username="filterer")
+        _, token = AuthToken.objects.create(user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        for n, price in enumerate(["5.00", "12.50", "12.50", "30.00", "99.99"]):
+            Product.objects.create(name=f"P{n}", price=Decimal(price), stock=n % 2)
+        Product.objects.filter(name__in=["P3", "P4"]).update(updated_at=timezone.now())
+
+    def names(self, params, url="/api/products/"):
+        names = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            names += [product["name"] for product in data["results"]]
+            if data["next"] is None:
+                return names
+            response = self.client.get(data["next"])
+
+    def test_filters_and_sorting(self):
+        self.assertEqual(self.names({"sort": "-price", "page_size": 2}), ["P4", "P3", "P2", "P1", "P0"])
+        self.assertEqual(self.names({"sort": "price", "min_price": "10", "max_price": "30", "page_size": 1}), ["P1", "P2", "P3"])
+        self.assertEqual(self.names({"in_stock": "true"}), ["P1", "P3"])
+        self.assertEqual(self.names({"updated_after": "2000-01-01T00:00:00Z", "sort": "-created"}), ["P4", "P3"])
+        self.assertEqual(self.client.get("/api/products/", {"sort": "stock"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/products/", {"min_price": "cheap"}).status_code, 400)
+
+    def test_async_list_filters_and_sorts_alike(self):
+        for params in (
+            {"sort": "-price", "page_size": 2},
+            {"sort": "price", "min_price": "10", "max_price": "30", "page_size": 1},
+            {"in_stock": "true"},
+            {"updated_after": "2000-01-01T00:00:00Z", "sort": "-created"},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.names(params, "/api/async/products/"), self.names(params))
+        self.assertEqual(self.client.get("/api/async/products/", {"sort": "stock"}).status_code, 400)
+
+    @skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN output is SQLite's")
+    def test_query_plans_use_indexes(self):
+        own_window = {
+            "created": {"created_after": "2000-01-01T00:00:00Z", "created_before": "2100-01-01T00:00:00Z"},
+            "price": {"min_price": "10", "max_price": "50"},
+        }
+        for sort in ("created", "-created", "price", "-price"):
+            # Pages an index hands out in sort order: searched, never sorted
+            for params in ({}, {"in_stock": "true"}, own_window[sort.lstrip("-")]):
+                for page, plan in self.plans(sort, params):
+                    with self.subTest(sort=sort, params=params, page=page):
+                        if not params and page == "first":
+                            # Nothing to search for, the sort index is walked until the page is full
+                            self.assertEqual(len(plan), 1)
+                            self.assertRegex(plan[0], r"^SCAN customer_product USING (COVERING )?INDEX product_(created_id|price_id)_idx$")
+                        else:
+                            self.assertEqual(len(plan), 1, plan)
+                            self.assertRegex(plan[0], r"^SEARCH customer_product USING (COVERING )?INDEX \S+ \(")
+
+            # A range on another column than the sort is searched in that column's index, and what it finds is sorted
+            others = [window for column, window in own_window.items() if column != sort.lstrip("-")] + [{"updated_after": "2000-01-01T00:00:00Z"}]
+            for params in others:
+                for page, plan in self.plans(sort, params):
+                    with self.subTest(sort=sort, params=params, page=page):
+                        self.assertRegex(plan[0], r"^SEARCH customer_product USING (COVERING )?INDEX \S+ \(")
+                        self.assertTrue(all(line == "USE TEMP B-TREE FOR ORDER BY" for line in plan[1:]), plan)
+
+    def plans(self, sort, params):
+        first = self.client.get("/api/products/", {**params, "sort": sort, "page_size": 1})
+        return [("first", self.plan({**params, "sort": sort, "page_size": 1})), ("next", self.plan(first.data["next"]))]
+
+    def plan(self, request):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            if isinstance(request, str):
+                self.client.get(request)
+            else:
+                self.client.get("/api/products/", request)
+        page = [query["sql"] for query in queries if 'FROM "customer_product"' in query["sql"] and "LIMIT" in query["sql"]]
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + page[0])
+            return [row[-1] for row in cursor.fetchall()]
+
+
+class RenditionTests(TestCase):
+
+    def setUp(self):
+        self.media = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media, RENDITION_ROOT=self.media / "renditions", IMAGE_UPLOAD_ROOT=self.media / "uploads", RENDITION_WORKERS=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.product = Product.objects.create(name="Poster", price=Decimal("8.00"), stock=3)
+
+    def picture(self):
+        picture = io.BytesIO()
+        PILImage.new("RGB", (1200, 600), "teal").save(picture, "PNG")
+        picture.seek(0)
+        picture.name = "poster.png"
+        return picture
+
+    def upload(self):
+        picture = self.picture()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"/api/products/{self.product.pk}/images", {"image": picture}, format="multipart")
+        self.assertEqual(response.status_code, 201)
+
+    def test_renditions_are_content_addressed_and_listed(self):
+        self.upload()
+        self.upload()
+        first, second = Image.objects.order_by("id")
+        self.assertEqual(first.renditions, second.renditions)
+        self.assertEqual(set(first.renditions), {"160", "480", "1024"})
+        with PILImage.open(self.media / "renditions" / first.renditions["160"]["webp"]) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ("WEBP", (160, 80)))
+
+        product = self.client.get(f"/api/products/{self.product.pk}").data
+        self.assertEqual(len(product["images"]), 2)
+        self.assertTrue(product["images"][0]["renditions"]["480"]["jpeg"].startswith("/media/renditions/"))
+        self.assertEqual(self.client.get("/api/products/").data["results"][0]["images"], product["images"])
+
+    def test_product_lists_read_their_images_with_one_query(self):
+        for n in range(5):
+            product = Product.objects.create(name=f"Print {n}", price=Decimal("4.00"), stock=1)
+            Image.objects.create(product=product, image=f"photos/print{n}.png", renditions={"160": {"webp": f"print{n}.webp"}})
+        products = Product.objects.order_by("id")
+        expected = [ProductSerializer(product).data for product in products]
+
+        # The products, then their images
+        with self.assertNumQueries(2):
+            listed = ProductSerializer(products.all(), many=True).data
+        self.assertEqual(listed, expected)
+        self.assertEqual(listed[0]["images"], [])
+        self.assertEqual(len(listed[1]["images"]), 1)
+
+    def put_chunk(self, upload, data, offset):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.put(
+                f"/api/products/images/uploads/{upload}", data, content_type="application/offset+octet-stream", HTTP_UPLOAD_OFFSET=str(offset)
+            )
+
+    def test_chunked_upload_resumes_and_deduplicates(self):
+        data = self.picture().getvalue()
+        upload = self.client.post(f"/api/products/{self.product.pk}/images/uploads", {"size": len(data)}, format="json").data["upload"]
+        half = len(data) // 2
+
+        self.assertEqual(self.put_chunk(upload, data[:half], 0).data["offset"], half)
+        # A retried chunk is refused with the offset to resume from
+        retried = self.put_chunk(upload, data[:half], 0)
+        self.assertEqual((retried.status_code, retried.data["offset"]), (409, half))
+        self.assertEqual(self.client.get(f"/api/products/images/uploads/{upload}").data["offset"], half)
+        done = self.put_chunk(upload, data[half:], half)
+        self.assertEqual((done.status_code, done.data["deduplicated"]), (201, False))
+
+        image = Image.objects.get(pk=done.data["id"])
+        self.assertEqual(image.sha256, hashlib.sha256(data).hexdigest())
+        self.assertTrue(image.renditions)
+        self.assertEqual(os.listdir(self.media / "uploads"), [])
+
+        # Known content is attached without sending it again, sharing file and renditions
+        again = self.client.post(f"/api/products/{self.product.pk}/images/uploads", {"size": len(data), "sha256": image.sha256}, format="json")
+        self.assertEqual((again.status_code, again.data["deduplicated"]), (201, True))
+        copy = Image.objects.get(pk=again.data["id"])
+        self.assertEqual((copy.image.name, copy.renditions), (image.image.name, image.renditions))
+
+
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.product = Product.objects.create(name="Poster", price=Decimal("8.00"), stock=3)
+
+    def assertRevalidates(self, url, change):
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_new_renditions_change_the_product_etag(self):
+        image = Image.objects.create(product=self.product, image="photos/poster.png")
+
+        self.assertRevalidates(f"/api/products/{self.product.pk}", lambda: store_renditions(image.pk, {"160": {"webp": "a/poster.webp"}}))
+        self.assertRevalidates("/api/products/", lambda: store_renditions(image.pk, {"480": {"webp": "b/poster.webp"}}))
+
+    def test_sharded_redemptions_change_the_discount_etag(self):
+        discount = Discounts.objects.create(product=self.product, discount=10, coupon_code="POSTER10", allowed_users=10)
+        shard_coupon(discount, 2)
+
+        def redeem():
+            self.assertTrue(redeem_coupon(coupon_index.lookup(self.product.pk, "POSTER10")))
+
+        self.assertRevalidates(f"/api/discount/retrieve/{discount.pk}", redeem)
+        self.assertRevalidates("/api/discount/", redeem)
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.buyer = CustomUser.objects.create_user(email="shopper@example.com", password=None, username="shopper")
+        self.product = Product.objects.create(name="Teapot", description="Cast iron", price=Decimal("25.00"), stock=4)
+
+    def get(self, url):
+        before = catalog_cache_stats()
+        data = self.client.get(url).data
+        after = catalog_cache_stats()
+        return data, after["hits"] - before["hits"], after["misses"] - before["misses"]
+
+    def test_checkout_keeps_the_cache_and_product_edits_drop_it(self):
+        url = f"/api/products/{self.product.pk}"
+        self.assertEqual(self.get(url)[1:], (0, 1))
+        self.assertEqual(self.get(url)[1:], (1, 0))
+        self.assertEqual(self.get("/api/products/?in_stock=true")[1:], (0, 1))
+
+        CartItem.objects.create(user=self.buyer, product=self.product, quantity=4, price=self.product.price, rate=self.product.price, total=self.product.price * 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout(self.buyer)
+
+        # Still served from the cache, with the stock as it is now
+        data, hits, misses = self.get(url)
+        self.assertEqual((data["stock"], hits, misses), (0, 1, 0))
+        self.assertEqual(self.get("/api/products/")[0]["results"][0]["stock"], 0)
+        # A page picked by stock is not
+        data, hits, misses = self.get("/api/products/?in_stock=true")
+        self.assertEqual((data["results"], hits, misses), ([], 0, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(f"/api/products/update/{self.product.pk}", {"name": "Teapot", "description": "Enamelled", "price": "25.00", "stock": 4}, format="json")
+        self.assertEqual(response.status_code, 200)
+        data, hits, misses = self.get(url)
+        self.assertEqual((data["description"], data["stock"], hits, misses), ("Enamelled", 4, 0, 1))
+
+
+class ProductImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(self.admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.lamp = Product.objects.create(name="Desk lamp", description="Warm", price=Decimal("10.00"), stock=5)
+
+    def upload(self, name, content):
+        response = self.client.post("/api/products/import", {"file": SimpleUploadedFile(name, content.encode())}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_malformed_rows_are_reported_by_line(self):
+        report = self.upload("products.ndjson", "\n".join([
+            '{"name": "Rug", "description": "Wool", "price": "20.00", "stock": 3}',
+            '{"name": "Broken", ',
+            '["Not", "an", "object"]',
+            '{"name": "Vase", "description": "Glass", "price": "cheap", "stock": 1}',
+            '{"name": "Mug", "description": "Tall", "price": "4.00", "stock": -1}',
+        ]))
+
+        self.assertEqual((report["rows"], report["imported"], report["failed"]), (5, 1, 4))
+        self.assertEqual([error["line"] for error in report["errors"]], [2, 3, 4, 5])
+        self.assertIn("price", report["errors"][2]["errors"])
+        self.assertEqual(sorted(Product.objects.values_list("name", flat=True)), ["Desk lamp", "Rug"])
+
+    def test_existing_names_are_updated_in_place(self):
+        report = self.upload("products.csv", "name,description,price,stock\nDesk lamp,Bright,10.00,9\nRug,Wool,20.00,3\n")
+
+        self.assertEqual((report["imported"], report["failed"]), (2, 0))
+        self.assertEqual(Product.objects.count(), 2)
+        lamp = Product.objects.get(pk=self.lamp.pk)
+        self.assertEqual((lamp.description, lamp.stock), ("Bright", 9))
+        self.assertIsNotNone(lamp.updated_at)
+        # The price stayed, nothing to reprice
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_price_changes_reprice_carts_through_the_outbox(self):
+        Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=5)
+        item = CartItem.objects.create(user=self.admin, product=self.lamp, quantity=2, coupon="LAMP10", price=Decimal("10.00"), rate=Decimal("9.00"), total=Decimal("18.00"))
+
+        self.upload("products.csv", "name,description,price,stock\nDesk lamp,Warm,30.00,5\n")
+        self.assertEqual(list(OutboxEvent.objects.values_list("topic", "payload")), [("reprice_product", {"product_id": self.lamp.pk})])
+        self.assertEqual(CartItem.objects.get(pk=item.pk).total, Decimal("18.00"))
+
+        self.assertEqual(drain(), (1, 0))
+        item = CartItem.objects.get(pk=item.pk)
+        self.assertEqual((item.price, item.rate, item.total), (Decimal("30.00"), Decimal("27.00"), Decimal("54.00")))
+        self.assertEqual(cart_summary(self.admin).total, Decimal("54.00"))
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=10)
+        self.rug = Product.objects.create(name="Wool rug", price=Decimal("20.00"), stock=10)
+        self.discount = Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=10)
+        self.items = [
+            CartItem.objects.create(user=admin, product=product, quantity=1, price=product.price, rate=product.price, total=product.price)
+            for product in (self.lamp, self.rug)
+        ]
+
+    def export(self, name, since):
+        response = self.client.get(f"/api/export/{name}", {"since": since.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()], parse_datetime(response["X-Export-Watermark"])
+
+    def test_repriced_cart_rows_are_exported_since_the_watermark(self):
+        _, watermark = self.export("carts", timezone.now())
+        Product.objects.filter(pk=self.lamp.pk).update(price=Decimal("12.00"))
+        reprice_product(Product.objects.get(pk=self.lamp.pk))
+
+        rows, _ = self.export("carts", watermark)
+        self.assertEqual([(row["id"], row["price"], row["total"]) for row in rows], [(self.items[0].pk, "12.00", "12.00")])
+
+    def test_sharded_redemptions_are_exported_since_the_watermark(self):
+        shard_coupon(self.discount, 2)
+        _, watermark = self.export("discounts", timezone.now())
+        for _ in range(3):
+            self.assertTrue(redeem_coupon(coupon_index.lookup(self.lamp.pk, "LAMP10")))
+
+        rows, _ = self.export("discounts", watermark)
+        self.assertEqual([(row["id"], row["used"]) for row in rows], [(self.discount.pk, 3)])
+
+
+class CouponIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        admin = CustomUser.objects.create_superuser(email="admin@example.com", password=None, username="admin")
+        _, token = AuthToken.objects.create(admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.product = Product.objects.create(name="Kettle", price=Decimal("30.00"), stock=5)
+        self.expiry = (timezone.now() + timezone.timedelta(days=1)).isoformat()
+        # Built before the changes below, as a worker's index would be
+        self.assertIsNone(coupon_index.lookup(self.product.pk, "KETTLE10"))
+
+    def send(self, method, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(url, data, format="json")
+        self.assertEqual(response.status_code // 100, 2)
+        return response
+
+    def test_lookup_follows_create_update_and_delete(self):
+        data = {"product": self.product.pk, "discount": 10, "provider": "shop", "coupon_code": "KETTLE10", "allowed_users": 5, "expiry": self.expiry}
+        pk = self.send("post", "/api/discount/create", data).data["id"]
+        self.assertEqual(coupon_index.lookup(self.product.pk, "KETTLE10").discount, 10)
+
+        self.send("put", f"/api/discount/update/{pk}", dict(data, discount=25, coupon_code="KETTLE25"))
+        self.assertIsNone(coupon_index.lookup(self.product.pk, "KETTLE10"))
+        self.assertEqual(coupon_index.lookup(self.product.pk, "KETTLE25").discount, 25)
+
+        self.send("delete", f"/api/discount/delete/{pk}")
+        self.assertIsNone(coupon_index.lookup(self.product.pk, "KETTLE25"))
+
+    def test_changes_that_skipped_the_version_show_up_after_the_ttl(self):
+        with override_settings(COUPON_INDEX_TTL=0):
+            coupon_index.invalidate()
+            self.assertIsNone(coupon_index.lookup(self.product.pk, "KETTLE10"))
+            # Written behind the serializers' back, the coupon version stays put
+            Discounts.objects.create(product=self.product, discount=10, coupon_code="KETTLE10", allowed_users=5)
+            self.assertEqual(coupon_index.lookup(self.product.pk, "KETTLE10").discount, 10)
+
+
+class PerformanceMetricsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.admin = CustomUser.objects.create_user(email="ops@example.com", password=None, username="ops", is_staff=True)
+        _, token = AuthToken.objects.create(self.admin)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        Product.objects.create(name="Gauge", price=Decimal("3.00"), stock=1)
+
+    def test_server_timing_and_route_histograms(self):
+        response = self.client.get("/api/products/")
+        timing = dict(part.split(";", 1) for part in response["Server-Timing"].split(", "))
+        self.assertEqual(set(timing), {"db", "auth", "serializer", "total"})
+        queries = int(timing["db"].split('desc="')[1].split()[0])
+        self.assertGreater(queries, 0)
+
+        metrics = self.client.get("/api/metrics")
+        self.assertEqual(metrics["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        text = metrics.content.decode()
+        self.assertIn('api_responses_total{route="product_list",status="200"} 1', text)
+        self.assertIn(f'api_request_queries_sum{{route="product_list"}} {float(queries)}', text)
+        self.assertIn('api_request_duration_seconds_count{route="product_list"} 1', text)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every route answers within a fixed number of queries however many rows
+    the store holds. A route that starts querying per row, or a new route
+    without a budget, fails here.
+    """
+
+    SIZES = (10, 1000)
+
+    # Most queries a request may run, by URL name. Caches are cleared before
+    # each request, so these are the cold costs.
+    BUDGETS = {
+        "schema-json": 0,
+        "schema-swagger-ui": 0,
+        "schema-redoc": 0,
+        "register": 3,
+        "knox_login": 11,
+        "knox_logout": 3,
+        "knox_logoutall": 4,
+        "product_create": 8,
+        "product_list": 6,
+        "product_retrieve": 6,
+        "product_search": 8,
+        "product_update": 12,
+        "product_delete": 15,
+        "product_import": 11,
+        "product_image_upload": 9,
+        "image_upload_start": 6,
+        "image_upload": 3,
+        "product_cache_stats": 2,
+        "metrics": 2,
+        "cart_add": 13,
+        "cart_add_bulk": 18,
+        "cart_list": 3,
+        "cart_summary": 3,
+        "cart_retrieve": 4,
+        "cart_update": 15,
+        "cart_delete": 9,
+        "cart_buy": 14,
+        "cart_checkout": 14,
+        "discount_view": 4,
+        "discount_create": 6,
+        "discount_update": 9,
+        "discount_retrieve": 5,
+        "discount_delete": 5,
+        "discount_product": 4,
+        "export": 3,
+        "async_product_list": 4,
+        "async_product_retrieve": 4,
+        "async_cart_list": 3,
+        "async_cart_retrieve": 3,
+        "async_discount_view": 3,
+        "async_discount_product": 3,
+    }
+
+    def setUp(self):
+        media = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = override_settings(
+            MEDIA_ROOT=media, RENDITION_ROOT=media / "renditions", IMAGE_UPLOAD_ROOT=media / "uploads", RENDITION_WORKERS=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def populate(self, size):
+        """
+        `size` products, each with a discount and an image, in the cart of a
+        staff user but for the last five, which are left to be added.
+        """
+        self.user = CustomUser.objects.create_user(email="budget@example.com", password="budget-pass", username="budget", is_staff=True)
+        products = Product.objects.bulk_create(
+            Product(name=f"Budget lamp {n}", description="Warm light", price=Decimal("10.00"), stock=1000) for n in range(size)
+        )
+        index_products(products)
+        discounts = Discounts.objects.bulk_create(
+            Discounts(product=product, discount=10, provider="shop", coupon_code=f"LAMP{n}", allowed_users=1000,
+                      expiry=timezone.now() + timezone.timedelta(days=30))
+            for n, product in enumerate(products)
+        )
+        Image.objects.bulk_create(Image(product=product, image=f"photos/lamp{n}.png") for n, product in enumerate(products))
+        items = CartItem.objects.bulk_create(
+            CartItem(user=self.user, product=product, quantity=1, coupon=f"LAMP{n}", rate=Decimal("9.00"), total=Decimal("9.00"))
+            for n, product in enumerate(products[:-5])
+        )
+        # Checkout runs a conditional UPDATE per line it buys, so the buyer's cart stays small
+        self.buyer = CustomUser.objects.create_user(email="buyer@example.com", password=None, username="buyer")
+        CartItem.objects.bulk_create(CartItem(user=self.buyer, product=product, quantity=1, rate=product.price, total=product.price) for product in products[:3])
+        upload = ImageUpload.objects.create(product=products[0], user=self.user, size=100)
+        rebuild(self.user.pk)
+        rebuild(self.buyer.pk)
+        return products, discounts, items, upload
+
+    def requests(self, products, discounts, items, upload):
+        # (URL name, URL kwargs, method, request arguments, user), the ones that delete come last
+        picture = io.BytesIO()
+        PILImage.new("RGB", (32, 32), "olive").save(picture, "PNG")
+        picture.seek(0)
+        picture.name = "lamp.png"
+        rows = io.BytesIO(b"".join(f"Imported lamp {n},Bright,12.00,5\n".encode() for n in range(10)))
+        rows.name = "products.csv"
+        header = io.BytesIO(b"name,description,price,stock\n" + rows.getvalue())
+        header.name = rows.name
+        expiry = (timezone.now() + timezone.timedelta(days=30)).isoformat()
+        return [
+            ("schema-json", {"format": ".json"}, "get", {}, None),
+            ("schema-swagger-ui", {}, "get", {}, None),
+            ("schema-redoc", {}, "get", {}, None),
+            ("register", {}, "post", {"data": {"username": "newcomer", "email": "newcomer@example.com", "password": "pass-word-1"}, "format": "json"}, None),
+            ("knox_login", {}, "post", {"data": {"username": "budget@example.com", "password": "budget-pass"}, "format": "json"}, None),
+            ("product_create", {}, "post", {"data": {"name": "Fresh lamp", "description": "New", "price": "15.00", "stock": 4}, "format": "json"}, "user"),
+            ("product_list", {}, "get", {}, "user"),
+            ("product_retrieve", {"pk": products[0].pk}, "get", {}, "user"),
+            ("product_search", {}, "get", {"data": {"q": "lamp"}}, "user"),
+            ("product_update", {"pk": products[1].pk}, "put", {"data": {"name": "Renamed lamp", "description": "Warm light", "price": "11.00", "stock": 900}, "format": "json"}, "user"),
+            ("product_import", {}, "post", {"data": {"file": header}, "format": "multipart"}, "user"),
+            ("product_image_upload", {"pk": products[0].pk}, "post", {"data": {"image": picture}, "format": "multipart"}, "user"),
+            ("image_upload_start", {"pk": products[0].pk}, "post", {"data": {"size": 1000}, "format": "json"}, "user"),
+            ("image_upload", {"pk": upload.pk}, "get", {}, "user"),
+            ("product_cache_stats", {}, "get", {}, "user"),
+            ("metrics", {}, "get", {}, "user"),
+            ("cart_add", {}, "post", {"data": {"product": products[-1].pk, "quantity": 1, "coupon": discounts[-1].coupon_code}, "format": "json"}, "user"),
+            ("cart_add_bulk", {}, "post", {"data": [
+                {"product": product.pk, "quantity": 1, "coupon": discount.coupon_code} for product, discount in zip(products[-5:-1], discounts[-5:-1])
+            ], "format": "json"}, "user"),
+            ("cart_list", {}, "get", {}, "user"),
+            ("cart_summary", {}, "get", {}, "user"),
+            ("cart_retrieve", {"pk": items[0].pk}, "get", {}, "user"),
+            ("cart_update", {"pk": items[3].pk}, "put", {"data": {"product": products[3].pk, "quantity": 2, "coupon": discounts[3].coupon_code}, "format": "json"}, "user"),
+            ("discount_view", {}, "get", {}, "user"),
+            ("discount_create", {}, "post", {"data": {"product": products[0].pk, "discount": 5, "provider": "shop", "coupon_code": "NEWLAMP", "allowed_users": 10, "expiry": expiry}, "format": "json"}, "user"),
+            ("discount_update", {"pk": discounts[4].pk}, "put", {"data": {"product": products[4].pk, "discount": 20, "provider": "shop", "coupon_code": "LAMP4", "allowed_users": 1000, "expiry": expiry}, "format": "json"}, "user"),
+            ("discount_retrieve", {"pk": discounts[0].pk}, "get", {}, "user"),
+            ("discount_product", {"pk": products[0].pk}, "get", {}, "user"),
+            ("export", {"name": "products"}, "get", {}, "user"),
+            ("async_product_list", {}, "get", {}, "user"),
+            ("async_product_retrieve", {"pk": products[0].pk}, "get", {}, "user"),
+            ("async_cart_list", {}, "get", {}, "user"),
+            ("async_cart_retrieve", {"pk": items[0].pk}, "get", {}, "user"),
+            ("async_discount_view", {}, "get", {}, "user"),
+            ("async_discount_product", {"pk": products[0].pk}, "get", {}, "user"),
+            ("cart_buy", {"pk": items[1].pk}, "delete", {}, "user"),
+            ("cart_checkout", {}, "post", {}, "buyer"),
+            ("cart_delete", {"pk": items[2].pk}, "delete", {}, "user"),
+            ("discount_delete", {"pk": discounts[1].pk}, "delete", {}, "user"),
+            ("product_delete", {"pk": products[2].pk}, "delete", {}, "user"),
+            ("knox_logout", {}, "post", {}, "user"),
+            ("knox_logoutall", {}, "post", {}, "user"),
+        ]
+
+    def queries(self, name, kwargs, method, arguments, user):
+        # Caches and the token logged out with are set up outside the count
+        cache.clear()
+        token_cache.clear()
+        client = APIClient()
+        if user is not None:
+            _, token = AuthToken.objects.create(getattr(self, user))
+            client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            response = getattr(client, method)(reverse(name, kwargs=kwargs), **arguments)
+            if response.streaming:
+                b"".join(response.streaming_content)
+        self.assertLess(response.status_code, 400, f"{name}: {getattr(response, 'data', response.status_code)}")
+        return count[0]
+
+    def test_every_route_has_a_budget(self):
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(self.BUDGETS))
+
+    def test_routes_stay_within_budget_as_data_grows(self):
+        for size in self.SIZES:
+            with transaction.atomic():
+                for name, *request in self.requests(*self.populate(size)):
+                    with self.subTest(route=name, rows=size):
+                        self.assertLessEqual(self.queries(name, *request), self.BUDGETS[name])
+                transaction.set_rollback(True)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def ping(connection):
+    if not connection.alive:
+        raise OSError("gone away")
+
+
+class TokenCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(token_cache.clear)
+        self.user = CustomUser.objects.create_user(email="keyholder@example.com", password=None, username="keyholder")
+
+    def client_for(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.assertEqual(client.get("/api/cart/").status_code, 200)
+        return client
+
+    def cached_entries(self):
+        # What another worker still holds after this one dropped its copies
+        with token_cache._lock:
+            return dict(token_cache._entries)
+
+    def restore(self, entries):
+        with token_cache._lock:
+            token_cache._entries.update(entries)
+
+    def test_logout_revokes_a_cached_token(self):
+        _, token = AuthToken.objects.create(self.user)
+        _, other = AuthToken.objects.create(self.user)
+        client, bystander = self.client_for(token), self.client_for(other)
+        entries = self.cached_entries()
+
+        self.assertEqual(client.post("/api/logout/").status_code, 204)
+        self.restore(entries)
+
+        self.assertEqual(client.get("/api/cart/").status_code, 401)
+        self.assertEqual(bystander.get("/api/cart/").status_code, 200)
+
+    def test_logoutall_revokes_every_cached_token(self):
+        clients = [self.client_for(AuthToken.objects.create(self.user)[1]) for _ in range(2)]
+        entries = self.cached_entries()
+
+        self.assertEqual(clients[0].post("/api/logoutall/").status_code, 204)
+        self.restore(entries)
+
+        for client in clients:
+            self.assertEqual(client.get("/api/cart/").status_code, 401)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def test_caps_waits_and_times_out(self):
+        pool = ConnectionPool(max_size=2, timeout=0.05, check=ping)
+        first = pool.acquire(FakeConnection)
+        pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+
+        threading.Timer(0.02, pool.release, [first]).start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(FakeConnection), first)
+        stats = pool.snapshot()
+        self.assertEqual((stats["opened"], stats["checkouts"], stats["timeouts"], stats["waits"]), (2, 3, 1, 2))
+        self.assertGreater(stats["max_wait_seconds"], 0.01)
+
+    def test_health_check_lifetime_and_min_size(self):
+        pool = ConnectionPool(min_size=1, max_size=3, max_lifetime=0.05, check=ping)
+        pool.fill(FakeConnection)
+        connection = pool.acquire(FakeConnection)
+        self.assertEqual(pool.snapshot()["opened"], 1)
+
+        # A connection that died while idle is replaced
+        connection.alive = False
+        pool.release(connection)
+        replacement = pool.acquire(FakeConnection)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(replacement, connection)
+
+        # Past its lifetime a connection is closed instead of pooled
+        time.sleep(0.06)
+        pool.release(replacement)
+        self.assertTrue(replacement.closed)
+        self.assertEqual(pool.snapshot()["failed_checks"], 1)
+        self.assertEqual(pool.snapshot()["size"], 0)
+
+    def test_pooled_backend_reuses_driver_connections(self):
+        path = Path(tempfile.mkdtemp()) / "pooled.sqlite3"
+        self.addCleanup(shutil.rmtree, path.parent)
+        settings_dict = dict(connection.settings_dict, ENGINE="customer.backends.sqlite3", NAME=path, POOL={"MAX_SIZE": 2})
+        self.addCleanup(pools.pop, ("pooled", str(path)), None)
+
+        first = SQLiteDatabaseWrapper(settings_dict, alias="pooled")
+        first.ensure_connection()
+        driver_connection = first.connection
+        first.close()
+        second = SQLiteDatabaseWrapper(settings_dict, alias="pooled")
+        with second.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertIs(second.connection, driver_connection)
+
+        # Closed inside a transaction, the connection is not handed out again
+        second.set_autocommit(False)
+        second.close()
+        third = SQLiteDatabaseWrapper(settings_dict, alias="pooled")
+        third.ensure_connection()
+        self.assertIsNot(third.connection, driver_connection)
+        third.close()
+        self.assertEqual(pools["pooled", str(path)].snapshot()["opened"], 2)
+
+    def test_pooled_backend_refuses_in_memory_databases(self):
+        for name in (":memory:", "file:memorydb_default?mode=memory&cache=shared"):
+            settings_dict = dict(connection.settings_dict, ENGINE="customer.backends.sqlite3", NAME=name)
+            with self.subTest(name=name), self.assertRaises(ImproperlyConfigured):
+                SQLiteDatabaseWrapper(settings_dict, alias="pooled").ensure_connection()
+        self.assertNotIn(("pooled", ":memory:"), pools)
+
+
+@skipUnless(connection.vendor == "sqlite", "The replica is a copy of the SQLite test database")
+class ReplicaRoutingTests(TransactionTestCase):
+
+    def setUp(self):
+        # A second SQLite database standing in for a replica, filled by replicate()
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        primary = connections["default"]
+        connections["replica"] = type(primary)(dict(primary.settings_dict, NAME=str(directory / "replica.sqlite3")), alias="replica")
+        self.addCleanup(connections.__delitem__, "replica")
+        self.addCleanup(connections["replica"].close)
+        self.addCleanup(cache.clear)
+        cache.clear()
+        token_cache.clear()
+        settings_override = override_settings(DATABASE_REPLICAS=["replica"], REPLICA_STICKY_SECONDS=60)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = CustomUser.objects.create_user(email="reader@example.com", password=None, username="reader")
+        self.product = Product.objects.create(name="Mirror", price=Decimal("4.00"), stock=10)
+        Discounts.objects.create(product=self.product, discount=0, provider="shop", coupon_code="MIRROR", allowed_users=10)
+        _, token = AuthToken.objects.create(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.replicate()
+
+    def replicate(self):
+        connection.ensure_connection()
+        connections["replica"].ensure_connection()
+        connection.connection.backup(connections["replica"].connection)
+
+    def cart_products(self):
+        with CaptureQueriesContext(connections["replica"]) as replica_queries:
+            response = self.client.get("/api/cart/")
+        return [item["product"] for item in response.data["results"]], len(replica_queries) > 0
+
+    def test_reads_go_to_the_replica_but_writers_read_their_writes(self):
+        self.assertEqual(self.cart_products(), ([], True))
+
+        added = self.client.post("/api/cart/add", {"product": self.product.pk, "quantity": 1, "coupon": "MIRROR"}, format="json")
+        self.assertEqual(added.status_code, 200)
+        # The replica has not caught up, the writer reads from the primary
+        self.assertEqual(self.cart_products(), ([self.product.pk], False))
+
+        # Once the window is over reads go back to the (still lagging) replica
+        cache.clear()
+        self.assertEqual(self.cart_products(), ([], True))
+        self.replicate()
+        self.assertEqual(self.cart_products(), ([self.product.pk], True))
+
+
+    def test_catalog_cache_is_filled_from_the_primary(self):
+        Product.objects.filter(pk=self.product.pk).update(price=Decimal("9.00"))
+        bump_catalog_version()
+
+        # The replica still has the old price, the cached payload must not
+        for _ in range(2):
+            self.assertEqual(self.client.get(f"/api/products/{self.product.pk}").data["price"], "9.00")
+        self.assertEqual(Product.objects.using("replica").get(pk=self.product.pk).price, Decimal("4.00"))
+
+class CartSummaryTests(TestCase):
+
+    def setUp(self):
+        # The coupon index reloads once the version it was built at is gone
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = CustomUser.objects.create_user(email="summer@example.com", password=None, username="summer")
+        _, token = AuthToken.objects.create(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=10)
+        self.rug = Product.objects.create(name="Wool rug", price=Decimal("20.00"), stock=10)
+        Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=5)
+        Discounts.objects.create(product=self.rug, discount=50, coupon_code="RUG50", allowed_users=5)
+
+    def assertSummary(self, items, quantity, subtotal, total):
+        cart = CartItem.objects.filter(user=self.user)
+        self.assertEqual(
+            (items, quantity, Decimal(subtotal), Decimal(total)),
+            (cart.count(), sum(item.quantity for item in cart), sum((item.price * item.quantity for item in cart), Decimal(0)), sum((item.total for item in cart), Decimal(0))),
+        )
+        response = self.client.get("/api/cart/summary")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            (response.data["items"], response.data["quantity"], response.data["subtotal"], response.data["savings"], response.data["total"]),
+            (items, quantity, Decimal(subtotal), Decimal(subtotal) - Decimal(total), Decimal(total)),
+        )
+
+    def test_summary_follows_every_cart_write(self):
+        self.assertSummary(0, 0, "0", "0")
+        with self.assertNumQueries(1):
+            cart_summary(self.user)
+
+        self.client.post("/api/cart/add", {"product": self.lamp.pk, "quantity": 2, "coupon": "LAMP10"}, format="json")
+        self.assertSummary(1, 2, "20.00", "18.00")
+        self.client.post("/api/cart/add/bulk", [{"product": self.rug.pk, "quantity": 1, "coupon": "RUG50"}], format="json")
+        self.assertSummary(2, 3, "40.00", "28.00")
+        lamp = CartItem.objects.get(user=self.user, product=self.lamp)
+        self.client.put(f"/api/cart/update/{lamp.pk}", {"product": self.lamp.pk, "quantity": 3, "coupon": "LAMP10"}, format="json")
+        self.assertSummary(2, 4, "50.00", "37.00")
+
+        # Repricing moves every cart holding the product
+        serializer = ProductSerializer(self.rug, data={"name": "Wool rug", "description": "Thick", "price": "30.00", "stock": 10})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        drain()
+        self.assertSummary(2, 4, "60.00", "42.00")
+
+        self.client.delete(f"/api/cart/buy/{lamp.pk}")
+        self.assertSummary(1, 1, "30.00", "15.00")
+        self.user.is_staff = True
+        self.user.save()
+        self.client.delete(f"/api/products/delete/{self.rug.pk}")
+        self.assertSummary(0, 0, "0", "0")
+
+    def test_rows_left_before_a_queued_reprice_ran(self):
+        self.client.post("/api/cart/add", {"product": self.lamp.pk, "quantity": 2, "coupon": "LAMP10"}, format="json")
+        self.client.post("/api/cart/add", {"product": self.rug.pk, "quantity": 1, "coupon": "RUG50"}, format="json")
+        for product in (self.lamp, self.rug):
+            serializer = ProductSerializer(product, data={"name": product.name, "description": "New price", "price": "30.00", "stock": 10})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+
+        # Both rows leave the cart at the price they were added at, the reprice finds nothing left
+        lamp = CartItem.objects.get(user=self.user, product=self.lamp)
+        rug = CartItem.objects.get(user=self.user, product=self.rug)
+        self.client.delete(f"/api/cart/delete/{lamp.pk}")
+        self.client.delete(f"/api/cart/buy/{rug.pk}")
+        drain()
+        self.assertSummary(0, 0, "0", "0")
+
+    def test_other_users_rows_cannot_be_deleted(self):
+        self.client.post("/api/cart/add", {"product": self.lamp.pk, "quantity": 2, "coupon": "LAMP10"}, format="json")
+        lamp = CartItem.objects.get(user=self.user, product=self.lamp)
+        intruder = CustomUser.objects.create_user(email="intruder@example.com", password=None, username="intruder")
+        _, token = AuthToken.objects.create(intruder)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token)
+
+        self.assertEqual(client.delete(f"/api/cart/delete/{lamp.pk}").status_code, 404)
+        self.assertSummary(1, 2, "20.00", "18.00")
+        self.assertEqual(Product.objects.get(pk=self.lamp.pk).reserved, 2)
+
+
+class CartBulkAddTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = CustomUser.objects.create_user(email="bulker@example.com", password=None, username="bulker")
+        _, token = AuthToken.objects.create(self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token)
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=10)
+        self.rug = Product.objects.create(name="Wool rug", price=Decimal("20.00"), stock=1)
+        self.vase = Product.objects.create(name="Vase", price=Decimal("8.00"), stock=5)
+        Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=5)
+        Discounts.objects.create(product=self.rug, discount=50, coupon_code="RUG50", allowed_users=5)
+        Discounts.objects.create(product=self.vase, discount=25, coupon_code="VASE25", allowed_users=0)
+
+    def add(self, entries):
+        return self.client.post("/api/cart/add/bulk", entries, format="json")
+
+    def test_every_entry_is_added_with_one_write_per_table(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.add([
+                {"product": self.lamp.pk, "quantity": 2, "coupon": "LAMP10"},
+                {"product": self.rug.pk, "quantity": 1, "coupon": "RUG50"},
+            ])
+        self.assertEqual(response.status_code, 200)
+        inserts = [query["sql"].split()[2] for query in queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(sorted(inserts), sorted(connection.ops.quote_name(table) for table in ("customer_cartitem", "customer_stockreservation", "customer_cartsummary")))
+
+        rows = {item.product_id: (item.quantity, item.rate, item.total) for item in CartItem.objects.filter(user=self.user)}
+        self.assertEqual(rows, {self.lamp.pk: (2, Decimal("9.00"), Decimal("18.00")), self.rug.pk: (1, Decimal("10.00"), Decimal("10.00"))})
+        self.assertEqual(list(Product.objects.order_by("id").values_list("reserved", flat=True)), [2, 1, 0])
+        self.assertEqual(Discounts.objects.get(coupon_code="LAMP10").used, 1)
+
+    def test_failing_entries_are_reported_and_hold_nothing(self):
+        self.add([{"product": self.lamp.pk, "quantity": 1, "coupon": "LAMP10"}])
+        response = self.add([
+            {"product": self.lamp.pk, "quantity": 1, "coupon": "LAMP10"},
+            {"product": self.rug.pk, "quantity": 2, "coupon": "RUG50"},
+            {"product": self.vase.pk, "quantity": 1, "coupon": "VASE25"},
+            {"product": self.rug.pk, "quantity": 1, "coupon": "NOPE"},
+            {"product": self.rug.pk, "quantity": 1, "coupon": "RUG50"},
+            {"product": self.rug.pk, "quantity": 1, "coupon": "RUG50"},
+        ])
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result["errors"] for result in response.data["results"]], [
+            ["Item already exists in the cart"],
+            ["Currently there's only 1 remaining in the stock"],
+            ["Coupon code expired or reached its limit!"],
+            ["Invalid Coupon Code!"],
+            [],
+            ["Item already exists in the cart"],
+        ])
+        # The vase was held, then handed back when its coupon ran out
+        self.assertEqual(list(Product.objects.order_by("id").values_list("reserved", flat=True)), [1, 1, 0])
+        self.assertEqual(sorted(CartItem.objects.filter(user=self.user).values_list("product_id", flat=True)), [self.lamp.pk, self.rug.pk])
+        self.assertEqual(cart_summary(self.user).items, 2)
+
+
+class StockReservationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=5)
+        Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=50)
+        self.clients = {}
+        for name in ("ann", "bob"):
+            user = CustomUser.objects.create_user(email=f"{name}@example.com", password=None, username=name)
+            _, token = AuthToken.objects.create(user)
+            self.clients[name] = APIClient()
+            self.clients[name].credentials(HTTP_AUTHORIZATION="Token " + token)
+
+    def add(self, name, quantity):
+        return self.clients[name].post("/api/cart/add", {"product": self.lamp.pk, "quantity": quantity, "coupon": "LAMP10"}, format="json")
+
+    def reserved(self):
+        return Product.objects.get(pk=self.lamp.pk).reserved
+
+    def test_carts_hold_stock_until_swept(self):
+        self.assertEqual(self.add("ann", 3).status_code, 200)
+        self.assertEqual(self.reserved(), 3)
+        self.assertEqual(self.add("bob", 3).data, {"non_field_errors": ["Currently there's only 2 remaining in the stock"]})
+        self.assertEqual(self.clients["bob"].post("/api/cart/add/bulk", [{"product": self.lamp.pk, "quantity": 2, "coupon": "LAMP10"}], format="json").status_code, 200)
+        self.assertEqual(self.reserved(), 5)
+
+        ann = CartItem.objects.get(user__username="ann")
+        self.clients["ann"].put(f"/api/cart/update/{ann.pk}", {"product": self.lamp.pk, "quantity": 1, "coupon": "LAMP10"}, format="json")
+        self.assertEqual(self.reserved(), 3)
+
+        # Bob buys with his own hold, Ann's is left for her
+        bob = CartItem.objects.get(user__username="bob")
+        self.assertEqual(self.clients["bob"].delete(f"/api/cart/buy/{bob.pk}").status_code, 200)
+        self.assertEqual((Product.objects.get(pk=self.lamp.pk).stock, self.reserved()), (3, 1))
+
+        self.assertEqual(sweep(), 0)
+        StockReservation.objects.update(expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertEqual(sweep(), 1)
+        self.assertEqual(self.reserved(), 0)
+
+        # A swept item is bought out of the stock nobody holds
+        self.assertEqual(self.clients["ann"].post("/api/cart/checkout").status_code, 200)
+        self.assertEqual((Product.objects.get(pk=self.lamp.pk).stock, self.reserved()), (2, 0))
+
+    def test_sweep_releases_in_batches_and_deletes_release(self):
+        users = [CustomUser.objects.create_user(email=f"u{n}@example.com", password=None, username=f"u{n}") for n in range(5)]
+        items = CartItem.objects.bulk_create(CartItem(user=user, product=self.lamp, quantity=1) for user in users)
+        expired = timezone.now() - timezone.timedelta(seconds=1)
+        StockReservation.objects.bulk_create(
+            StockReservation(cart_item=item, product=self.lamp, quantity=1, expires_at=expired if n < 4 else timezone.now() + timezone.timedelta(minutes=5))
+            for n, item in enumerate(items)
+        )
+        Product.objects.filter(pk=self.lamp.pk).update(reserved=5)
+
+        with self.assertNumQueries(4 * 3 + 1):
+            self.assertEqual(sweep(batch_size=2), 4)
+        self.assertEqual(self.reserved(), 1)
+
+        users[4].delete()
+        self.assertEqual(self.reserved(), 0)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class RepricingTests(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="pricer@example.com", password=None, username="pricer")
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=50)
+        self.rug = Product.objects.create(name="Wool rug", price=Decimal("20.00"), stock=50)
+        for code, discount in (("TEN", 10), ("ALSOTEN", 10), ("HALF", 50)):
+            Discounts.objects.create(product=self.lamp, discount=discount, coupon_code=code, allowed_users=5)
+        Discounts.objects.create(product=self.rug, discount=10, coupon_code="RUGTEN", allowed_users=5)
+
+    def item(self, product, coupon, quantity=2):
+        return CartItem.objects.create(
+            user=self.user, product=product, quantity=quantity, coupon=coupon, price=product.price, rate=product.price, total=product.price * quantity
+        )
+
+    def test_one_update_per_rate_and_only_the_products_rows(self):
+        lamps = {code: self.item(self.lamp, code) for code in ("TEN", "ALSOTEN", "HALF", "")}
+        rug = self.item(self.rug, "RUGTEN")
+        self.lamp.price = Decimal("30.00")
+        self.lamp.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reprice_product(self.lamp), 4)
+        # 27.00 for both ten percent coupons, 15.00 and the listed price
+        updates = [query["sql"] for query in queries if query["sql"].split()[:2] == ["UPDATE", connection.ops.quote_name("customer_cartitem")]]
+        self.assertEqual(len(updates), 3)
+
+        rates = {code: CartItem.objects.get(pk=item.pk).rate for code, item in lamps.items()}
+        self.assertEqual(rates, {"TEN": Decimal("27.00"), "ALSOTEN": Decimal("27.00"), "HALF": Decimal("15.00"), "": Decimal("30.00")})
+        self.assertEqual(CartItem.objects.get(pk=lamps["HALF"].pk).total, Decimal("30.00"))
+        untouched = CartItem.objects.get(pk=rug.pk)
+        self.assertEqual((untouched.rate, untouched.updated_at), (Decimal("20.00"), None))
+
+
+class RedemptionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.product = Product.objects.create(name="Headphones", price=Decimal("50.00"), stock=10)
+        self.discount = Discounts.objects.create(
+            product=self.product, discount=20, coupon_code="QUIET20", allowed_users=3, expiry=timezone.now() + timezone.timedelta(days=1)
+        )
+
+    def coupon(self):
+        return coupon_index.lookup(self.product.pk, "QUIET20")
+
+    def test_uses_stop_exactly_at_the_limit(self):
+        self.assertTrue(redeem_coupon(self.coupon(), count=2))
+        # Two more would pass the limit, none are taken
+        self.assertFalse(redeem_coupon(self.coupon(), count=2))
+        self.assertEqual(Discounts.objects.get(pk=self.discount.pk).used, 2)
+        self.assertTrue(redeem_coupon(self.coupon()))
+        self.assertFalse(redeem_coupon(self.coupon()))
+        self.assertEqual(Discounts.objects.get(pk=self.discount.pk).used, 3)
+
+    def test_a_coupon_that_expired_meanwhile_is_not_redeemed(self):
+        coupon = self.coupon()
+        # The index entry still has the old expiry, the UPDATE checks the row's
+        Discounts.objects.filter(pk=self.discount.pk).update(expiry=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertFalse(redeem_coupon(coupon))
+        self.assertEqual(Discounts.objects.get(pk=self.discount.pk).used, 0)
+
+    def test_full_shards_fall_back_to_the_others(self):
+        shard_coupon(self.discount, 2)
+        self.assertEqual(list(DiscountShard.objects.filter(discount=self.discount).order_by("index").values_list("allowed", flat=True)), [2, 1])
+        DiscountShard.objects.filter(discount=self.discount, index=0).update(used=2)
+
+        # Starting at the full shard it moves on to the next one
+        with mock.patch("customer.redemption.random.randrange", return_value=0):
+            self.assertTrue(redeem_coupon(self.coupon()))
+        self.assertEqual(DiscountShard.objects.get(discount=self.discount, index=1).used, 1)
+        self.assertFalse(redeem_coupon(self.coupon()))
+        self.assertEqual(total_redeemed(Discounts.objects.get(pk=self.discount.pk)), 3)
+        # Shards prefetched for a list are summed without another query
+        prefetched = Discounts.objects.prefetch_related("redemption_shards").get(pk=self.discount.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(total_redeemed(prefetched), 3)
+
+
+class OutboxTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        user = CustomUser.objects.create_user(email="boxer@example.com", password=None, username="boxer")
+        self.lamp = Product.objects.create(name="Desk lamp", price=Decimal("10.00"), stock=10)
+        self.discount = Discounts.objects.create(product=self.lamp, discount=10, coupon_code="LAMP10", allowed_users=5)
+        self.item = CartItem.objects.create(user=user, product=self.lamp, quantity=2, coupon="LAMP10", rate=Decimal("9.00"), total=Decimal("18.00"))
+
+    def update(self, serializer_class, instance, data):
+        serializer = serializer_class(instance, data=data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+    def test_repricing_runs_after_the_commit_coalesced(self):
+        for price in ("30.00", "20.00"):
+            self.update(ProductSerializer, self.lamp, {"name": "Desk lamp", "description": "Bright", "price": price, "stock": 10})
+        expiry = (timezone.now() + timezone.timedelta(days=1)).isoformat()
+        self.update(DiscountSerializer, self.discount, {"product": self.lamp.pk, "discount": 50, "provider": "shop", "coupon_code": "LAMP10", "allowed_users": 5, "expiry": expiry})
+
+        # The request only committed the change and its events
+        self.assertEqual(CartItem.objects.get(pk=self.item.pk).total, Decimal("18.00"))
+        self.assertEqual(OutboxEvent.objects.count(), 3)
+
+        # One thread, SQLite takes a single writer at a time
+        with ThreadPoolExecutor(1) as executor:
+            self.assertEqual(drain(executor=executor), (2, 0))
+        self.assertEqual(CartItem.objects.get(pk=self.item.pk).total, Decimal("20.00"))
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_product_and_discount_reprices_run_side_by_side(self):
+        self.update(ProductSerializer, self.lamp, {"name": "Desk lamp", "description": "Bright", "price": "20.00", "stock": 10})
+        expiry = (timezone.now() + timezone.timedelta(days=1)).isoformat()
+        self.update(DiscountSerializer, self.discount, {"product": self.lamp.pk, "discount": 50, "provider": "shop", "coupon_code": "LAMP10", "allowed_users": 5, "expiry": expiry})
+        runs = batches(claim(10))
+        self.assertEqual(sorted(topic for topic, _, _, _ in runs), ["reprice_discount", "reprice_product"])
+        barrier = threading.Barrier(len(runs))
+        outcomes = []
+
+        def work(arguments):
+            barrier.wait()
+            try:
+                for attempt in range(500):
+                    # A run that lost to the other one's write lock is retried, as the worker would
+                    if run(*arguments):
+                        outcomes.append("ran")
+                        return
+                    time.sleep(0.01)
+                outcomes.append("gave up")
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, args=(arguments,)) for arguments in runs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes, ["ran", "ran"])
+        item = CartItem.objects.get(pk=self.item.pk)
+        self.assertEqual((item.price, item.rate, item.total), (Decimal("20.00"), Decimal("10.00"), Decimal("20.00")))
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_events_back_off_then_park(self):
+        calls = []
+
+        def flaky(product_id):
+            calls.append(product_id)
+            Product.objects.filter(pk=product_id).update(stock=0)
+            raise RuntimeError("upstream down")
+
+        handlers["flaky"] = flaky
+        self.addCleanup(handlers.pop, "flaky")
+        enqueue("flaky", product_id=self.lamp.pk)
+
+        with override_settings(OUTBOX_MAX_ATTEMPTS=2):
+            self.assertEqual(drain(), (0, 1))
+            event = OutboxEvent.objects.get()
+            self.assertEqual((event.attempts, event.last_error), (1, "RuntimeError: upstream down"))
+            self.assertGreater(event.available_at, timezone.now())
+            # The failed run's writes were rolled back
+            self.assertEqual(Product.objects.get(pk=self.lamp.pk).stock, 10)
+
+            OutboxEvent.objects.update(available_at=timezone.now())
+            self.assertEqual(drain(), (0, 1))
+            self.assertIsNone(OutboxEvent.objects.get().available_at)
+            self.assertEqual(drain(), (0, 0))
+        self.assertEqual(len(calls), 2)
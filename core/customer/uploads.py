@@ -0,0 +1,210 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image as PILImage, UnidentifiedImageError
+from .models import Image, ImageUpload, Product
+from .imaging import file_sha256
+from .renditions import schedule_renditions
+from .cache import bump_catalog_version
+
+# Bytes moved per read/write, the most an upload holds in memory
+BLOCK_SIZE = 64 * 1024
+
+# Running hashes of in-progress uploads kept by this process
+MAX_RUNNING_HASHES = 1000
+
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+
+_lock = threading.Lock()
+_running = OrderedDict()
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    def __init__(self, offset):
+        super().__init__(f"The upload continues at byte {offset}")
+        self.offset = offset
+
+
+class InvalidUpload(UploadError):
+    pass
+
+
+def blob_name(sha256, extension):
+    return f"photos/{sha256[:2]}/{sha256}{extension}"
+
+
+def find_blob(sha256):
+    # Stored file of an image with this content, if any is still on disk
+    for name in Image.objects.filter(sha256=sha256).values_list('image', flat=True).distinct():
+        if default_storage.exists(name):
+            return name
+    return None
+
+
+def attach_image(product, sha256, name):
+    """
+    Image row of `product` for the stored file `name`. Renditions of the same
+    content are reused, otherwise they are scheduled once the row commits.
+    """
+    rendered = Image.objects.filter(sha256=sha256).exclude(renditions={}).values_list('renditions', flat=True).first()
+    image = Image.objects.create(product=product, image=name, sha256=sha256, renditions=rendered or {})
+    # The product's images are part of its representation, see customer.conditional
+    Product.objects.filter(pk=product.pk).update(updated_at=timezone.now())
+    if not rendered:
+        transaction.on_commit(partial(schedule_renditions, image))
+    transaction.on_commit(bump_catalog_version)
+    return image
+
+
+def store_image(product, upload):
+    """
+    Attach an uploaded file to `product`, writing it only when its content is
+    not stored yet. Returns `(image, deduplicated)`.
+    """
+    sha256 = file_sha256(upload)
+    name = find_blob(sha256)
+    deduplicated = name is not None
+    if not deduplicated:
+        name = default_storage.save(blob_name(sha256, os.path.splitext(upload.name)[1].lower()), upload)
+    return attach_image(product, sha256, name), deduplicated
+
+
+def part_path(upload):
+    return os.path.join(settings.IMAGE_UPLOAD_ROOT, f"{upload.pk}.part")
+
+
+def start_upload(product, user, size, filename="", sha256=""):
+    """
+    Open a chunked upload of `size` bytes. When `sha256` names content that
+    is already stored, the image is attached right away and no upload is
+    opened. Returns `(upload, image)`, one of them None.
+    """
+    if sha256:
+        name = find_blob(sha256)
+        if name is not None:
+            return None, attach_image(product, sha256, name)
+    upload = ImageUpload.objects.create(product=product, user=user, size=size, filename=filename, sha256=sha256)
+    os.makedirs(settings.IMAGE_UPLOAD_ROOT, exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload, None
+
+
+def _running_hash(upload):
+    # Hash of the bytes received so far, rebuilt from the part file when another process took them
+    with _lock:
+        state = _running.pop(upload.pk, None)
+    if state is not None and state[0] == upload.received:
+        return state[1]
+    hasher = hashlib.sha256()
+    with open(part_path(upload), 'rb') as part:
+        remaining = upload.received
+        while remaining:
+            block = part.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _keep_running_hash(upload, hasher):
+    with _lock:
+        _running[upload.pk] = (upload.received, hasher)
+        while len(_running) > MAX_RUNNING_HASHES:
+            _running.popitem(last=False)
+
+
+def write_chunk(upload_id, user, offset, stream, length):
+    """
+    Append `length` bytes read from `stream` at `offset` of an upload,
+    streaming them to its part file and hash block by block.
+
+    Returns `(upload, image, deduplicated)`; image is set once the last byte
+    arrived and the file was stored (or found already stored). Raises
+    OffsetMismatch when `offset` is not where the upload continues and
+    InvalidUpload when the content turns out not to be the announced image.
+    """
+    with transaction.atomic():
+        upload = ImageUpload.objects.select_for_update().select_related('product').get(pk=upload_id, user=user)
+        if offset != upload.received:
+            raise OffsetMismatch(upload.received)
+        if offset + length > upload.size:
+            raise InvalidUpload("The chunk runs past the announced size")
+
+        hasher = _running_hash(upload)
+        with open(part_path(upload), 'r+b') as part:
+            # Bytes past the offset are left over from a write that did not commit
+            part.seek(offset)
+            part.truncate()
+            remaining = length
+            while remaining:
+                block = stream.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                part.write(block)
+                hasher.update(block)
+                remaining -= len(block)
+        upload.received += length - remaining
+
+        if upload.received < upload.size:
+            upload.save(update_fields=['received'])
+            _keep_running_hash(upload, hasher)
+            return upload, None, False
+
+        sha256 = hasher.hexdigest()
+        error = _check_content(upload, sha256)
+        if error is None:
+            name = find_blob(sha256)
+            deduplicated = name is not None
+            if deduplicated:
+                os.remove(part_path(upload))
+            else:
+                name = _move_to_blob(upload, sha256)
+            image = attach_image(upload.product, sha256, name)
+        else:
+            os.remove(part_path(upload))
+        upload.delete()
+
+    if error is not None:
+        raise InvalidUpload(error)
+    return upload, image, deduplicated
+
+
+def _check_content(upload, sha256):
+    if upload.sha256 and upload.sha256 != sha256:
+        return "The content does not match the announced sha256"
+    try:
+        with PILImage.open(part_path(upload)) as picture:
+            picture.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return "The upload is not an image"
+    return None
+
+
+def _move_to_blob(upload, sha256):
+    # A rename within MEDIA_ROOT, the received bytes are not copied again
+    with PILImage.open(part_path(upload)) as picture:
+        extension = EXTENSIONS.get(picture.format, os.path.splitext(upload.filename)[1].lower())
+    name = blob_name(sha256, extension)
+    target = default_storage.path(name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(part_path(upload), target)
+    return name
+
+
+def abort_upload(upload):
+    with _lock:
+        _running.pop(upload.pk, None)
+    if os.path.exists(part_path(upload)):
+        os.remove(part_path(upload))
+    upload.delete()
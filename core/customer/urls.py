@@ -5,6 +5,7 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from .views import *
+from . import async_views
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -30,18 +31,35 @@ urlpatterns = [
      path('products/create', ProductCreateView.as_view(), name='product_create'),
      path('products/', ProductListView.as_view(), name='product_list'),
      path('products/<int:pk>', ProductRetrieveView.as_view(), name='product_retrieve'),
+     path('products/search', ProductSearchView.as_view(), name='product_search'),
      path('products/update/<int:pk>', ProductUpdateView.as_view(), name='product_update'),
      path('products/delete/<int:pk>', ProductDeleteView.as_view(), name='product_delete'),
+     path('products/import', ProductImportView.as_view(), name='product_import'),
+     path('products/<int:pk>/images', ProductImageUploadView.as_view(), name='product_image_upload'),
+     path('products/<int:pk>/images/uploads', ImageUploadStartView.as_view(), name='image_upload_start'),
+     path('products/images/uploads/<int:pk>', ImageUploadView.as_view(), name='image_upload'),
+     path('products/cache/stats', CatalogCacheStatsView.as_view(), name='product_cache_stats'),
+     path('metrics', MetricsView.as_view(), name='metrics'),
      path('cart/add', CartAddView.as_view(), name='cart_add'),
+     path('cart/add/bulk', CartBulkAddView.as_view(), name='cart_add_bulk'),
      path('cart/', CartListView.as_view(), name='cart_list'),
+     path('cart/summary', CartSummaryView.as_view(), name='cart_summary'),
      path('cart/<int:pk>', CartRetrieveView.as_view(), name='cart_retrieve'),
      path('cart/update/<int:pk>', CartUpdateView.as_view(), name='cart_update'),
      path('cart/delete/<int:pk>', CartDeleteView.as_view(), name='cart_delete'),
      path('cart/buy/<int:pk>', CartBuyView.as_view(), name='cart_buy'),
+     path('cart/checkout', CartCheckoutView.as_view(), name='cart_checkout'),
      path('discount/', DiscountListView.as_view(), name="discount_view"),
      path('discount/create', DiscountCreateView.as_view(), name="discount_create"),
      path('discount/update/<int:pk>', DiscountUpdateView.as_view(), name="discount_update"),
      path('discount/retrieve/<int:pk>', DiscountRetrieveView.as_view(), name="discount_retrieve"),
      path('discount/delete/<int:pk>', DiscountDeleteView.as_view(), name="discount_delete"),
      path('discount/product/<int:pk>', DiscountProductSpecificView.as_view(), name="discount_product"),
-]
\ No newline at end of file
+     path('export/<str:name>', ExportView.as_view(), name="export"),
+     path('async/products/', async_views.product_list, name='async_product_list'),
+     path('async/products/<int:pk>', async_views.product_retrieve, name='async_product_retrieve'),
+     path('async/cart/', async_views.cart_list, name='async_cart_list'),
+     path('async/cart/<int:pk>', async_views.cart_retrieve, name='async_cart_retrieve'),
+     path('async/discount/', async_views.discount_list, name='async_discount_view'),
+     path('async/discount/product/<int:pk>', async_views.discount_product, name='async_discount_product'),
+]
@@ -1,15 +1,38 @@
+import io
 from django.contrib.auth import login
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.http import StreamingHttpResponse, HttpResponse
 
 from rest_framework import generics
 from rest_framework import permissions
-from .models import Product, CartItem, CustomUser, Discounts
+from .models import Product, CartItem, CustomUser, Discounts, ImageUpload
 from rest_framework.authtoken.serializers import AuthTokenSerializer
 from knox.views import LoginView as KnoxLoginView
-from knox.auth import TokenAuthentication
+from .authentication import CachedTokenAuthentication
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import ProductSerializer, UserRegisterSerializer, CartItemSerializer, DiscountSerializer
+from .serializers import ProductSerializer, UserRegisterSerializer, CartItemSerializer, DiscountSerializer, CartBulkEntrySerializer, CartSummarySerializer, ProductImageSerializer, ImageUploadSerializer
 from rest_framework.renderers import MultiPartRenderer
+from .pagination import KeysetPagination
+from .filters import ProductFilter, STOCK_FILTERS
+from .cache import cached_catalog_payload, bump_catalog_version, catalog_cache_stats
+from .conditional import ConditionalGetMixin
+from .fastpath import FastListMixin, product_rows, cart_item_rows, discount_rows, live_stock
+from .search import search_products
+from .uploads import store_image, start_upload, write_chunk, abort_upload, OffsetMismatch, InvalidUpload
+from .checkout import checkout, EmptyCart, OutOfStock
+from .coupons import bump_coupon_version
+from .cart import bulk_add_to_cart
+from .summary import cart_summary, line, record, refresh
+from .reservations import release
+from .importer import FORMATS, guess_format, read_rows, import_products
+from . import exporter
+from .metrics import registry
+from .routers import identify
 
 
 class LoginView(KnoxLoginView):
@@ -20,6 +43,7 @@ class LoginView(KnoxLoginView):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         login(request, user)
+        identify(user.pk)
         return super(LoginView, self).post(request, format=None)
     
 class UserRegisterView(generics.CreateAPIView):
@@ -30,42 +54,214 @@ class UserRegisterView(generics.CreateAPIView):
 class ProductCreateView(generics.CreateAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
 
-class ProductListView(generics.ListAPIView):
+class ProductListView(ConditionalGetMixin, FastListMixin, generics.ListAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    authentication_classes = (TokenAuthentication, )
+    row_encoder = product_rows
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
-
-class ProductRetrieveView(generics.RetrieveAPIView):
+    pagination_class = KeysetPagination
+    filter_backends = (ProductFilter, )
+
+    def list(self, request, *args, **kwargs):
+        # Pages differ by cursor and page size, and the links embed the host
+        data = cached_catalog_payload(
+            ("list", request.build_absolute_uri()), lambda: super(ProductListView, self).list(request, *args, **kwargs).data,
+            stock=any(request.query_params.get(param) for param in STOCK_FILTERS),
+        )
+        return Response(dict(data, results=live_stock(data['results'])))
+
+class ProductRetrieveView(ConditionalGetMixin, generics.RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def retrieve(self, request, *args, **kwargs):
+        data = cached_catalog_payload(("retrieve", kwargs['pk']), lambda: super(ProductRetrieveView, self).retrieve(request, *args, **kwargs).data)
+        return Response(live_stock([data])[0])
+
+class ProductSearchView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if(not query):
+            return Response({"message": "Pass the search terms as q"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(request.query_params.get('limit', settings.API_PAGE_SIZE)), settings.API_MAX_PAGE_SIZE)
+        except(ValueError):
+            return Response({"message": "limit must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+        if(limit < 1):
+            return Response({"message": "limit must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = live_stock(cached_catalog_payload(("search", query, limit), lambda: search_products(query, limit)))
+        return Response({"count": len(results), "results": results}, status=status.HTTP_200_OK)
+
 class ProductUpdateView(generics.UpdateAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
 
 class ProductDeleteView(generics.DestroyAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
 
     def destroy(self, request, *args, **kwargs):
         item = Product.objects.get(pk=kwargs['pk'])
-        item.delete()
+        with transaction.atomic():
+            # The cart rows holding it go with it, their owners' summaries are recomputed after
+            owners = list(CartItem.objects.filter(product=item).values_list('user_id', flat=True))
+            item.delete()
+            if(owners):
+                refresh(owners)
+        transaction.on_commit(bump_catalog_version)
         return Response({"message":"Item deleted from the store successfully!"}, status=status.HTTP_200_OK)
 
+class ProductImageUploadView(generics.GenericAPIView):
+    serializer_class = ProductImageSerializer
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def post(self, request, *args, **kwargs):
+        product = Product.objects.filter(pk=kwargs['pk']).first()
+        if(product is None):
+            return Response({"message": "There's no such product in the store"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            # Content already stored is not written again, renditions are rendered off the request
+            image, deduplicated = store_image(product, serializer.validated_data['image'])
+        return Response({"message": "Image uploaded!", "id": image.id, "deduplicated": deduplicated}, status=status.HTTP_201_CREATED)
+
+class ImageUploadStartView(generics.GenericAPIView):
+    serializer_class = ImageUploadSerializer
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def post(self, request, *args, **kwargs):
+        product = Product.objects.filter(pk=kwargs['pk']).first()
+        if(product is None):
+            return Response({"message": "There's no such product in the store"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            upload, image = start_upload(product, request.user, **serializer.validated_data)
+        if(image is not None):
+            return Response({"message": "Image uploaded!", "id": image.id, "deduplicated": True}, status=status.HTTP_201_CREATED)
+        return Response({
+            "message": "Send the file with PUT in chunks, each with an Upload-Offset header",
+            "upload": upload.id, "offset": 0, "size": upload.size, "chunk_size": settings.IMAGE_UPLOAD_CHUNK_SIZE,
+        }, status=status.HTTP_201_CREATED)
+
+class ImageUploadView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def get_queryset(self):
+        return ImageUpload.objects.filter(user=self.request.user)
+
+    def get(self, request, *args, **kwargs):
+        # Where an interrupted upload resumes
+        upload = self.get_object()
+        return Response({"upload": upload.id, "offset": upload.received, "size": upload.size}, status=status.HTTP_200_OK)
+
+    def put(self, request, *args, **kwargs):
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except(KeyError, ValueError):
+            return Response({"message": "Send the Upload-Offset and Content-Length headers"}, status=status.HTTP_400_BAD_REQUEST)
+        if(length > settings.IMAGE_UPLOAD_CHUNK_SIZE):
+            return Response({"message": f"Chunks are at most {settings.IMAGE_UPLOAD_CHUNK_SIZE} bytes"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        try:
+            upload, image, deduplicated = write_chunk(kwargs['pk'], request.user, offset, request.stream, length)
+        except(ImageUpload.DoesNotExist):
+            return Response({"message": "No such upload"}, status=status.HTTP_404_NOT_FOUND)
+        except(OffsetMismatch) as e:
+            return Response({"message": str(e), "offset": e.offset}, status=status.HTTP_409_CONFLICT)
+        except(InvalidUpload) as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if(image is None):
+            return Response({"upload": upload.id, "offset": upload.received, "size": upload.size}, status=status.HTTP_200_OK)
+        return Response({"message": "Image uploaded!", "id": image.id, "deduplicated": deduplicated}, status=status.HTTP_201_CREATED)
+
+    def delete(self, request, *args, **kwargs):
+        abort_upload(self.get_object())
+        return Response({"message": "Upload cancelled"}, status=status.HTTP_200_OK)
+
+class ProductImportView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if(upload is None):
+            return Response({"message": "Upload a CSV or NDJSON file as 'file'"}, status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('file_format') or guess_format(upload.name)
+        if(file_format not in FORMATS):
+            return Response({"message": f"file_format must be one of {', '.join(FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Large uploads are spooled to disk by Django, rows are read off it one at a time
+        stream = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+        report = import_products(read_rows(stream, file_format), chunk_size=settings.PRODUCT_IMPORT_CHUNK_SIZE)
+        return Response(report, status=status.HTTP_200_OK)
+
+class ExportView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        name = kwargs['name']
+        file_format = request.query_params.get('file_format', 'ndjson')
+        if(name not in exporter.EXPORTS or file_format not in exporter.FORMATS):
+            return Response({"message": f"Exports: {', '.join(exporter.EXPORTS)}, formats: {', '.join(exporter.FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        since = request.query_params.get('since')
+        if(since is not None):
+            since = parse_datetime(since)
+            if(since is None):
+                return Response({"message": "since must be an ISO 8601 datetime"}, status=status.HTTP_400_BAD_REQUEST)
+            if(timezone.is_naive(since)):
+                since = timezone.make_aware(since)
+
+        # Rows changed from now on are picked up by the next export passing this watermark
+        watermark = timezone.now()
+        rows = exporter.export_rows(name, since=since, chunk_size=settings.EXPORT_CHUNK_SIZE)
+        response = StreamingHttpResponse(exporter.encode_rows(name, rows, file_format), content_type=exporter.CONTENT_TYPES[file_format])
+        response.headers['Content-Disposition'] = f'attachment; filename="{name}.{file_format}"'
+        response.headers['X-Export-Watermark'] = watermark.isoformat()
+        return response
+
+class CatalogCacheStatsView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(catalog_cache_stats(), status=status.HTTP_200_OK)
+
+class MetricsView(generics.GenericAPIView):
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        # Prometheus scrapes plain text, not one of the API renderers. Only this worker process's requests are in it
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 class CartAddView(generics.CreateAPIView):
     queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
     def post(self, request, *args, **kwargs):
@@ -75,17 +271,36 @@ class CartAddView(generics.CreateAPIView):
             return Response({"message": "Added to the cart!"}, status=status.HTTP_200_OK)
         return Response(serializer.errors)
     
-class CartListView(generics.ListAPIView):
+class CartBulkAddView(generics.GenericAPIView):
+    serializer_class = CartBulkEntrySerializer
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True, max_length=settings.CART_BULK_MAX_ITEMS)
+        if(not serializer.is_valid()):
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        results = [
+            {"index": index, "status": "error" if errors else "added", "errors": errors}
+            for index, errors in bulk_add_to_cart(request.user, serializer.validated_data)
+        ]
+        added = sum(1 for result in results if result["status"] == "added")
+        response_status = status.HTTP_200_OK if added == len(results) else status.HTTP_207_MULTI_STATUS
+        return Response({"message": f"Added {added} of {len(results)} items to the cart!", "results": results}, status=response_status)
+    
+class CartListView(FastListMixin, generics.ListAPIView):
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    row_encoder = cart_item_rows
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return CartItem.objects.filter(user=self.request.user)
 
 class CartRetrieveView(generics.RetrieveAPIView):
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
     def get_queryset(self):
@@ -93,7 +308,7 @@ class CartRetrieveView(generics.RetrieveAPIView):
 
 class CartUpdateView(generics.UpdateAPIView):
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
     def get_queryset(self):
@@ -101,84 +316,116 @@ class CartUpdateView(generics.UpdateAPIView):
 
 class CartDeleteView(generics.DestroyAPIView):
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
     def get_queryset(self):
         return CartItem.objects.filter(user=self.request.user)
     
     def destroy(self, request, *args, **kwargs):
-        item = CartItem.objects.get(pk=kwargs['pk'])
-        item.delete()
+        item = self.get_object()
+        with transaction.atomic():
+            release([item])
+            item.delete()
+            record(item.user_id, removed=[line(item)])
         return Response({"message":"Item deleted from the cart successfully!"}, status=status.HTTP_200_OK)
     
 class CartBuyView(generics.DestroyAPIView):
     serializer_class = CartItemSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
 
     def get_queryset(self):
         return CartItem.objects.filter(user=self.request.user)
     
     def destroy(self, request, *args, **kwargs):
-        item = CartItem.objects.get(pk=kwargs['pk'])
-        change = Product.objects.get(id=item.product.id)
-        discount = Discounts.objects.get(product=item.product, coupon_code=item.coupon)
-        discount.used += 1
-        change.stock -= item.quantity
-        discount.save()
-        change.save()
-        item.delete()
+        item = self.get_object()
+        try:
+            checkout(request.user, CartItem.objects.filter(pk=item.pk))
+        except(OutOfStock) as e:
+            return Response({"message": str(e)}, status=status.HTTP_409_CONFLICT)
         return Response({"message":"Item bought successfully!"}, status=status.HTTP_200_OK)
+
+class CartSummaryView(generics.RetrieveAPIView):
+    serializer_class = CartSummarySerializer
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_object(self):
+        return cart_summary(self.request.user)
+
+class CartCheckoutView(generics.GenericAPIView):
+    serializer_class = CartItemSerializer
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def post(self, request, *args, **kwargs):
+        try:
+            order = checkout(request.user)
+        except(EmptyCart) as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except(OutOfStock) as e:
+            return Response({"message": str(e), "product": e.product_id}, status=status.HTTP_409_CONFLICT)
+        return Response({"message": "Cart checked out successfully!", "items": order["items"], "total": order["total"]}, status=status.HTTP_200_OK)
     
 class DiscountCreateView(generics.CreateAPIView):
     queryset = Discounts.objects.all()
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser)
 
-class DiscountListView(generics.ListAPIView):
+class DiscountListView(ConditionalGetMixin, FastListMixin, generics.ListAPIView):
     queryset = Discounts.objects.all()
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    row_encoder = discount_rows
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
+    # Redemptions of sharded coupons are counted on the shards
+    conditional_aggregates = {"redeemed": Sum('redemption_shards__used')}
+    pagination_class = KeysetPagination
 
 class DiscountUpdateView(generics.UpdateAPIView):
     queryset = Discounts.objects.all()
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser)
 
-class DiscountProductSpecificView(generics.RetrieveAPIView):
+class DiscountProductSpecificView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, )
+    conditional_aggregates = {"redeemed": Sum('redemption_shards__used')}
 
     def get_queryset(self):
         return Discounts.objects.all()
+
+    def get_conditional_queryset(self):
+        return Discounts.objects.filter(product=self.kwargs['pk'])
     
-    def get(self, request, *args, **kwargs):
+    def retrieve(self, request, *args, **kwargs):
         try:
             item = Discounts.objects.filter(product=kwargs['pk']).values()
         except(Discounts.DoesNotExist):
             return Response({"message": "No discounts found on the particular product"})
         return Response(item.values(), status=status.HTTP_200_OK)
 
-class DiscountRetrieveView(generics.RetrieveAPIView):
+class DiscountRetrieveView(ConditionalGetMixin, generics.RetrieveAPIView):
     queryset = Discounts.objects.all()
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser)
+    conditional_aggregates = {"redeemed": Sum('redemption_shards__used')}
 
 class DiscountDeleteView(generics.DestroyAPIView):
     queryset = Discounts.objects.all()
     serializer_class = DiscountSerializer
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (permissions.IsAuthenticated, permissions.IsAdminUser)
 
     def destroy(self, request, *args, **kwargs):
         dis = Discounts.objects.get(pk=kwargs['pk'])
         dis.delete()
+        transaction.on_commit(bump_coupon_version)
         return Response({"message":"Discount deleted successfully!"}, status=status.HTTP_200_OK)
         
     